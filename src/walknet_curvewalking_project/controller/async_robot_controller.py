@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+import asyncio
+import time
+
+import rospy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+from walknet_curvewalking_project.controller.rate_groups import RateGroup
+from walknet_curvewalking_project.controller.robot_controller import RobotController
+
+# maximal number of joint state messages waiting for ingestion (3 joints * 6 legs * 4 messages per joint)
+JOINT_STATE_QUEUE_SIZE = 72
+
+
+##
+#   Robot controller node driven by an asyncio event loop.
+#
+#   All ROS callbacks are handed over to the event loop thread, so the state of the legs and the body
+#   model is only mutated on this thread. The node consists of separate tasks:
+#       - message ingestion: applies the received joint states and control messages and wakes up waiting tasks
+#       - control cycle: body model update and leg coordination at RSTATIC.controller_frequency
+#       - command publishing: sends the commands produced by the control cycle
+#       - visualization: publishes the body model at RSTATIC.visualization_frequency
+#       - parameter updates: the settings polled from the private ROS parameters by RobotController are applied
+#         by the control cycle before the body model update (see phantomx/settings.py)
+#   The stages are connected through bounded queues. Joint states and commands are "latest wins": when a
+#   queue is full the oldest entry is dropped (and counted) instead of blocking the producer. Control messages are
+#   not queued with the joint states, the latest one is kept in its own slot, so a burst of joint states cannot
+#   discard a steering command.
+#   The periodic tasks keep the statistics of rate groups (see rate_groups.py).
+#   On shutdown all tasks are cancelled.
+class AsyncRobotController:
+    def __init__(self, name, note_handle):
+        self.loop = asyncio.new_event_loop()
+        self.joint_state_queue = None
+        # latest control message (handler, data) that was not applied yet
+        self.control_message = None
+        self.messages_available = None
+        self.command_queue = None
+        self.state_changed = None
+        self.dropped_joint_states = 0
+        self.dropped_commands = 0
+        self.tasks = []
+        self.statistics = {}
+        self.robot = RobotController(name, note_handle, dispatch=self.dispatch)
+        for leg in self.robot.legs:
+            leg.leg.defer_commands = True
+
+    # Called from the ROS callback threads: hand the callback over to the event loop.
+    def dispatch(self, handler, data):
+        try:
+            self.loop.call_soon_threadsafe(self.enqueue, handler, data)
+        except RuntimeError:
+            # event loop already closed during shutdown
+            pass
+
+    def enqueue(self, handler, data):
+        if self.joint_state_queue is None:
+            # event loop is not running yet, apply directly (this already runs on the event loop thread)
+            handler(data)
+            return
+        if handler == self.robot.control_robot_callback:
+            self.control_message = (handler, data)
+        else:
+            if self.joint_state_queue.full():
+                self.joint_state_queue.get_nowait()
+                self.dropped_joint_states += 1
+            self.joint_state_queue.put_nowait((handler, data))
+        self.messages_available.set()
+
+    # Wait (without polling) until the predicate is true. It is reevaluated whenever new joint states or
+    # control messages were ingested. Returns the result of the predicate.
+    async def wait_for(self, predicate, timeout=None):
+        async with self.state_changed:
+            try:
+                await asyncio.wait_for(self.state_changed.wait_for(predicate), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return predicate()
+
+    def legs_ready(self):
+        return all(leg.leg.is_ready() for leg in self.robot.legs)
+
+    # True when the joint controllers of all legs took over the last sent command and reached it.
+    def legs_reached_commands(self):
+        return all(leg.leg.is_command_reached() for leg in self.robot.legs)
+
+    async def ingest_messages(self):
+        while True:
+            await self.messages_available.wait()
+            self.messages_available.clear()
+            # apply all messages that are already waiting before waking up the other tasks
+            if self.control_message is not None:
+                handler, data = self.control_message
+                self.control_message = None
+                handler(data)
+            while not self.joint_state_queue.empty():
+                handler, data = self.joint_state_queue.get_nowait()
+                handler(data)
+            async with self.state_changed:
+                self.state_changed.notify_all()
+
+    # Run function periodically with the given period. Releases that are missed because of a too long
+    # execution are skipped.
+    async def run_periodic(self, name, period, function):
+        group = RateGroup(name, 1.0 / period, function)
+        self.statistics[name] = group
+        next_release = time.perf_counter()
+        while True:
+            end = group.execute(next_release)
+            next_release = group.next_release(next_release, end)
+            await asyncio.sleep(next_release - time.perf_counter())
+
+    def send_commands(self):
+        commands = []
+        for leg in self.robot.legs:
+            commands.append((leg.leg.pending_command, leg.leg.is_traced(leg.leg.pending_ik)))
+            leg.leg.pending_command = None
+        if self.command_queue.full():
+            self.command_queue.get_nowait()
+            self.dropped_commands += 1
+        self.command_queue.put_nowait(commands)
+
+    async def publish_commands(self):
+        while True:
+            commands = await self.command_queue.get()
+            for leg, (command, traced) in zip(self.robot.legs, commands):
+                if command is not None:
+                    leg.leg.send_command(command, traced)
+
+    def control_step(self):
+        self.robot.updateStanceBodyModel()
+        for leg in self.robot.legs:
+            leg.manage_walk(sleep=False)
+        self.send_commands()
+
+    async def move_legs_into_init_pos(self):
+        rospy.loginfo("wait for legs to connect...")
+        await self.wait_for(self.legs_ready)
+        rospy.loginfo("legs connected move to init pos")
+        self.robot.command_init_pos()
+        self.send_commands()
+        if await self.wait_for(self.legs_reached_commands, RSTATIC.init_pos_timeout):
+            rospy.loginfo("reached init positions")
+        else:
+            rospy.logwarn("timeout while moving into init positions")
+
+    async def control_cycle(self):
+        await self.move_legs_into_init_pos()
+        rospy.loginfo("wait for walking motivation...")
+        await self.wait_for(lambda: self.robot.walk_motivation)
+        await self.run_periodic('control_cycle', 1.0 / RSTATIC.controller_frequency, self.control_step)
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def main(self):
+        self.joint_state_queue = asyncio.Queue(maxsize=JOINT_STATE_QUEUE_SIZE)
+        self.messages_available = asyncio.Event()
+        self.command_queue = asyncio.Queue(maxsize=1)
+        self.state_changed = asyncio.Condition()
+        self.tasks = [self.loop.create_task(self.ingest_messages()),
+                      self.loop.create_task(self.control_cycle()),
+                      self.loop.create_task(self.publish_commands()),
+                      self.loop.create_task(self.run_periodic('visualization', 1.0 / RSTATIC.visualization_frequency,
+                              self.robot.body_model.publish_visualization))]
+        rospy.on_shutdown(lambda: self.loop.call_soon_threadsafe(self.cancel))
+        # a failing task stops the whole node
+        done, pending = await asyncio.wait(self.tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                rospy.logerr("task " + str(task.get_coro()) + " failed: " + str(task.exception()))
+        for stats in self.statistics.values():
+            rospy.loginfo(str(stats))
+        rospy.loginfo("dropped joint states = " + str(self.dropped_joint_states) + " dropped commands = " +
+                      str(self.dropped_commands))
+
+    def run(self):
+        try:
+            self.loop.run_until_complete(self.main())
+        finally:
+            self.loop.close()
+
+
+if __name__ == '__main__':
+    nh = rospy.init_node('async_robot_controller', anonymous=True)
+    controller = AsyncRobotController('robot', nh)
+    controller.run()
@@ -0,0 +1,260 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import rospy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+from walknet_curvewalking_project.phantomx.settings import settings
+
+
+##
+#   Parallel execution of the per-leg computations of one control cycle (forward/inverse kinematics,
+#   swing trajectory search, stance updates). The body model has to be updated before a cycle is run.
+#   While the workers are running, all commands of the legs are deferred. After all workers are joined
+#   the commands are flushed in the fixed order of the legs, so the joint commands leave the controller
+#   in the same order as in the sequential execution.
+class LegExecutor:
+    def __init__(self, robot):
+        self.robot = robot
+        self.legs = robot.legs
+        self.cycles = 0
+        self.leg_times = numpy.zeros(len(self.legs))
+        self.max_leg_times = numpy.zeros(len(self.legs))
+        self.cycle_time = 0.0
+        self.max_cycle_time = 0.0
+
+    def run_cycle(self):
+        start = time.perf_counter()
+        self.execute_legs()
+        for leg in self.legs:
+            leg.leg.flush_command()
+        self.cycle_time = time.perf_counter() - start
+        self.max_cycle_time = max(self.max_cycle_time, self.cycle_time)
+        numpy.maximum(self.max_leg_times, self.leg_times, out=self.max_leg_times)
+        self.cycles += 1
+
+    def shutdown(self):
+        for leg in self.legs:
+            leg.leg.defer_commands = False
+            leg.leg.flush_command()
+
+    def statistics(self):
+        return {'cycles': self.cycles, 'cycle_time': self.cycle_time, 'max_cycle_time': self.max_cycle_time,
+                'leg_times': dict(zip(RSTATIC.leg_names, self.leg_times.tolist())),
+                'max_leg_times': dict(zip(RSTATIC.leg_names, self.max_leg_times.tolist()))}
+
+
+##
+#   Runs the manage_walk step of every leg in a thread pool. This pays off for the numpy heavy
+#   parts of the computation that release the GIL. The workers do not write the shared state of the body model:
+#   the legs that are put on the ground and the failed inverse kinematics are deferred like the commands and applied
+#   in the order of the legs after the workers are joined (see mmcBodyModelStance.apply_deferred_updates).
+class ThreadedLegExecutor(LegExecutor):
+    def __init__(self, robot, workers=None):
+        LegExecutor.__init__(self, robot)
+        self.pool = ThreadPoolExecutor(max_workers=workers or len(self.legs), thread_name_prefix='leg_worker')
+        for leg in self.legs:
+            leg.leg.defer_commands = True
+        self.robot.body_model.defer_updates = True
+
+    def timed_walk_step(self, leg_nr):
+        start = time.perf_counter()
+        self.legs[leg_nr].manage_walk(sleep=False)
+        self.leg_times[leg_nr] = time.perf_counter() - start
+
+    def execute_legs(self):
+        futures = [self.pool.submit(self.timed_walk_step, leg_nr) for leg_nr in range(len(self.legs))]
+        # joined in leg order, exceptions of the workers are raised here
+        for future in futures:
+            future.result()
+        self.robot.body_model.apply_deferred_updates()
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+        self.robot.body_model.defer_updates = False
+        LegExecutor.shutdown(self)
+
+
+# layout of the joint state rows in the shared memory: angles, targets, reached flags
+JOINT_STATE_SIZE = 9
+
+
+##
+#   Runs the manage_walk step of the legs in worker processes. Every worker owns a forked copy of the robot
+#   controller and is responsible for a fixed subset of legs, so the state of the motion primitives of these legs
+#   only lives in the worker. In every cycle the parent mirrors the inputs of the leg computations (joint states,
+#   leg vectors and ground contacts of the body model, estimated ground contacts, swing states, walking motivation,
+#   support polygon of the stability monitor)
+#   into shared memory
+#   arrays. The workers write back the commands (and whether they were computed by the stance inverse kinematics),
+#   the new swing states, the legs that were put on the ground and the legs with failed inverse kinematics.
+#   These results are applied in the parent in the fixed order of the legs. The swing starts are checked by the
+#   stability monitor of the worker, so legs of different workers that start their swings in the same cycle are only
+#   checked against the support polygon at the start of the cycle.
+#   Settings that are changed in the parent at runtime (see settings.apply_pending) are sent to the workers with the
+#   next cycle and applied there before the legs are run.
+#   Requires the fork start method. As long as the process executor is used, the motion primitives of the
+#   legs in the parent are not updated.
+class ProcessLegExecutor(LegExecutor):
+    def __init__(self, robot, workers=None):
+        LegExecutor.__init__(self, robot)
+        leg_count = len(self.legs)
+        workers = min(workers or multiprocessing.cpu_count(), leg_count)
+        context = multiprocessing.get_context('fork')
+
+        self.joint_state = self.shared_array(context, (leg_count, JOINT_STATE_SIZE))
+        self.leg_vect = self.shared_array(context, (leg_count, 3))
+        self.ground_contact = self.shared_array(context, (leg_count,))
+        self.contact_confidence = self.shared_array(context, (leg_count,))
+        self.support_feet = self.shared_array(context, (leg_count, 2))
+        self.support_stance = self.shared_array(context, (leg_count,))
+        self.swing = self.shared_array(context, (leg_count,))
+        self.walk_motivation = self.shared_array(context, (1,))
+        self.command = self.shared_array(context, (leg_count, 3))
+        self.command_valid = self.shared_array(context, (leg_count,))
+        self.command_ik = self.shared_array(context, (leg_count,))
+        self.put_on_ground = self.shared_array(context, (leg_count,))
+        self.put_on_ground_vect = self.shared_array(context, (leg_count, 3))
+        self.ik_failure = self.shared_array(context, (leg_count,))
+        self.shared_leg_times = self.shared_array(context, (leg_count,))
+        self.worker_times = self.shared_array(context, (workers,))
+
+        self.connections = []
+        self.processes = []
+        for worker_nr in range(workers):
+            leg_nrs = list(range(worker_nr, leg_count, workers))
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target=self.worker_loop, args=(child_connection, worker_nr, leg_nrs),
+                    name='leg_worker_' + str(worker_nr), daemon=True)
+            process.start()
+            child_connection.close()
+            self.connections.append(parent_connection)
+            self.processes.append(process)
+        for leg in self.legs:
+            leg.leg.defer_commands = True
+        # values of the settings changed since the last cycle, subscribed after forking so only the parent collects them
+        self.settings_updates = {}
+        settings.subscribe(settings.definitions.keys(), self.collect_settings_updates)
+
+    def collect_settings_updates(self, changed):
+        for name in changed:
+            self.settings_updates[name] = settings.get(name)
+
+    @staticmethod
+    def shared_array(context, shape):
+        return numpy.frombuffer(context.RawArray('d', int(numpy.prod(shape))), dtype=float).reshape(shape)
+
+    def write_inputs(self):
+        for leg_nr, leg in enumerate(self.legs):
+            # a leg without joint state is passed as NaN
+            angles = leg.leg.get_current_angles()
+            self.joint_state[leg_nr, 0:3] = numpy.nan if angles is None else angles
+            targets = leg.leg.get_current_targets()
+            self.joint_state[leg_nr, 3:6] = numpy.nan if targets is None else targets
+            self.joint_state[leg_nr, 6:9] = [leg.leg.alpha_reached, leg.leg.beta_reached, leg.leg.gamma_reached]
+            self.leg_vect[leg_nr] = self.robot.body_model.leg_vect[leg_nr]
+            self.ground_contact[leg_nr] = self.robot.body_model.gc[leg_nr]
+            self.swing[leg_nr] = leg.swing
+        self.walk_motivation[0] = self.robot.walk_motivation
+        self.contact_confidence[:] = self.robot.ground_contact_estimator.confidence
+        self.support_feet[:] = self.robot.stability_monitor.feet
+        self.support_stance[:] = self.robot.stability_monitor.stance
+
+    def read_inputs(self, leg_nrs):
+        self.robot.walk_motivation = bool(self.walk_motivation[0])
+        estimator = self.robot.ground_contact_estimator
+        estimator.confidence = self.contact_confidence.copy()
+        estimator.contact = estimator.confidence > 0.5
+        estimator.updated = True
+        self.robot.stability_monitor.update(self.support_feet.copy(), self.support_stance.astype(bool))
+        for leg_nr in leg_nrs:
+            leg = self.legs[leg_nr]
+            angles = self.joint_state[leg_nr, 0:3]
+            targets = self.joint_state[leg_nr, 3:6]
+            leg.leg.apply_joint_state([None] * 3 if numpy.isnan(angles).any() else angles.tolist(),
+                    [None] * 3 if numpy.isnan(targets).any() else targets.tolist(),
+                    self.joint_state[leg_nr, 6:9].astype(bool).tolist())
+            self.robot.body_model.leg_vect[leg_nr] = self.leg_vect[leg_nr].copy()
+            self.robot.body_model.gc[leg_nr] = bool(self.ground_contact[leg_nr])
+            leg.swing = bool(self.swing[leg_nr])
+
+    # Main loop of a worker process: waits for the next cycle (the settings changed in the parent, None to stop),
+    # runs the legs of this worker and writes back the results.
+    def worker_loop(self, connection, worker_nr, leg_nrs):
+        # the forked copy must not use the ROS connections of the parent
+        logging.getLogger('rosout').disabled = True
+        for leg_nr in leg_nrs:
+            self.legs[leg_nr].leg.defer_commands = True
+        while True:
+            settings_updates = connection.recv()
+            if settings_updates is None:
+                break
+            start = time.perf_counter()
+            if settings_updates:
+                settings.update(settings_updates)
+            self.read_inputs(leg_nrs)
+            for leg_nr in leg_nrs:
+                leg_start = time.perf_counter()
+                leg = self.legs[leg_nr]
+                was_on_ground = self.robot.body_model.gc[leg_nr]
+                self.robot.body_model.ik_failure[leg_nr] = False
+                leg.manage_walk(sleep=False)
+                command = leg.leg.pending_command
+                leg.leg.pending_command = None
+                self.command_valid[leg_nr] = command is not None
+                self.command_ik[leg_nr] = leg.leg.pending_ik
+                if command is not None:
+                    self.command[leg_nr] = command
+                self.put_on_ground[leg_nr] = not was_on_ground and self.robot.body_model.gc[leg_nr]
+                self.put_on_ground_vect[leg_nr] = self.robot.body_model.leg_vect[leg_nr]
+                self.ik_failure[leg_nr] = self.robot.body_model.ik_failure[leg_nr]
+                self.swing[leg_nr] = leg.swing
+                self.shared_leg_times[leg_nr] = time.perf_counter() - leg_start
+            self.worker_times[worker_nr] = time.perf_counter() - start
+            connection.send(True)
+
+    def execute_legs(self):
+        self.write_inputs()
+        settings_updates = self.settings_updates
+        self.settings_updates = {}
+        for connection in self.connections:
+            connection.send(settings_updates)
+        # joined in worker order
+        for connection in self.connections:
+            connection.recv()
+        self.leg_times[:] = self.shared_leg_times
+        for leg_nr, leg in enumerate(self.legs):
+            leg.swing = bool(self.swing[leg_nr])
+            if self.put_on_ground[leg_nr]:
+                self.robot.body_model.put_leg_on_ground(leg.name, self.put_on_ground_vect[leg_nr].copy())
+            if self.ik_failure[leg_nr]:
+                self.robot.body_model.report_ik_failure(leg_nr)
+            if self.command_valid[leg_nr]:
+                # the inverse kinematics of the worker is traced when its command is applied
+                leg.leg.ik_command = bool(self.command_ik[leg_nr])
+                leg.leg.set_command(self.command[leg_nr].copy())
+
+    def statistics(self):
+        stats = LegExecutor.statistics(self)
+        stats['worker_times'] = self.worker_times.tolist()
+        return stats
+
+    def shutdown(self):
+        for connection in self.connections:
+            connection.send(None)
+        for process in self.processes:
+            process.join(1.0)
+            if process.is_alive():
+                process.terminate()
+        LegExecutor.shutdown(self)
+
+
+def create_leg_executor(robot, mode, workers=None):
+    if mode == 'thread':
+        return ThreadedLegExecutor(robot, workers)
+    elif mode == 'process':
+        return ProcessLegExecutor(robot, workers)
+    raise ValueError('unknown parallel leg execution mode: ' + str(mode))
@@ -0,0 +1,119 @@
+import threading
+import time
+
+import rospy
+
+
+##
+#   A rate group bundles a function that is executed periodically at a fixed frequency.
+#   Each group has its own deadline (by default one period, measured from the release time of
+#   an execution) and keeps statistics about its execution times and deadline overruns.
+class RateGroup:
+    def __init__(self, name, frequency, function, deadline=None):
+        self.name = name
+        self.frequency = frequency
+        self.period = 1.0 / frequency
+        self.deadline = self.period if deadline is None else deadline
+        self.function = function
+
+        self.executions = 0
+        self.overruns = 0
+        self.skipped_releases = 0
+        self.total_execution_time = 0.0
+        self.max_execution_time = 0.0
+        self.max_latency = 0.0
+
+    # Execute the function once for the given release time and update the statistics.
+    # Returns the time at which the execution finished.
+    def execute(self, release):
+        start = time.perf_counter()
+        self.function()
+        end = time.perf_counter()
+        execution_time = end - start
+        latency = end - release
+        self.executions += 1
+        self.total_execution_time += execution_time
+        if execution_time > self.max_execution_time:
+            self.max_execution_time = execution_time
+        if latency > self.max_latency:
+            self.max_latency = latency
+        if latency > self.deadline:
+            self.overruns += 1
+        return end
+
+    # Release time following an execution that finished at end. Releases that are already missed are skipped (and
+    # counted) instead of being executed in a burst.
+    def next_release(self, release, end):
+        release += self.period
+        if end > release:
+            skipped = int((end - release) / self.period) + 1
+            self.skipped_releases += skipped
+            release += skipped * self.period
+        return release
+
+    def statistics(self):
+        mean_execution_time = self.total_execution_time / self.executions if self.executions > 0 else 0.0
+        return {'name': self.name, 'frequency': self.frequency, 'deadline': self.deadline,
+                'executions': self.executions, 'overruns': self.overruns, 'skipped_releases': self.skipped_releases,
+                'mean_execution_time': mean_execution_time, 'max_execution_time': self.max_execution_time,
+                'max_latency': self.max_latency}
+
+    def __str__(self):
+        stats = self.statistics()
+        return (self.name + " (" + str(self.frequency) + " Hz): executions = " + str(stats['executions']) +
+                " overruns = " + str(stats['overruns']) + " skipped = " + str(stats['skipped_releases']) +
+                " mean = " + str(round(stats['mean_execution_time'] * 1000, 3)) + " ms max = " +
+                str(round(stats['max_execution_time'] * 1000, 3)) + " ms max latency = " +
+                str(round(stats['max_latency'] * 1000, 3)) + " ms (deadline " +
+                str(round(stats['deadline'] * 1000, 3)) + " ms)")
+
+
+##
+#   Runs several rate groups concurrently, each one in its own thread.
+#   Releases are computed on the monotonic wall clock. When a group falls behind by more than
+#   a period the missed releases are skipped (and counted) instead of being executed in a burst.
+class MultiRateExecutor:
+    def __init__(self, groups, report_interval=10.0):
+        self.groups = groups
+        self.report_interval = report_interval
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def is_stopped(self):
+        return self.stop_event.is_set() or rospy.is_shutdown()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run_group(self, group):
+        next_release = time.perf_counter()
+        while not self.is_stopped():
+            try:
+                end = group.execute(next_release)
+            except Exception as e:
+                rospy.logerr("rate group " + group.name + " failed: " + str(e) + ". Stop multi-rate execution.")
+                self.stop()
+                raise
+            next_release = group.next_release(next_release, end)
+            self.stop_event.wait(max(0.0, next_release - time.perf_counter()))
+
+    def start(self):
+        for group in self.groups:
+            thread = threading.Thread(target=self.run_group, args=(group,), name=group.name, daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def log_statistics(self):
+        for group in self.groups:
+            rospy.loginfo(str(group))
+
+    # Start all groups and block until shutdown. The statistics are logged periodically.
+    def spin(self):
+        rospy.on_shutdown(self.stop)
+        self.start()
+        while not self.stop_event.wait(self.report_interval) and not rospy.is_shutdown():
+            self.log_statistics()
+        self.stop()
+        for thread in self.threads:
+            thread.join()
+        self.log_statistics()
@@ -1,39 +1,168 @@
 #!/usr/bin/env python3
+import functools
+import threading
+import time
 
+import numpy
 import rospy
-from walknet_curvewalking.msg import robot_control
+from walknet_curvewalking.msg import robot_control, robot_control_stamped
 
 import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+from walknet_curvewalking_project.controller.parallel_legs import create_leg_executor
+from walknet_curvewalking_project.controller.rate_groups import MultiRateExecutor, RateGroup
 from walknet_curvewalking_project.controller.single_leg_controller import SingleLegController
+from walknet_curvewalking_project.phantomx.SingleLeg import SingleLeg, wait_for_legs
+from walknet_curvewalking_project.phantomx.ground_contact import GroundContactEstimator
+from walknet_curvewalking_project.phantomx.leg_kinematics import differential_inverse_kinematics, inverse_kinematics
 from walknet_curvewalking_project.phantomx.mmcBodyModel3D import mmcBodyModelStance
+from walknet_curvewalking_project.phantomx.settings import settings
+from walknet_curvewalking_project.phantomx.stability import StabilityMonitor
+from walknet_curvewalking_project.support.latency import BODY_MODEL, LatencyTracer
+from walknet_curvewalking_project.support.telemetry import TelemetryRecorder
 
 
 class RobotController:
-    def __init__(self, name, note_handle):
+    # dispatch is an optional function dispatch(handler, data) through which all subscriber callbacks are passed
+    # (e.g. to handle them on an event loop instead of the ROS callback threads).
+    # offline: the robot is built without any ROS communication, the recorded messages are passed to the callbacks
+    # directly and the controller is stepped with body_model_step (see support/gait_replay.py).
+    def __init__(self, name, note_handle, dispatch=None, offline=False):
         self.debug = True
 
         self.nh = note_handle
         self.name = name
+        if not offline:
+            # settings from the YAML file and the private parameters of the node, see phantomx/settings.py
+            settings_file = rospy.get_param('~settings_file', None)
+            if settings_file is not None:
+                settings.load_yaml(settings_file, ignore_unknown=True)
+            settings.update(rospy.get_param('~', {}), ignore_unknown=True)
         self.walk_motivation = False
+        # set together with walk_motivation, see wait_for_walk_motivation
+        self.walk_motivation_event = threading.Event()
+        # optional parallel execution of the per-leg computations (see parallel_legs.py)
+        self.leg_executor = None
         self.legs = []
-        self.body_model = mmcBodyModelStance(self)
+        self.body_model = mmcBodyModelStance(self, offline)
         for name in RSTATIC.leg_names:
             swing = False
             if name == 'rm' or name == 'lf' or name == 'lr':
                 # swing = True
-                self.legs.append(SingleLegController(name, self.nh, swing, self))
+                self.legs.append(SingleLegController(name, self.nh, swing, self, dispatch, offline))
             if name == 'lm' or name == 'rf' or name == 'rr':
                 swing = True
-                self.legs.append(SingleLegController(name, self.nh, swing, self))
-        self.control_robot_sub = rospy.Subscriber('/control_robot', robot_control, self.control_robot_callback)
+                self.legs.append(SingleLegController(name, self.nh, swing, self, dispatch, offline))
+        # ground contact of all legs, updated once per body model update (see update_ground_contact)
+        self.ground_contact_estimator = GroundContactEstimator([leg.leg for leg in self.legs])
+        self.offline = offline
+        self.ground_contact_update_time = None
+        for leg in self.legs:
+            leg.leg.ground_contact_estimator = self.ground_contact_estimator
+        # static stability of the support polygon, gates the start of the swings (see stability.py)
+        self.stability_monitor = StabilityMonitor(len(self.legs))
+        # latency of the steering commands (see support/latency.py). The stamps of recorded messages are not
+        # comparable with the time of the replay, their latencies are traced from the reception.
+        self.latency_tracer = LatencyTracer(clock=time.time if offline else rospy.get_time)
+        self.use_command_stamps = not offline
+        self.control_commands = 0
+        for leg in self.legs:
+            leg.leg.latency_tracer = self.latency_tracer
+        self.control_robot_sub = None
+        self.control_robot_stamped_sub = None
+        if not offline:
+            from diagnostic_msgs.msg import DiagnosticArray
+            control_robot_callback = self.control_robot_callback
+            if dispatch is not None:
+                control_robot_callback = functools.partial(dispatch, self.control_robot_callback)
+            self.control_robot_sub = rospy.Subscriber('/control_robot', robot_control, control_robot_callback)
+            self.control_robot_stamped_sub = rospy.Subscriber('/control_robot_stamped', robot_control_stamped,
+                    control_robot_callback)
+            rospy.on_shutdown(self.log_statistics)
+            self.parameter_timer = rospy.Timer(rospy.Duration(RSTATIC.parameter_update_period), self.poll_parameters)
+            self.diagnostics_pub = rospy.Publisher('/diagnostics', DiagnosticArray, queue_size=1)
+            self.diagnostics_timer = rospy.Timer(rospy.Duration(RSTATIC.latency_diagnostics_period),
+                    self.publish_diagnostics)
+        # optional binary per tick records of the control loop (see support/telemetry.py)
+        self.telemetry = None
+        if RSTATIC.telemetry_directory is not None and not offline:
+            self.telemetry = TelemetryRecorder(RSTATIC.telemetry_directory, RSTATIC.telemetry_chunk_size,
+                    RSTATIC.telemetry_buffers)
+            rospy.on_shutdown(self.telemetry.close)
+
+    # Request an update of the settings from the private parameters of the node. The changes are applied by the
+    # control loop before the next body model update (see updateStanceBodyModel).
+    def poll_parameters(self, event=None):
+        try:
+            settings.request_update(rospy.get_param('~', {}), ignore_unknown=True)
+        except ValueError as error:
+            rospy.logerr("invalid settings: " + str(error))
+
+    def log_statistics(self):
+        ik_cache = self.legs[0].leg.ik_cache
+        if ik_cache is not None:
+            rospy.loginfo("inverse kinematics cache: " + str(ik_cache.statistics()))
+        rospy.loginfo("steering latency: " + str(self.latency_tracer.statistics()))
 
+    def publish_diagnostics(self, event=None):
+        self.diagnostics_pub.publish(self.latency_tracer.diagnostics(rospy.Time.now()))
+
+    # Compute the joint angles of the initial positions of all legs with one batched inverse kinematics and command
+    # them in the same cycle. Returns the legs with an initial position and their angles (n, 3).
+    def command_init_pos(self):
+        self.set_legs_init_pos()
+        legs = [leg for leg in self.legs if leg.init_pos is not None]
+        angles, valid = inverse_kinematics([leg.init_pos[0:3] for leg in legs],
+                [leg.leg.c1_static_transform for leg in legs], legs[0].leg.segment_lengths) if legs else ([], [])
+        for leg, leg_angles, leg_valid in zip(legs, angles, valid):
+            if not leg_valid:
+                raise ValueError('the initial position ' + str(leg.init_pos) + ' is not valid for the geometry of '
+                                 'leg ' + leg.name)
+            rospy.loginfo(leg.name + ": move to init pos " + str(leg.init_pos) + " angles = " + str(leg_angles))
+            leg.leg.set_command(leg_angles)
+        return legs, numpy.array(angles)
+
+    # Move all legs into their initial positions at the same time. Commands are resent to the legs that did not reach
+    # them after RSTATIC.init_pos_resend_period, together with the remaining joint errors of all legs. Returns False
+    # if the positions were not reached within RSTATIC.init_pos_timeout.
     def move_legs_into_init_pos(self):
-        rate = rospy.Rate(RSTATIC.controller_frequency)
-        for leg in self.legs:
-            while not leg.leg.is_ready():
-                rospy.loginfo("leg not connected yet! wait...")
-                rate.sleep()
+        self.wait_for_legs_ready()
         rospy.loginfo("legs connected move to init pos")
+        start = time.monotonic()
+        legs, angles = self.command_init_pos()
+        while not rospy.is_shutdown():
+            # woken up by the joint state callbacks as soon as all legs reached their commands
+            if wait_for_legs([leg.leg for leg in legs], SingleLeg.is_command_reached, RSTATIC.init_pos_resend_period):
+                rospy.loginfo("reached init positions after " + str(round(time.monotonic() - start, 3)) + " s")
+                return True
+            reached = numpy.array([leg.leg.is_command_reached() for leg in legs])
+            errors = numpy.abs(numpy.array([leg.leg.get_current_angles() for leg in legs]) - angles).max(axis=1)
+            rospy.loginfo("moving to init positions: " + ", ".join(
+                    leg.name + (" reached" if leg_reached else " error " + str(round(error, 3)) + " rad")
+                    for leg, leg_reached, error in zip(legs, reached, errors)))
+            if RSTATIC.init_pos_timeout is not None and time.monotonic() - start > RSTATIC.init_pos_timeout:
+                rospy.logwarn("timeout while moving into init positions, legs not reached: " +
+                              str([leg.name for leg, leg_reached in zip(legs, reached) if not leg_reached]))
+                return False
+            for leg, leg_angles, leg_reached in zip(legs, angles, reached):
+                if not leg_reached:
+                    leg.leg.set_command(leg_angles)
+        return False
+
+    # Block until the joint states of all legs were received.
+    def wait_for_legs_ready(self):
+        legs = [leg.leg for leg in self.legs]
+        while not wait_for_legs(legs, SingleLeg.is_ready, RSTATIC.state_wait_log_period) and \
+                not rospy.is_shutdown():
+            rospy.loginfo("leg not connected yet! wait... ready status = " + str([leg.is_ready() for leg in legs]))
+
+    # Block until a control message set the walking motivation. Returns the walking motivation.
+    def wait_for_walk_motivation(self):
+        while not self.walk_motivation_event.wait(RSTATIC.state_wait_log_period) and not rospy.is_shutdown():
+            rospy.loginfo("no walking motivation...")
+        return self.walk_motivation
+
+    # Set the initial position of every leg: the PEP for swing legs and the AEP for stance legs.
+    def set_legs_init_pos(self):
         for leg in self.legs:
             if leg.swing and (leg.name == "lf" or leg.name == "rf"):
                 init_pos = RSTATIC.front_initial_pep.copy()
@@ -60,25 +189,20 @@ class RobotController:
                 init_pos[1] = init_pos[1] * leg.movement_dir
                 leg.set_init_pos(init_pos)
 
-            if not leg.init_pos is None:
-                leg.move_leg_to(leg.init_pos)
-                rate.sleep()
-
-        finished = False
-        while not rospy.is_shutdown() and not finished:
-            finished = True
-            for leg in self.legs:
-                if not leg.leg.is_target_reached():
-                    finished = False
-                    leg.move_leg_to()
-                    rate.sleep()
-        rospy.loginfo("reached init positions")
-
+    # Steering command, either robot_control or robot_control_stamped. The latency of stamped messages is traced
+    # from their stamp, the latency of the others from the reception.
     def control_robot_callback(self, data):
+        self.control_commands += 1
         if data.speed_fact > 0:
+            header = getattr(data, 'header', None)
+            if header is not None and self.use_command_stamps and header.stamp.to_sec() > 0:
+                self.latency_tracer.command_received(header.seq, header.stamp.to_sec())
+            else:
+                self.latency_tracer.command_received(self.control_commands)
             self.body_model.pullBodyModelAtFrontIntoRelativeDirection(data.pull_angle, data.speed_fact)
             self.body_model.pullBodyModelAtBackIntoRelativeDirection(0, 0)
             self.walk_motivation = True
+            self.walk_motivation_event.set()
 
     def init_body_model(self):
         for leg in self.legs:
@@ -96,6 +220,10 @@ class RobotController:
             print("SWING: ", mleg.swing)
             # input()
 
+        settings.apply_pending()
+        self.body_model.update_history()
+        self.update_ground_contact()
+        self.stability_monitor.update(self.ground_contact_estimator.feet, [not leg.swing for leg in self.legs])
         self.body_model.updateLegStates()
 
         for i in range(0, 6):
@@ -104,34 +232,108 @@ class RobotController:
                 self.body_model.lift_leg_from_ground(i)
 
         self.body_model.mmc_iteration_step()
+        self.latency_tracer.trace(BODY_MODEL)
+        if RSTATIC.stance_ik_mode == 'differential':
+            self.update_stance_angles()
+
+    # Update of the ground contact estimator with the measured time since its last update. Offline the ticks are not
+    # run in real time, they are one period of the body model apart.
+    def update_ground_contact(self):
+        now = time.monotonic()
+        if self.offline or self.ground_contact_update_time is None:
+            period = 1.0 / RSTATIC.body_model_frequency
+        else:
+            period = now - self.ground_contact_update_time
+        self.ground_contact_update_time = now
+        self.ground_contact_estimator.update(period)
+
+    # Differential inverse kinematics step of all legs that continue their stance, computed in one batch for the
+    # stance movements of the following leg computations (see StanceMovementBodyModel.compute_stance_angles).
+    def update_stance_angles(self):
+        stance_nets = [leg.stance_net for leg in self.legs if
+                       leg.stance_net is not None and leg.stance_net.stance_angles is not None]
+        if not stance_nets:
+            return
+        next_angles, distances = differential_inverse_kinematics(
+                [stance_net.stance_angles for stance_net in stance_nets],
+                [stance_net.stance_target() for stance_net in stance_nets],
+                [stance_net.inverseKinematic_provider.c1_static_transform for stance_net in stance_nets],
+                RSTATIC.differential_ik_damping)
+        for stance_net, angles, distance in zip(stance_nets, next_angles, distances):
+            stance_net.batched_step = (stance_net.stance_angles, angles, float(distance))
 
     def walk_body_model(self):
         rate = rospy.Rate(RSTATIC.controller_frequency)
-        ready_status = [leg.leg.is_ready() for leg in self.legs]
-        rospy.loginfo("ready status = " + str(ready_status))
-        while ready_status.__contains__(False):
-            rospy.loginfo("leg not connected yet! wait...")
-            rate.sleep()
-            ready_status = [leg.leg.is_ready() for leg in self.legs]
-            rospy.loginfo("ready status = " + str(ready_status))
+        self.wait_for_legs_ready()
         while not rospy.is_shutdown():
             self.updateStanceBodyModel()
-            for leg in self.legs:
+            for leg_nr, leg in enumerate(self.legs):
                 if rospy.is_shutdown():
                     break
+                # the legs are stepped one tick apart, so the contact of a swing leg is estimated from the joint
+                # states of its tick
+                if leg_nr > 0 and RSTATIC.ground_contact_mode == 'estimator':
+                    self.update_ground_contact()
                 # input("press any key to performe the next step.")
                 leg.manage_walk()
                 rate.sleep()
+            if self.telemetry is not None:
+                self.telemetry.record(self)
 
-    def move_body_cohesive(self):
+    # One step of the body model and the leg coordination: used as the body model rate group of the multi-rate
+    # execution. The resulting joint targets are interpolated by the faster joint command rate group.
+    def body_model_step(self):
+        start = time.perf_counter()
+        self.updateStanceBodyModel()
+        if self.leg_executor is not None:
+            self.leg_executor.run_cycle()
+        else:
+            for leg in self.legs:
+                leg.manage_walk(sleep=False)
+        if self.telemetry is not None:
+            self.telemetry.record(self, time.perf_counter() - start)
+
+    def step_joint_commands(self):
+        for leg in self.legs:
+            leg.leg.step_command_interpolation()
+
+    # Walking with separate rates for the joint commands, the body model and the visualization
+    # (see RSTATIC.joint_command_frequency, RSTATIC.body_model_frequency and RSTATIC.visualization_frequency).
+    def walk_body_model_multi_rate(self):
+        self.wait_for_legs_ready()
+        interpolation_steps = max(1, int(round(RSTATIC.joint_command_frequency / RSTATIC.body_model_frequency)))
+        for leg in self.legs:
+            leg.leg.interpolation_steps = interpolation_steps
+            # the legs are stepped by the body model rate group
+            leg.leg.step_frequency = RSTATIC.body_model_frequency
+        executor = MultiRateExecutor([
+            RateGroup('joint_commands', RSTATIC.joint_command_frequency, self.step_joint_commands),
+            RateGroup('body_model', RSTATIC.body_model_frequency, self.body_model_step),
+            RateGroup('visualization', RSTATIC.visualization_frequency, self.body_model.publish_visualization)])
+        try:
+            executor.spin()
+        finally:
+            for leg in self.legs:
+                leg.leg.interpolation_steps = 1
+                leg.leg.step_frequency = None
+
+    # Walking with the per-leg computations of each cycle fanned out to a pool of workers.
+    # mode is either 'thread' or 'process' (see parallel_legs.py).
+    def walk_body_model_parallel(self, mode=RSTATIC.parallel_leg_mode, workers=RSTATIC.parallel_leg_workers):
         rate = rospy.Rate(RSTATIC.controller_frequency)
-        ready_status = [leg.leg.is_ready() for leg in self.legs]
-        rospy.loginfo("ready status = " + str(ready_status))
-        while ready_status.__contains__(False):
-            rospy.loginfo("leg not connected yet! wait...")
-            rate.sleep()
-            ready_status = [leg.leg.is_ready() for leg in self.legs]
-            rospy.loginfo("ready status = " + str(ready_status))
+        self.wait_for_legs_ready()
+        self.leg_executor = create_leg_executor(self, mode, workers)
+        try:
+            while not rospy.is_shutdown():
+                self.body_model_step()
+                rate.sleep()
+        finally:
+            rospy.loginfo("parallel leg execution statistics: " + str(self.leg_executor.statistics()))
+            self.leg_executor.shutdown()
+            self.leg_executor = None
+
+    def move_body_cohesive(self):
+        self.wait_for_legs_ready()
         leg_status = [not leg.swing for leg in self.legs]
         rospy.loginfo("leg_status = " + str(leg_status))
         while not rospy.is_shutdown() and not leg_status.__contains__(False):
@@ -151,5 +353,7 @@ if __name__ == '__main__':
         robot_controller.move_legs_into_init_pos()
         # robot_controller.move_body_cohesive()
         robot_controller.walk_body_model()
+        # robot_controller.walk_body_model_multi_rate()
+        # robot_controller.walk_body_model_parallel()
     except rospy.ROSInterruptException:
         pass
@@ -1,80 +1,117 @@
 #!/usr/bin/env python3
+import functools
+
 import rospy
-import tf
 from control_msgs.msg import JointControllerState
 
 import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
 from walknet_curvewalking_project.motion_primitives.stance_movement_body_model import StanceMovementBodyModel
 from walknet_curvewalking_project.motion_primitives.stance_movment_simple import StanceMovementSimple
 from walknet_curvewalking_project.motion_primitives.swing_movement_bezier import SwingMovementBezier
+from walknet_curvewalking_project.motion_primitives.swing_movement_joint_spline import SwingMovementJointSpline
 from walknet_curvewalking_project.phantomx.SingleLeg import SingleLeg
+from walknet_curvewalking_project.phantomx.settings import STANCE_GEOMETRY, SWING_MOVEMENT, settings
 
 
 class SingleLegController:
-    def __init__(self, name, note_handle, swing, robot):
+    # dispatch is an optional function dispatch(handler, data) through which the joint state callbacks are passed.
+    # offline: no subscribers, publishers, rate or tf listener are created, the joint states are passed to the
+    # callbacks of the leg directly and the controller is only stepped with manage_walk(sleep=False).
+    def __init__(self, name, note_handle, swing, robot, dispatch=None, offline=False):
         self.robot = robot
         self.name = name
         self.nh = note_handle
-        self.rate = rospy.Rate(RSTATIC.controller_frequency)
+        self.rate = None if offline else rospy.Rate(RSTATIC.controller_frequency)
         if 'l' in self.name:
             rospy.loginfo("leg on left side movement_dir 1")
             self.movement_dir = 1
         else:
             rospy.loginfo("leg on left side movement_dir -1")
             self.movement_dir = -1
-        self.leg = SingleLeg(name, [0.054, 0.066, 0.16], tf.TransformListener(), self.movement_dir)
-        self.temp = SwingMovementBezier(self.leg)
+        # the tf listener is only created when the transforms are looked up (see SingleLeg.transform_listener)
+        self.leg = SingleLeg(name, [0.054, 0.066, 0.16], None, self.movement_dir, offline)
+        self.temp = self.create_swing_movement()
+        # set when the swing settings changed, the swing movement is replaced before the next swing starts
+        self.swing_settings_changed = False
         self.swing = swing
+        # set when the stability gate refused the lift at the PEP, the leg requests its lift again in every step until
+        # it is lifted, also when its stance carried it behind the window of reached_pep
+        self.lift_delayed = False
         self.stance_trajectory_gen = StanceMovementSimple(self.leg)
         self.init_pos = None
 
-        # self.target_pos = None
-        if self.name == "lf" or self.name == "rf":
-            self.target_pos = RSTATIC.front_initial_aep.copy()
-        elif self.name == "lm" or self.name == "rm":
-            self.target_pos = RSTATIC.middle_initial_aep.copy()
-        elif self.name == "lr" or self.name == "rr":
-            self.target_pos = RSTATIC.hind_initial_aep.copy()
-        self.target_pos[1] = self.target_pos[1] * self.movement_dir
-        rospy.loginfo("leg " + str(self.name) + " target_pos = " + str(self.target_pos))
+        self.target_pos = None
+        self.update_target_pos()
+        settings.subscribe(STANCE_GEOMETRY, self.update_target_pos)
+        settings.subscribe(SWING_MOVEMENT, self.notify_swing_settings_changed)
 
         if self.robot is None:
             self.stance_net = None
         else:
             self.stance_net = StanceMovementBodyModel(self)
+        if offline:
+            return
+        c1_callback, thigh_callback, tibia_callback = self.leg.c1_callback, self.leg.thigh_callback, \
+            self.leg.tibia_callback
+        if dispatch is not None:
+            c1_callback = functools.partial(dispatch, c1_callback)
+            thigh_callback = functools.partial(dispatch, thigh_callback)
+            tibia_callback = functools.partial(dispatch, tibia_callback)
         self.alpha_sub = rospy.Subscriber('/phantomx/j_c1_' + self.name + '_position_controller/state',
-            JointControllerState, self.leg.c1_callback)
+            JointControllerState, c1_callback)
         self.beta_sub = rospy.Subscriber('/phantomx/j_thigh_' + self.name + '_position_controller/state',
-            JointControllerState, self.leg.thigh_callback)
+            JointControllerState, thigh_callback)
         self.gamma_sub = rospy.Subscriber('/phantomx/j_tibia_' + self.name + '_position_controller/state',
-            JointControllerState, self.leg.tibia_callback)
+            JointControllerState, tibia_callback)
+
+    def create_swing_movement(self):
+        if RSTATIC.swing_mode == 'joint_spline':
+            return SwingMovementJointSpline(self.leg)
+        return SwingMovementBezier(self.leg)
+
+    # The swing target is the AEP of the leg.
+    def update_target_pos(self, changed=None):
+        if self.name == "lf" or self.name == "rf":
+            target_pos = RSTATIC.front_initial_aep.copy()
+        elif self.name == "lm" or self.name == "rm":
+            target_pos = RSTATIC.middle_initial_aep.copy()
+        else:
+            target_pos = RSTATIC.hind_initial_aep.copy()
+        target_pos[1] = target_pos[1] * self.movement_dir
+        self.target_pos = target_pos
+        rospy.loginfo("leg " + str(self.name) + " target_pos = " + str(self.target_pos))
+
+    def notify_swing_settings_changed(self, changed):
+        self.swing_settings_changed = True
+
+    # Replace the swing movement if the swing settings changed. Only called between two swings.
+    def update_swing_movement(self):
+        if self.swing_settings_changed:
+            self.swing_settings_changed = False
+            self.temp = self.create_swing_movement()
 
     def set_init_pos(self, p):
         self.init_pos = p
         rospy.loginfo(self.name + ": set init pos to P = " + str(p))
         rospy.loginfo(self.name + ": set init pos = " + str(self.init_pos))
 
-    def bezier_swing(self):
-        while not self.leg.is_ready() and not rospy.is_shutdown():
+    # Block until the joint states of the leg were received (without polling, see SingleLeg.wait_for).
+    def wait_until_leg_ready(self):
+        while not self.leg.wait_until_ready(RSTATIC.state_wait_log_period) and not rospy.is_shutdown():
             rospy.loginfo("leg not connected yet! wait...")
-            self.rate.sleep()
-        self.temp.swing_start_point = self.leg.ee_position()[0:3]
-        # self.temp.swing_target_point = self.leg.compute_forward_kinematics([self.movement_dir * 0.3, 0, -1.0])[0:3]
 
-        # self.temp.swing_target_point = self.leg.compute_inverse_kinematics(target_pos)
-        self.temp.swing_target_point = self.target_pos
+    def bezier_swing(self):
+        self.wait_until_leg_ready()
+        # self.temp.swing_target_point = self.leg.compute_forward_kinematics([self.movement_dir * 0.3, 0, -1.0])[0:3]
         # the offset that is added to the middle point that was computed on the connecting line between start and
         # end point using the apex_point_ratio concept.
         # temp.apex_point_offset = numpy.array([0, 0, 0.4]) # constant is used
         # temp.collision_point = numpy.array([0.8, 0, 0.256])
-        # bezier_points = temp.compute_bezier_points()
-        # self.temp.trajectory_generator.bezier_points = self.temp.compute_bezier_points()
-        self.temp.trajectory_generator.bezier_points = self.temp.compute_bezier_points_with_joint_angles()
-        print(self.temp.trajectory_generator.bezier_points)
+        self.temp.start_swing(self.leg.ee_position()[0:3], self.target_pos)
         while not rospy.is_shutdown() and not self.leg.predictedGroundContact():
-            self.temp.move_to_next_point(1)
+            self.temp.step()
             self.rate.sleep()
-        self.temp.move_to_next_point(0)
+        self.temp.stop()
         self.rate.sleep()
         self.swing = False
 
@@ -84,71 +121,81 @@ class SingleLegController:
         #     rospy.loginfo("leg not connected yet! wait...")
         #     rate.sleep()
         # rospy.loginfo("leg connected start walking")
-        while not self.robot.walk_motivation and not rospy.is_shutdown():
-            rospy.loginfo("no walking motivation...")
-            self.rate.sleep()
+        self.robot.wait_for_walk_motivation()
         rospy.loginfo("leg connected start walking")
 
         while not rospy.is_shutdown():
             self.robot.updateStanceBodyModel()
             if self.swing:
-                if self.temp.swing_start_point is None:
+                if not self.temp.is_active():
                     rospy.loginfo("##############################reset swing")
-                    self.temp.swing_start_point = self.leg.ee_position()[0:3]
-                    # self.temp.swing_target_point = self.leg.compute_forward_kinematics(
-                    #    [self.movement_dir * 0.3, 0, -1.0])[0:3]
-                    self.temp.swing_target_point = self.target_pos
-                    # self.temp.trajectory_generator.bezier_points = self.temp.compute_bezier_points()
-                    self.temp.trajectory_generator.bezier_points = self.temp.compute_bezier_points_with_joint_angles()
-                self.temp.move_to_next_point(1)
+                    self.update_swing_movement()
+                    self.temp.start_swing(self.leg.ee_position()[0:3], self.target_pos)
+                self.temp.step()
                 self.rate.sleep()
                 if self.leg.predictedGroundContact():
-                    self.temp.move_to_next_point(0)
-                    self.temp.swing_start_point = None
+                    self.temp.stop()
                     self.rate.sleep()
                     self.swing = False
                 # rospy.loginfo('swing finished is: ' + str(self.swing_trajectory_gen.is_finished()))
             else:
                 self.stance_net.modulated_routine_function_call()
 
+    # The leg may only start a swing if the robot stays statically stable without it (see stability.py). A leg whose
+    # lift was delayed until it is more than stability_max_pep_overshoot behind its PEP is lifted anyway, before its
+    # stance runs into the joint limits.
+    def request_lift(self):
+        if self.robot is None:
+            return True
+        leg_nr = RSTATIC.leg_names.index(self.name)
+        if self.robot.stability_monitor.request_lift(leg_nr):
+            return True
+        if self.lift_delayed and self.leg.pep_distance() > RSTATIC.stability_max_pep_overshoot:
+            rospy.logwarn(self.name + ": lifted without stability, " + str(self.leg.pep_distance()) +
+                          " m behind the PEP. Stability margin without the leg: " +
+                          str(self.robot.stability_monitor.lift_margins[leg_nr]))
+            return self.robot.stability_monitor.request_lift(leg_nr, force=True)
+        rospy.loginfo(self.name + ": swing delayed, stability margin without the leg: " +
+                      str(self.robot.stability_monitor.lift_margins[leg_nr]))
+        return False
+
     # function for executing a single step in a stance movement.
-    def manage_walk(self):
+    # When sleep is False the swing step does not wait for the next cycle (the caller is responsible for the timing).
+    def manage_walk(self, sleep=True):
         if not self.robot.walk_motivation or rospy.is_shutdown():
             rospy.loginfo("no moving motivation or shutdown...")
             return
         else:
             if self.swing:
                 rospy.loginfo(self.name + ": execute swing step.")
-                if self.temp.swing_start_point is None:
+                if not self.temp.is_active():
                     rospy.loginfo("##############################reset swing")
-                    self.temp.swing_start_point = self.leg.ee_position()[0:3]
-                    self.temp.swing_target_point = self.target_pos
-                    # self.temp.swing_target_point = self.leg.compute_forward_kinematics(
-                    #                                [self.movement_dir * 0.3, -0.5, -1.2])[0:3]
-                    # self.temp.trajectory_generator.bezier_points = self.temp.compute_bezier_points()
-                    self.temp.trajectory_generator.bezier_points = self.temp.compute_bezier_points_with_joint_angles()
-                self.temp.move_to_next_point(1)
-                self.rate.sleep()
+                    self.update_swing_movement()
+                    self.temp.start_swing(self.leg.ee_position()[0:3], self.target_pos)
+                self.temp.step()
+                if sleep:
+                    self.rate.sleep()
                 if self.leg.predictedGroundContact():
-                    self.temp.move_to_next_point(0)
-                    self.temp.swing_start_point = None
+                    self.temp.stop()
                     # self.rate.sleep()
                     self.swing = False
                 # rospy.loginfo('swing finished is: ' + str(self.swing_trajectory_gen.is_finished()))
             else:
                 rospy.loginfo(self.name + ": execute stance step.")
                 self.stance_net.modulated_routine_function_call()
-                if self.leg.reached_pep():
-                    rospy.loginfo(self.name + ": reached_pep. switch to swing mode.")
-                    self.stance_net.reset_stance_trajectory()
-                    # self.rate.sleep()
-                    self.swing = True
+                if self.leg.reached_pep() or (self.lift_delayed and self.leg.passed_pep()):
+                    if self.request_lift():
+                        rospy.loginfo(self.name + ": reached_pep. switch to swing mode.")
+                        self.stance_net.reset_stance_trajectory()
+                        # self.rate.sleep()
+                        self.swing = True
+                        self.lift_delayed = False
+                    else:
+                        self.lift_delayed = True
 
     # function for moving a leg alternating between swing and stance.
     def manage_walk_bezier(self):
-        while not self.leg.is_ready() and not rospy.is_shutdown():
-            rospy.loginfo("leg not connected yet! wait...")
-            self.rate.sleep()
+        self.wait_until_leg_ready()
         rospy.loginfo("leg connected")
 
         alpha = 0.3
@@ -159,18 +206,15 @@ class SingleLegController:
         while not rospy.is_shutdown():
             if self.swing:
                 rospy.loginfo(str(self.name) + " in swing phase")
-                if self.temp.swing_start_point is None:
+                if not self.temp.is_active():
                     rospy.loginfo("##############################reset swing")
-                    self.temp.swing_start_point = self.leg.ee_position()[0:3]
-                    self.temp.swing_target_point = self.leg.compute_forward_kinematics(
-                        [self.movement_dir * 0.3, 0, -1.0])[0:3]
-                    # self.temp.trajectory_generator.bezier_points = self.temp.compute_bezier_points()
-                    self.temp.trajectory_generator.bezier_points = self.temp.compute_bezier_points_with_joint_angles()
-                self.temp.move_to_next_point(1)
+                    self.update_swing_movement()
+                    self.temp.start_swing(self.leg.ee_position()[0:3], self.leg.compute_forward_kinematics(
+                        [self.movement_dir * 0.3, 0, -1.0])[0:3])
+                self.temp.step()
                 self.rate.sleep()
                 if self.leg.predictedGroundContact():
-                    self.temp.move_to_next_point(0)
-                    self.temp.swing_start_point = None
+                    self.temp.stop()
                     self.rate.sleep()
                     self.swing = False
                 # rospy.loginfo('swing finished is: ' + str(self.swing_trajectory_gen.is_finished()))
@@ -186,9 +230,7 @@ class SingleLegController:
 
     # function for executing a single stance movement.
     def manage_simple_stance(self):
-        while not self.leg.is_ready():
-            rospy.loginfo("leg not connected yet! wait...")
-            self.rate.sleep()
+        self.wait_until_leg_ready()
         rospy.loginfo("leg connected start swing")
         self.stance_trajectory_gen.set_start_point(self.leg.ee_position())
         alpha = 0.3
@@ -206,9 +248,7 @@ class SingleLegController:
         #     rospy.loginfo("leg not connected yet! wait...")
         #     rate.sleep()
         # rospy.loginfo("leg connected start walking")
-        while not self.robot.walk_motivation and not rospy.is_shutdown():
-            rospy.loginfo("no moving motivation...")
-            self.rate.sleep()
+        self.robot.wait_for_walk_motivation()
         rospy.loginfo("leg connected start walking")
         while not rospy.is_shutdown():
             # input("press any key to performe the next step for " + str(self.name) + " leg.")
@@ -223,7 +263,7 @@ class SingleLegController:
         else:
             rospy.loginfo(self.name + ": leg connected start walking. Swing = " + str(self.swing))
             self.stance_net.modulated_routine_function_call()
-            if self.leg.reached_pep():
+            if self.leg.reached_pep() and self.request_lift():
                 rospy.loginfo(self.name + ": reached pep. swing will be set to True")
                 self.stance_net.reset_stance_trajectory()
                 self.rate.sleep()
@@ -1,129 +1,178 @@
 #!/usr/bin/env python3
 
 import time
-from threading import Lock
+from threading import Condition
 
+import numpy
 import rospy
 from control_msgs.msg import JointControllerState
 from std_msgs.msg import Float64
 
 import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
 
+# maximal duration of a phase (interpolation and convergence) in seconds
 TIMEOUT = 15
-tibia_mutex = Lock()
-thigh_mutex = Lock()
-tibia_joint_values = {}
-thigh_joint_values = {}
-started = False
-c1_pub_list = [rospy.Publisher('/phantomx/j_c1_lf_position_controller/command', Float64, queue_size=1),
-               rospy.Publisher('/phantomx/j_c1_lm_position_controller/command', Float64, queue_size=1),
-               rospy.Publisher('/phantomx/j_c1_lr_position_controller/command', Float64, queue_size=1),
-               rospy.Publisher('/phantomx/j_c1_rf_position_controller/command', Float64, queue_size=1),
-               rospy.Publisher('/phantomx/j_c1_rm_position_controller/command', Float64, queue_size=1),
-               rospy.Publisher('/phantomx/j_c1_rr_position_controller/command', Float64, queue_size=1)]
-thigh_pub_list = [rospy.Publisher('/phantomx/j_thigh_lf_position_controller/command', Float64, queue_size=1),
-                  rospy.Publisher('/phantomx/j_thigh_lm_position_controller/command', Float64, queue_size=1),
-                  rospy.Publisher('/phantomx/j_thigh_lr_position_controller/command', Float64, queue_size=1),
-                  rospy.Publisher('/phantomx/j_thigh_rf_position_controller/command', Float64, queue_size=1),
-                  rospy.Publisher('/phantomx/j_thigh_rm_position_controller/command', Float64, queue_size=1),
-                  rospy.Publisher('/phantomx/j_thigh_rr_position_controller/command', Float64, queue_size=1)]
-tibia_pub_list = [rospy.Publisher('/phantomx/j_tibia_lf_position_controller/command', Float64, queue_size=1),
-                  rospy.Publisher('/phantomx/j_tibia_lm_position_controller/command', Float64, queue_size=1),
-                  rospy.Publisher('/phantomx/j_tibia_lr_position_controller/command', Float64, queue_size=1),
-                  rospy.Publisher('/phantomx/j_tibia_rf_position_controller/command', Float64, queue_size=1),
-                  rospy.Publisher('/phantomx/j_tibia_rm_position_controller/command', Float64, queue_size=1),
-                  rospy.Publisher('/phantomx/j_tibia_rr_position_controller/command', Float64, queue_size=1)]
-
-
-def tibia_callback(data, args):
-    global tibia_joint_values
-    # rospy.loginfo(rospy.get_caller_id() + "I heard from %s that %s", args, data.error)
-    tibia_mutex.acquire()
-    try:
-        tibia_joint_values[args] = data
-    finally:
-        tibia_mutex.release()
-
-
-def thigh_callback(data, args):
-    global thigh_joint_values
-    # rospy.loginfo(rospy.get_caller_id() + "I heard from %s that %s", args, data.error)
-    thigh_mutex.acquire()
-    try:
-        thigh_joint_values[args] = data
-    finally:
-        thigh_mutex.release()
-
-
-def make_move(target, joint_values, pub_list, mutex, rate):
-    if not rospy.is_shutdown():
-        for x in pub_list:
-            x.publish(target)
-    timeout = time.time() + TIMEOUT
-    while not rospy.is_shutdown():
-        done = True
-        mutex.acquire()
-        for key in joint_values:
-            if abs(joint_values[key].set_point - target) >= 0.05 or 0.1 < joint_values[key].error or joint_values[
-                key].error < -0.1:
-                done = False
-        mutex.release()
-        if done:
-            rospy.loginfo("finish movement...")
-            break
-        if time.time() > timeout:
-            rospy.loginfo("timeout...")
-            return False
-        rate.sleep()
-    return True
+# maximal absolute deviation of the set points from the keyframe targets and maximal absolute control error
+TOLERANCE = 0.05
+ERROR_TOLERANCE = 0.1
+# number of repetitions of a phase that timed out (from the measured positions) before the sequence is aborted
+RETRIES = 2
+JOINT_TYPES = ('c1', 'thigh', 'tibia')
+
+# Default stand-up: lift the thighs, move the tibias down and straighten the thighs.
+# The keys of the targets are either joint types (for all six legs) or single joints ('thigh_lf').
+DEFAULT_KEYFRAMES = [
+    {'name': 'move thigh up', 'targets': {'thigh': -1.0}, 'duration': 0.25},
+    {'name': 'move tibia down', 'targets': {'tibia': -1.2}, 'duration': 0.25},
+    {'name': 'straighten thigh', 'targets': {'thigh': -0.5}, 'duration': 0.25}]
+
+
+##
+#   A posture of all 18 joints that is reached by interpolating over duration seconds from the previous keyframe.
+#   Joints that are not named in the targets keep the value of the previous keyframe.
+class Keyframe:
+    def __init__(self, name, targets, duration=0.0):
+        self.name = name
+        self.targets = targets
+        self.duration = duration
+
+    # joint_names: names of the joints in the order of the joint arrays, previous: targets of the previous keyframe.
+    def joint_targets(self, joint_names, previous):
+        targets = previous.copy()
+        for key, value in self.targets.items():
+            if key in JOINT_TYPES:
+                mask = [name.startswith(key + '_') for name in joint_names]
+            elif key in joint_names:
+                mask = [name == key for name in joint_names]
+            else:
+                raise ValueError('unknown joint ' + str(key) + ' in keyframe ' + str(self.name))
+            targets[numpy.array(mask)] = value
+        return targets
+
+
+class PhaseResult:
+    def __init__(self, name, duration, timed_out):
+        self.name = name
+        self.duration = duration
+        self.timed_out = timed_out
+
+    def __str__(self):
+        return self.name + (": timeout after " if self.timed_out else ": finished after ") + str(
+                round(self.duration, 3)) + " s"
+
+
+##
+#   Runs keyframe sequences on all 18 joints of the robot. The joint states are stored in arrays that are updated
+#   by the subscriber callbacks, the convergence of a phase is checked for all joints at once and waited for on a
+#   condition that the callbacks notify. A phase that timed out is repeated up to retries times, starting from the
+#   measured positions, then the sequence is aborted.
+class StandUpSequencer:
+    def __init__(self, keyframes=None, frequency=RSTATIC.controller_frequency, tolerance=TOLERANCE,
+                 error_tolerance=ERROR_TOLERANCE, timeout=TIMEOUT, retries=RETRIES):
+        self.keyframes = [Keyframe(**keyframe) for keyframe in (keyframes or DEFAULT_KEYFRAMES)]
+        self.frequency = frequency
+        self.tolerance = tolerance
+        self.error_tolerance = error_tolerance
+        self.timeout = timeout
+        self.retries = retries
+        self.joint_names = [joint + '_' + leg for leg in RSTATIC.leg_names for joint in JOINT_TYPES]
+        self.positions = numpy.full(len(self.joint_names), numpy.nan)
+        self.set_points = numpy.full(len(self.joint_names), numpy.nan)
+        self.errors = numpy.full(len(self.joint_names), numpy.nan)
+        self.condition = Condition()
+        self.publishers = [rospy.Publisher('/phantomx/j_' + name + '_position_controller/command', Float64,
+                queue_size=1) for name in self.joint_names]
+        self.subscribers = [rospy.Subscriber('/phantomx/j_' + name + '_position_controller/state',
+                JointControllerState, self.state_callback, callback_args=index)
+                for index, name in enumerate(self.joint_names)]
+        rospy.on_shutdown(self.notify_shutdown)
+
+    def state_callback(self, data, index):
+        with self.condition:
+            self.positions[index] = data.process_value
+            self.set_points[index] = data.set_point
+            self.errors[index] = data.error
+            self.condition.notify_all()
+
+    def notify_shutdown(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def is_ready(self):
+        return not numpy.isnan(self.positions).any()
+
+    def converged(self, targets):
+        return bool(numpy.all((numpy.abs(self.set_points - targets) < self.tolerance) &
+                              (numpy.abs(self.errors) < self.error_tolerance)))
+
+    def wait_for(self, predicate, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: predicate() or rospy.is_shutdown(), timeout)
+            return predicate()
+
+    def publish(self, values):
+        for publisher, value in zip(self.publishers, values):
+            publisher.publish(value)
+
+    # Interpolate linearly from start to targets at the control rate and wait until all joints converged.
+    def run_phase(self, name, start, targets, duration):
+        phase_start = time.time()
+        rate = rospy.Rate(self.frequency)
+        steps = max(1, int(round(duration * self.frequency)))
+        for step in range(1, steps + 1):
+            if rospy.is_shutdown():
+                break
+            self.publish(start + (targets - start) * (step / steps))
+            if step < steps:
+                rate.sleep()
+        remaining = max(0.0, self.timeout - (time.time() - phase_start))
+        done = self.wait_for(lambda: self.converged(targets), remaining)
+        return PhaseResult(name, time.time() - phase_start, not done)
+
+    # Run all keyframes, starting from the measured joint positions. Returns the results of the phases.
+    def run(self):
+        if not self.wait_for(self.is_ready, self.timeout):
+            rospy.logwarn("no joint states received for " + str(
+                    [name for name, position in zip(self.joint_names, self.positions) if numpy.isnan(position)]))
+            return []
+        with self.condition:
+            previous = self.positions.copy()
+        results = []
+        for keyframe in self.keyframes:
+            if rospy.is_shutdown():
+                break
+            rospy.loginfo(keyframe.name + ":")
+            targets = keyframe.joint_targets(self.joint_names, previous)
+            result = self.run_phase(keyframe.name, previous, targets, keyframe.duration)
+            rospy.loginfo(str(result))
+            results.append(result)
+            retry = 0
+            while result.timed_out and retry < self.retries and not rospy.is_shutdown():
+                retry += 1
+                with self.condition:
+                    start = self.positions.copy()
+                result = self.run_phase(keyframe.name + " (retry " + str(retry) + ")", start, targets,
+                        keyframe.duration)
+                rospy.loginfo(str(result))
+                results.append(result)
+            if result.timed_out:
+                rospy.logerr("stand-up aborted, " + keyframe.name + " did not converge")
+                break
+            previous = targets
+        rospy.loginfo("sequence finished after " + str(round(sum(result.duration for result in results), 3)) + " s")
+        return results
 
 
 def talker():
-    finished = False
-    rate = rospy.Rate(RSTATIC.controller_frequency)
-    while not rospy.is_shutdown() and not finished:
-        finished = True
-
-        rospy.loginfo("move thigh up:")
-        if not make_move(-1.0, thigh_joint_values, thigh_pub_list, thigh_mutex, rate):
-            finished = False
-
-        rospy.loginfo("move tibia down:")
-        if not make_move(-1.2, tibia_joint_values, tibia_pub_list, tibia_mutex, rate):
-            finished = False
-
-        rospy.loginfo("straighten thigh:")
-        if not make_move(-0.5, thigh_joint_values, thigh_pub_list, thigh_mutex, rate):
-            finished = False
+    sequencer = StandUpSequencer(rospy.get_param('~keyframes', None),
+            tolerance=rospy.get_param('~tolerance', TOLERANCE),
+            error_tolerance=rospy.get_param('~error_tolerance', ERROR_TOLERANCE),
+            timeout=rospy.get_param('~timeout', TIMEOUT), retries=rospy.get_param('~retries', RETRIES))
+    sequencer.run()
 
 
 if __name__ == '__main__':
     rospy.init_node('standup_controller', anonymous=True)
-    rospy.Subscriber('/phantomx/j_thigh_lf_position_controller/state', JointControllerState, thigh_callback,
-                     callback_args="thigh_lf")
-    rospy.Subscriber('/phantomx/j_thigh_lm_position_controller/state', JointControllerState, thigh_callback,
-                     callback_args="thigh_lm")
-    rospy.Subscriber('/phantomx/j_thigh_lr_position_controller/state', JointControllerState, thigh_callback,
-                     callback_args="thigh_lr")
-    rospy.Subscriber('/phantomx/j_thigh_rf_position_controller/state', JointControllerState, thigh_callback,
-                     callback_args="thigh_rf")
-    rospy.Subscriber('/phantomx/j_thigh_rm_position_controller/state', JointControllerState, thigh_callback,
-                     callback_args="thigh_rm")
-    rospy.Subscriber('/phantomx/j_thigh_rr_position_controller/state', JointControllerState, thigh_callback,
-                     callback_args="thigh_rr")
-    rospy.Subscriber('/phantomx/j_tibia_lf_position_controller/state', JointControllerState, tibia_callback,
-                     callback_args="tibia_lf")
-    rospy.Subscriber('/phantomx/j_tibia_lm_position_controller/state', JointControllerState, tibia_callback,
-                     callback_args="tibia_lm")
-    rospy.Subscriber('/phantomx/j_tibia_lr_position_controller/state', JointControllerState, tibia_callback,
-                     callback_args="tibia_lr")
-    rospy.Subscriber('/phantomx/j_tibia_rf_position_controller/state', JointControllerState, tibia_callback,
-                     callback_args="tibia_rf")
-    rospy.Subscriber('/phantomx/j_tibia_rm_position_controller/state', JointControllerState, tibia_callback,
-                     callback_args="tibia_rm")
-    rospy.Subscriber('/phantomx/j_tibia_rr_position_controller/state', JointControllerState, tibia_callback,
-                     callback_args="tibia_rr")
-
     try:
         talker()
     except rospy.ROSInterruptException:
@@ -0,0 +1,203 @@
+import threading
+
+import numpy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+from walknet_curvewalking_project.support import log
+
+# number of samples of the arc length tables
+ARC_LENGTH_SAMPLES = 64
+ARC_LENGTH_PARAMETERS = numpy.linspace(0, 1, ARC_LENGTH_SAMPLES)
+
+
+# Points of the piecewise bezier curve (see swing_movement_bezier.bezier) at an array of parameters in [0, 1].
+def bezier_batch(points, parameters, order=2):
+    num_of_segments = (points.shape[0] - 1) // order
+    segment_numbers = numpy.clip(numpy.floor(parameters * num_of_segments), 0, num_of_segments - 1).astype(int)
+    relative_parameters = (parameters * num_of_segments - segment_numbers)[:, None, None]
+    # the bezier points of the segment of every parameter (parameters, order + 1, 3)
+    relevant_points = points[segment_numbers[:, None] * order + numpy.arange(order + 1)]
+    while relevant_points.shape[1] > 1:
+        relevant_points = relevant_points[:, :-1] + numpy.diff(relevant_points, axis=1) * relative_parameters
+    return relevant_points[:, 0]
+
+
+# Arc lengths of the curve at ARC_LENGTH_PARAMETERS, the table used by TrajectoryGenerator to estimate the parameter
+# of the next target.
+def arc_length_table(points, order=2):
+    samples = bezier_batch(points, ARC_LENGTH_PARAMETERS, order)
+    lengths = numpy.concatenate([[0.0], numpy.cumsum(numpy.linalg.norm(numpy.diff(samples, axis=0), axis=1))])
+    return lengths, ARC_LENGTH_PARAMETERS
+
+
+# Frame of a swing: the direction from the start to the target, the part of the apex direction perpendicular to it
+# and their cross product. None if the apex direction is parallel to the swing.
+def swing_frame(start_to_end_direction, apex_point_direction):
+    normal = apex_point_direction - numpy.dot(apex_point_direction, start_to_end_direction) * start_to_end_direction
+    normal_length = numpy.linalg.norm(normal)
+    if normal_length < 1e-9:
+        return None
+    normal = normal / normal_length
+    # the cross product (numpy.cross is slow for single vectors)
+    binormal = start_to_end_direction[[1, 2, 0]] * normal[[2, 0, 1]] - \
+        start_to_end_direction[[2, 0, 1]] * normal[[1, 2, 0]]
+    return numpy.array([start_to_end_direction, normal, binormal]).T
+
+
+# step of the finite differences of the template derivatives
+DERIVATIVE_STEP = 1e-6
+# index of the tilt in the parameters of a template and step of the finite differences of the second derivative
+TILT = 4
+CURVATURE_STEP = 1e-3
+
+
+# Template of an evasion curve: bezier points and arc lengths at the parameters of the template and their derivatives
+# with respect to the parameters (length of the swing, collision ratio, collision height, lateral offset of the
+# collision and tilt of the apex direction). The derivatives of the points are stored as (parameters, points * 3).
+# The curves depend strongly nonlinearly on the tilt (mainly in the retraction case), so the second derivatives with
+# respect to the tilt are stored as well.
+class EvasionTemplate:
+    def __init__(self, case, points, lengths, points_derivatives, lengths_derivatives, points_tilt_curvature,
+                 lengths_tilt_curvature):
+        self.case = case
+        self.points = points
+        self.lengths = lengths
+        self.points_derivatives = points_derivatives
+        self.lengths_derivatives = lengths_derivatives
+        self.points_tilt_curvature = points_tilt_curvature
+        self.lengths_tilt_curvature = lengths_tilt_curvature
+
+
+##
+#   Collision evasion curves of SwingMovementBezier, precomputed for a grid of collision ratios (where between the
+#   start and the target of the swing the collision happened, 0..1) and heights (distance of the collision point from
+#   the line from the start to the target in the direction of the apex, 0..evasion_template_max_height) of a swing of
+#   the nominal length. The templates are computed at the centers of the grid cells with
+#   compute_bezier_points_between, in the frame of the swing (see swing_frame), together with their arc length tables
+#   and the derivatives of both with respect to the parameters of the evasion (see EvasionTemplate). The boundaries of
+#   the evasion cases at the apex and at the end of the swing are edges of the grid cells.
+#   lookup evaluates the template of the cell of the collision to first order in the deviation of the parameters and
+#   transforms it from the frame of the swing to body coordinates, an affine map of the precomputed points.
+class EvasionTemplates:
+    def __init__(self, movement, swing_distance):
+        self.movement = movement
+        self.swing_distance = swing_distance
+        self.apex_point_direction = movement.apex_point_offset / numpy.linalg.norm(movement.apex_point_offset)
+        # direction of the nominal swing, perpendicular to the apex direction
+        self.swing_direction = swing_frame(self.apex_point_direction, numpy.array([1.0, 0, 0]))[:, 1]
+        self.ratio_step = 1.0 / RSTATIC.evasion_template_ratios
+        self.height_step = RSTATIC.evasion_template_max_height / RSTATIC.evasion_template_heights
+        self.templates = [[self.create_template((ratio_nr + 0.5) * self.ratio_step,
+                                                (height_nr + 0.5) * self.height_step)
+                           for height_nr in range(RSTATIC.evasion_template_heights)]
+                          for ratio_nr in range(RSTATIC.evasion_template_ratios)]
+
+    # Bezier points in the frame of the swing and arc lengths of the evasion curve of the parameters (length of the
+    # swing, collision ratio, height, lateral offset and tilt, the component of the apex direction along the swing).
+    def evaluate(self, parameters):
+        swing_distance, ratio, height, lateral, tilt = parameters
+        direction = numpy.sqrt(1 - tilt ** 2) * self.swing_direction + tilt * self.apex_point_direction
+        frame = swing_frame(direction, self.apex_point_direction)
+        target_point = swing_distance * direction
+        collision_point = ratio * target_point + height * frame[:, 1] + lateral * frame[:, 2]
+        points = self.movement.compute_bezier_points_between(numpy.zeros(3), target_point, collision_point)
+        return points.dot(frame), arc_length_table(points)[0]
+
+    def create_template(self, ratio, height):
+        parameters = numpy.array([self.swing_distance, ratio, height, 0, 0])
+        case = self.movement.evasion_case(ratio, height)
+        points, lengths = self.evaluate(parameters)
+        points_derivatives = numpy.zeros((len(parameters),) + points.shape)
+        lengths_derivatives = numpy.zeros((len(parameters), len(lengths)))
+        for parameter_nr in range(len(parameters)):
+            step = numpy.zeros(len(parameters))
+            step[parameter_nr] = DERIVATIVE_STEP
+            # central differences, one sided at the boundaries of the evasion cases
+            steps = [sign * step for sign in (1, -1) if
+                     self.movement.evasion_case((parameters + sign * step)[1],
+                                                numpy.hypot(*(parameters + sign * step)[2:4])) == case]
+            differences = [self.evaluate(parameters + step) for step in steps]
+            points_derivatives[parameter_nr] = sum((difference[0] - points) / step[parameter_nr]
+                                                   for difference, step in zip(differences, steps)) / len(steps)
+            lengths_derivatives[parameter_nr] = sum((difference[1] - lengths) / step[parameter_nr]
+                                                    for difference, step in zip(differences, steps)) / len(steps)
+        # the evasion case does not depend on the tilt
+        step = numpy.zeros(len(parameters))
+        step[TILT] = CURVATURE_STEP
+        (points_plus, lengths_plus), (points_minus, lengths_minus) = self.evaluate(parameters + step), \
+            self.evaluate(parameters - step)
+        return EvasionTemplate(case, points, lengths, points_derivatives.reshape(len(parameters), -1),
+                               lengths_derivatives, (points_plus - 2 * points + points_minus) / CURVATURE_STEP ** 2,
+                               (lengths_plus - 2 * lengths + lengths_minus) / CURVATURE_STEP ** 2)
+
+    # Evasion curve (bezier points) and its arc length table for a collision at the collision point during the swing
+    # from the start point to the target point. None if the swing is not covered by the templates: the collision is
+    # outside of the grid, the evasion case differs from the one of the template (at the boundaries of the cases in
+    # the height), the length of the swing differs by more than evasion_template_tolerance from the nominal length
+    # (relative) or the component of the apex direction along the swing exceeds evasion_template_max_tilt.
+    def lookup(self, start_point, target_point, collision_point):
+        start_to_end_vector = target_point - start_point
+        start_to_end_distance = numpy.linalg.norm(start_to_end_vector)
+        start_to_end_direction = start_to_end_vector / start_to_end_distance
+        tilt = numpy.dot(self.apex_point_direction, start_to_end_direction)
+        if abs(start_to_end_distance / self.swing_distance - 1) > RSTATIC.evasion_template_tolerance or \
+                abs(tilt) > RSTATIC.evasion_template_max_tilt:
+            return None
+        frame = swing_frame(start_to_end_direction, self.apex_point_direction)
+        distance, height, lateral = (collision_point - start_point).dot(frame)
+        ratio = distance / start_to_end_distance
+        ratio_nr = int(numpy.floor(ratio / self.ratio_step))
+        height_nr = int(numpy.floor(height / self.height_step))
+        if not (0 <= ratio_nr < len(self.templates) and 0 <= height_nr < len(self.templates[0])):
+            return None
+        template = self.templates[ratio_nr][height_nr]
+        if self.movement.evasion_case(ratio, numpy.hypot(height, lateral)) != template.case:
+            return None
+        deviation = numpy.array([start_to_end_distance - self.swing_distance, ratio - (ratio_nr + 0.5) *
+                                 self.ratio_step, height - (height_nr + 0.5) * self.height_step, lateral, tilt])
+        points = start_point + (template.points + deviation.dot(template.points_derivatives).reshape(-1, 3) +
+                                0.5 * tilt ** 2 * template.points_tilt_curvature).dot(frame.T)
+        lengths = numpy.maximum.accumulate(template.lengths + deviation.dot(template.lengths_derivatives) +
+                                           0.5 * tilt ** 2 * template.lengths_tilt_curvature)
+        return points, (lengths, ARC_LENGTH_PARAMETERS)
+
+
+# templates shared by the swing movements of all legs with the same evasion parameters and the keys of the templates
+# that are being built
+TEMPLATES = {}
+BUILDING = set()
+templates_lock = threading.Lock()
+
+
+def template_key(movement):
+    return (RSTATIC.default_stance_distance, tuple(movement.apex_point_offset), movement.apex_point_ratio,
+            movement.evasion_distance, movement.retraction_distance, movement.max_evasion_distance,
+            RSTATIC.evasion_template_ratios, RSTATIC.evasion_template_heights, RSTATIC.evasion_template_max_height)
+
+
+# The templates for the evasion parameters of the movement and a swing of the default stance distance, None if they
+# are not available yet. Missing templates are built in a background thread when build is set (a few tenths of a
+# second), so a swing movement can be created in a control tick; until they are ready the curves are computed.
+def evasion_templates(movement, build=True):
+    key = template_key(movement)
+    with templates_lock:
+        if key in TEMPLATES or not build or key in BUILDING:
+            return TEMPLATES.get(key)
+        BUILDING.add(key)
+    threading.Thread(target=build_evasion_templates, args=(movement, key), name='evasion_templates',
+                     daemon=True).start()
+    return None
+
+
+def build_evasion_templates(movement, key):
+    try:
+        templates = EvasionTemplates(movement, RSTATIC.default_stance_distance)
+        with templates_lock:
+            # the settings may have changed during the build
+            if template_key(movement) == key:
+                TEMPLATES[key] = templates
+    except Exception as e:
+        log.logerr("building the evasion templates failed: " + str(e))
+    finally:
+        with templates_lock:
+            BUILDING.discard(key)
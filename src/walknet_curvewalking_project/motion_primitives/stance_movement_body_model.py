@@ -7,6 +7,8 @@ import rospy
 
 import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
 import numpy
+from walknet_curvewalking_project.motion_primitives.streaming import StreamingPrimitive
+from walknet_curvewalking_project.support.latency import INVERSE_KINEMATICS
 
 
 ##
@@ -31,53 +33,90 @@ import numpy
 # It implements the required modulatedRoutineFunctionCall -
 # as a consequence a movement can be connected to a MotivationUnit which
 # (when active) always executes the connected modulatedRoutineFunctionCall.
+#
+# The stance is a stream of joint commands (see StreamingPrimitive) that starts
+# with putting the leg on the ground in the body model and runs until it is
+# stopped (reset_stance_trajectory) at the PEP.
 ##
-class StanceMovementBodyModel():
+class StanceMovementBodyModel(StreamingPrimitive):
 
     ##	Initialisation of the Stance Movement. Connecting to the bodyModelStance and
     #	setting the inverseKinematic_provider.
     #	@param motiv_leg Motivation network of the leg
     #	@param extr_pos extreme positions of the stance movement (also encoding direction)
     def __init__(self, leg):
+        StreamingPrimitive.__init__(self, leg.leg)
         self.leg_controller = leg
-        self.init_stance_footpoint = False
         self.bodyModelStance = self.leg_controller.robot.body_model
         self.inverseKinematic_provider = self.leg_controller.leg
+        # angles of the last stance command, start of the differential inverse kinematics
+        self.stance_angles = None
+        # (start angles, next angles, distance) of a differential step that was computed together with the other
+        # legs (see RobotController.update_stance_angles)
+        self.batched_step = None
 
     def __del__(self):
         pass
 
     def reset_stance_trajectory(self):
-        self.init_stance_footpoint = False
+        self.stop()
+        self.stance_angles = None
+
+    ##	Target of the leg in body coordinates given by the leg vector of the body model.
+    def stance_target(self):
+        target_vec = self.leg_controller.leg.apply_c1_static_transform()[0:3] + self.bodyModelStance.get_leg_vector(
+            self.leg_controller.leg.name)[0:3]
+        return self.leg_controller.leg.clamp_to_workspace(target_vec)
+
+    ##	Joint angles for the target of the leg vector. In the differential mode (RSTATIC.stance_ik_mode) the
+    #	angles are moved from the last stance angles by one step of the leg Jacobian, the full inverse kinematics
+    #	is only computed to synchronize with the target.
+    def compute_stance_angles(self):
+        if RSTATIC.stance_ik_mode == 'differential' and self.stance_angles is not None:
+            step, self.batched_step = self.batched_step, None
+            if step is not None and step[0] is self.stance_angles:
+                next_angles, distance = step[1], step[2]
+            else:
+                next_angles, distance = self.inverseKinematic_provider.compute_differential_inverse_kinematics(
+                        self.stance_angles, self.stance_target())
+            if distance <= RSTATIC.stance_resync_distance:
+                self.stance_angles = next_angles
+                return next_angles
+        next_angles = self.inverseKinematic_provider.compute_inverse_kinematics(self.stance_target())
+        self.stance_angles = next_angles
+        return next_angles
+
+    ##	Joint commands of the stance, one per call of modulated_routine_function_call.
+    def commands(self):
+        # stance_foot_pos = self.leg_controller.leg.ee_position()
+        # if (stance_foot_pos[0] <= self.leg_controller.pep_shifted[0]):
+        #     print("Stance correction: foot moved in Body Model in front of PEP ",
+        #         self.leg_controller.wleg.leg.name)
+        #     stance_foot_pos[0] = self.leg_controller.pep_shifted[0] + 0.02
+        # self.bodyModelStance.put_leg_on_ground(self.leg_controller.name, self.leg_controller.leg.compute_forward_kinematics_c1()[0:3])  #self.leg_controller.leg.ee_position())
+        self.bodyModelStance.put_leg_on_ground(self.leg_controller.name,
+            self.leg_controller.leg.ee_position()[0:3] - self.leg_controller.leg.apply_c1_static_transform()[0:3])
+        while True:
+            try:
+                next_angles = self.compute_stance_angles()
+                if self.inverseKinematic_provider.latency_tracer is not None:
+                    self.inverseKinematic_provider.latency_tracer.trace(INVERSE_KINEMATICS)
+                self.inverseKinematic_provider.ik_command = True
+            except ValueError:
+                self.stance_angles = None
+                rospy.logerr("ValueError in " + str(self.leg_controller.leg.name) +
+                             " during inverse kinematics computation.\n Tried to reach position " +
+                             str(self.bodyModelStance.get_leg_vector(self.leg_controller.leg.name)) +
+                             "\ncurrent position is: " + str(self.leg_controller.leg.ee_position()) +
+                             "\ncurrent angles are: " + str(self.leg_controller.leg.get_current_angles()) +
+                             "\nMaintaining current angles.")
+                next_angles = self.leg_controller.leg.get_current_angles()
+                self.inverseKinematic_provider.ik_command = False
+                self.bodyModelStance.report_ik_failure(RSTATIC.leg_names.index(self.leg_controller.name))
+            yield next_angles
 
     ##	Function called by the ModulatingMotivationUnit when active.
     #	Invokes the execution of the routine which has to be defined by the derived
     #	classes.
     def modulated_routine_function_call(self):
-        if not self.init_stance_footpoint:
-            # stance_foot_pos = self.leg_controller.leg.ee_position()
-            # if (stance_foot_pos[0] <= self.leg_controller.pep_shifted[0]):
-            #     print("Stance correction: foot moved in Body Model in front of PEP ",
-            #         self.leg_controller.wleg.leg.name)
-            #     stance_foot_pos[0] = self.leg_controller.pep_shifted[0] + 0.02
-            # self.bodyModelStance.put_leg_on_ground(self.leg_controller.name, self.leg_controller.leg.compute_forward_kinematics_c1()[0:3])  #self.leg_controller.leg.ee_position())
-            self.bodyModelStance.put_leg_on_ground(self.leg_controller.name,
-                self.leg_controller.leg.ee_position()[0:3] - self.leg_controller.leg.apply_c1_static_transform()[0:3])
-            self.init_stance_footpoint = True
-        try:
-            target_vec = self.leg_controller.leg.apply_c1_static_transform()[0:3] + self.bodyModelStance.get_leg_vector(
-                self.leg_controller.leg.name)[0:3]
-            next_angles = self.inverseKinematic_provider.compute_inverse_kinematics(target_vec)
-            self.leg_controller.leg.set_command(next_angles)
-        except ValueError:
-            rospy.logerr("ValueError in " + str(self.leg_controller.leg.name) +
-                         " during inverse kinematics computation.\n Tried to reach position " +
-                         str(self.bodyModelStance.get_leg_vector(self.leg_controller.leg.name)) +
-                         "\ncurrent position is: " + str(self.leg_controller.leg.ee_position()) +
-                         "\ncurrent angles are: " + str(self.leg_controller.leg.get_current_angles()) +
-                         "\nMaintaining current angles.")
-            self.leg_controller.leg.set_command(self.leg_controller.leg.get_current_angles())
-
-        # current_angles = numpy.array(self.leg_controller.leg.ee_position())
-        # new_joint_velocities = (next_angles - current_angles.T) / (1 / RSTATIC.controller_frequency)
-        # self.leg_controller.wleg.addControlVelocities(new_joint_velocities)
+        self.step()
@@ -1,44 +1,99 @@
+from math import ceil
+
+import numpy
 import rospy
 
+import walknet_curvewalking_project.support.constants as CONST
+from walknet_curvewalking_project.motion_primitives.streaming import InverseKinematicsStage, Pipeline, \
+    StreamingPrimitive, sample_line
+
 
-class StanceMovementSimple:
+##
+#   Straight stance movement from the start point to the target point with a constant speed of the end effector.
+#   The trajectory is planned once when the stance starts: the line is sampled with the distance the foot moves in
+#   one control tick and all samples are converted to joint angles with one batched inverse kinematics call (the
+#   pipeline of the samples and the inverse kinematics is evaluated in bulk). Every stance tick only sends the next
+#   sample. The stance is finished after the last sample was sent.
+class StanceMovementSimple(StreamingPrimitive):
 
     def __init__(self, leg):
-        self.leg = leg
+        StreamingPrimitive.__init__(self, leg)
         self.start_point = None
         self.target_point = None
-        self.finished_Stance = False
+        # speed of the end effector (m/s), CONST.DEFAULT_STANCE_VELOCITY if not set
+        self.stance_velocity = None
+        self.trajectory = None
 
     def set_start_point(self, start_point):
         self.start_point = start_point
+        self.reset_trajectory()
         rospy.loginfo('in set stance start_point: ' + str(self.start_point))
 
     def set_target_point(self, target_point):
         self.target_point = target_point
+        self.reset_trajectory()
         rospy.loginfo('in set stance target_point: ' + str(self.target_point))
 
-    def is_finished(self):
-        return self.finished_Stance
+    def set_velocity(self, stance_velocity):
+        self.stance_velocity = stance_velocity
+        self.reset_trajectory()
+
+    def reset_trajectory(self):
+        self.stop()
+        self.trajectory = None
+
+    # Joint angles of the points of the straight line from the start to the target point, one point per command of
+    # the leg (see SingleLeg.command_frequency). If a point is not reachable, the trajectory ends with the last
+    # reachable point before it (the current angles if the first point is not reachable).
+    def plan_stance(self):
+        start_point = numpy.array(self.start_point[0:3], dtype=float)
+        target_point = numpy.array(self.target_point[0:3], dtype=float)
+        velocity = self.stance_velocity if self.stance_velocity is not None else CONST.DEFAULT_STANCE_VELOCITY
+        step = velocity / self.leg.command_frequency()
+        samples = max(1, int(ceil(numpy.linalg.norm(target_point - start_point) / step)))
+        pipeline = Pipeline(sample_line(start_point, target_point, samples), InverseKinematicsStage(self.leg))
+        try:
+            self.trajectory = pipeline.evaluate()
+        except ValueError as error:
+            self.trajectory = self.reachable_trajectory(pipeline)
+            rospy.logerr("ValueError in " + str(self.leg.name) + " during inverse kinematics computation of the "
+                         "stance trajectory: " + str(error) + "\nThe stance ends after " + str(len(self.trajectory)) +
+                         " of " + str(samples) + " points.")
+        rospy.loginfo('planned stance trajectory with ' + str(len(self.trajectory)) + ' points')
+
+    # The joint angles of the points of the pipeline up to the first point that is not reachable, the current angles
+    # if there is none.
+    def reachable_trajectory(self, pipeline):
+        trajectory = []
+        try:
+            for angles in pipeline:
+                trajectory.append(angles)
+        except ValueError:
+            pass
+        if not trajectory:
+            trajectory.append(self.leg.get_current_angles())
+        return trajectory
+
+    def commands(self):
+        if self.trajectory is None:
+            if self.start_point is None:
+                self.start_point = self.leg.ee_position()
+            self.plan_stance()
+        for index, next_angles in enumerate(self.trajectory, 1):
+            # the stance is finished with the command of the last sample, not one tick later
+            if index == len(self.trajectory):
+                self.finished = True
+                rospy.loginfo("finished stance trajectory")
+            yield next_angles
 
     def stance(self):
         if not self.leg.is_ready():
             rospy.loginfo("haven't received Joint values yet! skipp")
             return
-        if self.check_if_current_target_is_reached():
-            self.finished_Stance = True
-            rospy.loginfo("finished stance trajectory")
-            return
-        else:
-            self.finished_Stance = False
-        next_angles = self.leg.compute_inverse_kinematics(self.target_point)
-        rospy.loginfo('angles to reach current target: ' + str(next_angles))
-        self.leg.set_command(next_angles)
-        rospy.loginfo('set_angles: ' + str(next_angles))
+        self.step()
 
     def check_if_current_target_is_reached(self):
         cur_target = self.target_point
         cur_ee = self.leg.ee_position()
-        rospy.loginfo('cur_target is ' + str(cur_target) + ' cur_ee is ' + str(cur_ee))
-        if abs(cur_target[0] - cur_ee[0]) < 0.02 and abs(cur_target[1] - cur_ee[1]) < 0.02 and abs(
-                cur_target[2] - cur_ee[2]) < 0.02:
-            return True
+        return abs(cur_target[0] - cur_ee[0]) < 0.02 and abs(cur_target[1] - cur_ee[1]) < 0.02 and abs(
+                cur_target[2] - cur_ee[2]) < 0.02
@@ -0,0 +1,159 @@
+import itertools
+
+import numpy
+
+
+##
+#   A stage of a pipeline: maps one value per tick (step) or the values of many ticks at once (bulk, e.g. when a
+#   movement is planned ahead or evaluated offline). The default bulk applies step to every value.
+class Stage:
+    def step(self, value):
+        return value
+
+    def bulk(self, values):
+        return numpy.array([self.step(value) for value in values])
+
+
+# Joint angles of end effector positions in body coordinates, with the batched inverse kinematics in bulk. Raises a
+# ValueError for unreachable positions.
+class InverseKinematicsStage(Stage):
+    def __init__(self, leg):
+        self.leg = leg
+
+    def step(self, value):
+        return self.leg.compute_inverse_kinematics(value)
+
+    def bulk(self, values):
+        return self.leg.compute_inverse_kinematics_batch(values)
+
+
+# Clip joint angles to the joint limits ((3, 2) array of minimum and maximum) when clip is set.
+class JointLimitStage(Stage):
+    def __init__(self, limits, clip=True):
+        self.limits = numpy.asarray(limits, dtype=float)
+        self.clip = clip
+
+    def step(self, value):
+        return self.bulk(value)
+
+    def bulk(self, values):
+        if not self.clip:
+            return values
+        return numpy.clip(values, self.limits[:, 0], self.limits[:, 1])
+
+
+##
+#   Samples of function(t) at the control ticks first_tick, first_tick + 1, ... (t = tick / frequency). Iterating
+#   gives one sample per tick without end, bulk(count) evaluates function once for the next count ticks.
+class TickSamples:
+    def __init__(self, function, frequency, first_tick=1):
+        self.function = function
+        self.frequency = frequency
+        self.first_tick = first_tick
+
+    def __iter__(self):
+        for tick in itertools.count(self.first_tick):
+            yield self.function(tick / self.frequency)
+
+    def bulk(self, count):
+        return self.function(numpy.arange(self.first_tick, self.first_tick + count) / self.frequency)
+
+
+# count points of the straight line from start to target (without the start, with the target).
+def sample_line(start, target, count):
+    start = numpy.asarray(start, dtype=float)
+    target = numpy.asarray(target, dtype=float)
+    return start + numpy.outer(numpy.linspace(1.0 / count, 1.0, count), target - start)
+
+
+##
+#   A source of values (an iterable, an array or TickSamples) followed by stages, e.g. the samples of a planned
+#   trajectory -> inverse kinematics -> joint limits. Iterating the pipeline evaluates the stages tick by tick,
+#   evaluate computes the values of count ticks (or of the whole finite source) with the bulk functions of the stages.
+class Pipeline:
+    def __init__(self, source, *stages):
+        self.source = source
+        self.stages = stages
+
+    def __iter__(self):
+        for value in self.source:
+            for stage in self.stages:
+                value = stage.step(value)
+            yield value
+
+    def evaluate(self, count=None):
+        if hasattr(self.source, 'bulk'):
+            values = self.source.bulk(count)
+        elif isinstance(self.source, numpy.ndarray):
+            values = self.source[:count]
+        else:
+            values = numpy.array(list(itertools.islice(self.source, count)))
+        for stage in self.stages:
+            values = stage.bulk(values)
+        return values
+
+
+# returned by StreamingPrimitive.next_command when the movement is finished
+END_OF_MOVEMENT = object()
+
+
+##
+#   Common interface of the motion primitives: a movement is a generator (commands, implemented by the primitives)
+#   that yields one joint command per control tick and ends when the movement is finished (swing movements end by
+#   stop, e.g. at ground contact). A command of None (e.g. no joint state after a failed inverse kinematics) sends
+#   nothing in this tick, the movement continues.
+#   step sends the next command of the running movement and starts the movement if none is running. After the
+#   generator ended the primitive is finished until it is stopped (reset). The state of a movement lives in its
+#   generator, stop closes it (the finally blocks of the generators clean up).
+class StreamingPrimitive:
+    def __init__(self, leg):
+        self.leg = leg
+        self.stream = None
+        self.finished = False
+        self.last_activation = 0
+
+    def start(self):
+        self.stop()
+        self.stream = self.commands()
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.finished = False
+
+    def is_active(self):
+        return self.stream is not None
+
+    def is_finished(self):
+        return self.finished
+
+    # The next command of the movement, END_OF_MOVEMENT once the movement is finished.
+    def next_command(self):
+        if self.finished:
+            return END_OF_MOVEMENT
+        if self.stream is None:
+            self.stream = self.commands()
+        command = next(self.stream, END_OF_MOVEMENT)
+        if command is END_OF_MOVEMENT:
+            self.stream = None
+            self.finished = True
+        return command
+
+    # Send the next command of the movement to the leg. Returns False if the movement is finished.
+    def step(self):
+        command = self.next_command()
+        if command is END_OF_MOVEMENT:
+            return False
+        if command is not None:
+            self.leg.set_command(command)
+        return True
+
+    # Activation interface of the Walknet movements: the movement runs while the activation is at least 0.5 and is
+    # stopped when the activation drops.
+    def move_to_next_point(self, activation):
+        if activation >= 0.5:
+            self.step()
+        elif self.last_activation >= 0.5:
+            self.stop()
+        self.last_activation = activation
@@ -8,6 +8,8 @@ import rospy
 
 import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
 import walknet_curvewalking_project.support.constants as CONST
+from walknet_curvewalking_project.motion_primitives.evasion_templates import arc_length_table, evasion_templates
+from walknet_curvewalking_project.motion_primitives.streaming import StreamingPrimitive
 
 
 # Function that computes a point that lies on a bezier curve
@@ -56,6 +58,9 @@ class TrajectoryGenerator:
         self.norm_delta_parameter = None
         self.bezier_points = None  # The points that are used for the piecewise bezier
         self.order = 2  # the order to the bezier curve
+        # (arc lengths, parameters) of the bezier curve, if known the parameter of the next target is estimated from
+        # it instead of from the parameter step of the last iteration
+        self.arc_length_table = None
 
         # self.frozen = True
 
@@ -63,6 +68,16 @@ class TrajectoryGenerator:
         self.last_target_position = None
         self.last_target_parameter = None
 
+    # Parameter step for the desired_distance along the curve from the last target, looked up in the arc length table.
+    # The default is kept at the end of the curve.
+    def estimate_delta_parameter(self, desired_distance, default):
+        lengths, parameters = self.arc_length_table
+        length = numpy.interp(self.last_target_parameter, parameters, lengths) + desired_distance
+        if length > lengths[-1]:
+            return default
+        delta_parameter = numpy.interp(length, lengths, parameters) - self.last_target_parameter
+        return delta_parameter if delta_parameter > 0 else default
+
     # Method to compute the next goal position along the curve that has a certain distance from the current position.
     # In a first attempt, the function tries to find a point on the curve by iteratively increasing/decreasing the
     # value of delta_parameter.
@@ -99,6 +114,8 @@ class TrajectoryGenerator:
             del delta_position
         # Try to adapt the delta_parameter to the desired_distance
         delta_parameter = self.norm_delta_parameter * desired_distance
+        if self.arc_length_table is not None:
+            delta_parameter = self.estimate_delta_parameter(desired_distance, delta_parameter)
         parameter_position_list = [(self.last_target_parameter, self.last_target_position)]
         slightly_further_parameter = None
         slightly_closer_parameter = None
@@ -197,11 +214,26 @@ class TrajectoryGenerator:
         return self.last_target_position
 
 
-class SwingMovementBezier:
+# The evasion movements after a collision (see SwingMovementBezier.evasion_case): before the apex below or above the
+# apex point (limited to the max_evasion_distance), after the apex (limited to the max_evasion_distance) and a
+# retraction near the end of the swing.
+BELOW_APEX = 'below_apex'
+ABOVE_APEX = 'above_apex'
+ABOVE_APEX_LIMITED = 'above_apex_limited'
+AFTER_APEX = 'after_apex'
+AFTER_APEX_LIMITED = 'after_apex_limited'
+RETRACTION = 'retraction'
+
+
+##
+#   Swing movement along a piecewise bezier curve. The movement is a stream of joint commands (see
+#   StreamingPrimitive): every tick the next target on the curve is computed from the current position of the foot
+#   (feedback), clamped to the workspace and converted to joint angles. The stream runs until it is stopped at the
+#   ground contact.
+class SwingMovementBezier(StreamingPrimitive):
     def __init__(self, leg=None):
-        self.leg = leg
+        StreamingPrimitive.__init__(self, leg)
         self.trajectory_generator = TrajectoryGenerator()
-        self.last_activation = 0
         self.swing_velocity = CONST.DEFAULT_SWING_VELOCITY
 
         self.swing_start_point = None  # the point where the swing phase starts
@@ -217,39 +249,73 @@ class SwingMovementBezier:
         self.retraction_distance = 0.10
         self.max_evasion_distance = 0.25
         # self.frozen = True
+        if RSTATIC.evasion_templates:
+            evasion_templates(self)
 
+    # Switch to the evasion curve of a collision at the current position. The curve is looked up in the precomputed
+    # evasion templates (see evasion_templates.py) and only computed if the swing is not covered by them.
     def notify_of_collision(self, weight=1):
         if weight >= 1:
             self.collision_point = self.leg.ee_position()
-            rospy.loginfo("in notify_of_collision: calculate bezier points based on positions!")
-            bezier_points = self.compute_bezier_points()
+            evasion = None
+            if RSTATIC.evasion_templates:
+                templates = evasion_templates(self, build=False)
+                if templates is not None:
+                    evasion = templates.lookup(self.swing_start_point[0:3], self.swing_target_point[0:3],
+                                               self.collision_point)
+            if evasion is None:
+                rospy.loginfo("in notify_of_collision: calculate bezier points based on positions!")
+                bezier_points = self.compute_bezier_points()
+                evasion = bezier_points, arc_length_table(bezier_points)
             self.trajectory_generator.reset()
-            self.trajectory_generator.bezier_points = bezier_points
+            self.trajectory_generator.bezier_points, self.trajectory_generator.arc_length_table = evasion
+
+    # The kind of evasion movement for a collision at the collision ratio and the distance from the line from the start
+    # to the target of the swing.
+    def evasion_case(self, collision_ratio, distance):
+        if collision_ratio < self.apex_point_ratio:
+            if distance + self.evasion_distance < numpy.linalg.norm(self.apex_point_offset):
+                return BELOW_APEX
+            if distance + self.evasion_distance > self.max_evasion_distance:
+                return ABOVE_APEX_LIMITED
+            return ABOVE_APEX
+        if collision_ratio > 0.9:
+            return RETRACTION
+        if distance + self.evasion_distance > self.max_evasion_distance:
+            return AFTER_APEX_LIMITED
+        return AFTER_APEX
 
     def compute_bezier_points(self):  # ForNormalSwingMovement(self):
-        #rospy.loginfo("target = " + str(self.swing_target_point) + " start = " + str(self.swing_start_point))
-        start_to_end_vector = self.swing_target_point - self.swing_start_point
+        return self.compute_bezier_points_between(self.swing_start_point, self.swing_target_point,
+            self.collision_point)
+
+    # Bezier points of the swing from the start point to the target point, of the evasion movement if a collision
+    # happened at the collision point (None if no collision happened).
+    def compute_bezier_points_between(self, start_point, target_point, collision_point):
+        #rospy.loginfo("target = " + str(target_point) + " start = " + str(start_point))
+        start_to_end_vector = target_point - start_point
         start_to_end_distance = numpy.linalg.norm(start_to_end_vector)
         start_to_end_direction = start_to_end_vector / start_to_end_distance
         apex_point_distance = numpy.linalg.norm(self.apex_point_offset)
-        apex_point = self.swing_start_point + self.apex_point_ratio * start_to_end_vector + self.apex_point_offset
+        apex_point = start_point + self.apex_point_ratio * start_to_end_vector + self.apex_point_offset
         apex_point_direction = self.apex_point_offset / apex_point_distance
-        if self.collision_point is None:  # if no collision happened
+        if collision_point is None:  # if no collision happened
             control_point_1 = apex_point - 0.5 * self.apex_point_ratio * start_to_end_vector
             control_point_2 = apex_point + 0.5 * (1 - self.apex_point_ratio) * start_to_end_vector
             return numpy.array(
-                [self.swing_start_point, control_point_1, apex_point, control_point_2, self.swing_target_point])
+                [start_point, control_point_1, apex_point, control_point_2, target_point])
         else:  # in case of a collision
-            collision_ratio = numpy.dot((self.collision_point - self.swing_start_point),
+            collision_ratio = numpy.dot((collision_point - start_point),
                 start_to_end_direction) / start_to_end_distance  # where during the swing
             # phase the collision happened
             start_to_end_vector_to_collision_point_distance = numpy.linalg.norm(
-                (self.collision_point - self.swing_start_point) - collision_ratio * start_to_end_vector)
-            control_point_1 = self.collision_point - self.retraction_distance * start_to_end_direction
-            evasion_point = self.collision_point + self.evasion_distance * apex_point_direction
-            if collision_ratio < self.apex_point_ratio:  # the collision happened before the leg reached the apex
-                if start_to_end_vector_to_collision_point_distance + self.evasion_distance < apex_point_distance:  #
-                    # the evasion movement will be below the apex point
+                (collision_point - start_point) - collision_ratio * start_to_end_vector)
+            control_point_1 = collision_point - self.retraction_distance * start_to_end_direction
+            evasion_point = collision_point + self.evasion_distance * apex_point_direction
+            case = self.evasion_case(collision_ratio, start_to_end_vector_to_collision_point_distance)
+            if case in (BELOW_APEX, ABOVE_APEX, ABOVE_APEX_LIMITED):  # the collision happened before the leg reached
+                # the apex
+                if case == BELOW_APEX:  # the evasion movement will be below the apex point
                     evasion_to_apex_vector = apex_point - evasion_point
                     control_point_3 = apex_point - numpy.dot(0.5 * evasion_to_apex_vector,
                         start_to_end_direction) * start_to_end_direction
@@ -264,14 +330,13 @@ class SwingMovementBezier:
                     retraction_point = 0.5 * (control_point_2 - control_point_1) + control_point_1
                     control_point_4 = apex_point + 0.5 * self.apex_point_ratio * start_to_end_vector
                     return numpy.array(
-                        [self.collision_point, control_point_1, retraction_point, control_point_2, evasion_point,
-                            control_point_3, apex_point, control_point_4, self.swing_target_point])
+                        [collision_point, control_point_1, retraction_point, control_point_2, evasion_point,
+                            control_point_3, apex_point, control_point_4, target_point])
                 else:  # the evasion movement will be above the standard apex point
-                    if start_to_end_vector_to_collision_point_distance + self.evasion_distance > \
-                            self.max_evasion_distance:
-                        evasion_point = self.swing_start_point + collision_ratio * start_to_end_vector + \
+                    if case == ABOVE_APEX_LIMITED:
+                        evasion_point = start_point + collision_ratio * start_to_end_vector + \
                                         self.max_evasion_distance * apex_point_direction
-                        apex_point = self.swing_start_point + self.apex_point_ratio * start_to_end_vector + \
+                        apex_point = start_point + self.apex_point_ratio * start_to_end_vector + \
                                      self.max_evasion_distance * apex_point_direction
 
                     else:
@@ -281,27 +346,27 @@ class SwingMovementBezier:
                     retraction_point = 0.5 * (control_point_2 - control_point_1) + control_point_1
                     control_point_4 = apex_point + 0.5 * (1 - self.apex_point_ratio) * start_to_end_vector
                     return numpy.array(
-                        [self.collision_point, control_point_1, retraction_point, control_point_2, evasion_point,
-                            control_point_3, apex_point, control_point_4, self.swing_target_point])
+                        [collision_point, control_point_1, retraction_point, control_point_2, evasion_point,
+                            control_point_3, apex_point, control_point_4, target_point])
             else:  # the collision happened after the leg reached the apex
-                if collision_ratio > 0.9:
-                    return numpy.array([self.collision_point, self.collision_point - apex_point_direction / 2,
-                        self.collision_point - apex_point_direction])
-                if start_to_end_vector_to_collision_point_distance + self.evasion_distance > self.max_evasion_distance:
-                    evasion_point = self.swing_start_point + collision_ratio * start_to_end_vector + \
+                if case == RETRACTION:
+                    return numpy.array([collision_point, collision_point - apex_point_direction / 2,
+                        collision_point - apex_point_direction])
+                if case == AFTER_APEX_LIMITED:
+                    evasion_point = start_point + collision_ratio * start_to_end_vector + \
                                     self.max_evasion_distance * apex_point_direction
                 control_point_2 = evasion_point - self.retraction_distance * start_to_end_direction
                 retraction_point = 0.5 * (control_point_2 - control_point_1) + control_point_1
                 control_point_3 = evasion_point + (1 - collision_ratio) * start_to_end_vector
                 return numpy.array(
-                    [self.collision_point, control_point_1, retraction_point, control_point_2, evasion_point,
-                        control_point_3, self.swing_target_point])
+                    [collision_point, control_point_1, retraction_point, control_point_2, evasion_point,
+                        control_point_3, target_point])
 
     def compute_bezier_points_with_joint_angles(self):  # ForNormalSwingMovement(self):
         #rospy.loginfo("target = " + str(self.swing_target_point) + " start = " + str(self.swing_start_point))
         start_to_end_vector = (self.swing_target_point - self.swing_start_point)[0:3]
         start_angles = self.leg.compute_inverse_kinematics(self.swing_start_point)
-        target_angles = self.leg.compute_inverse_kinematics(self.swing_target_point)
+        target_angles = self.leg.compute_inverse_kinematics(self.leg.clamp_to_workspace(self.swing_target_point))
         angles = [(start_angles[0] + target_angles[0]) / 2,
             (start_angles[1] + target_angles[1]) / 2 - CONST.DEFAULT_APEX_THIGH_OFFSET,
             (start_angles[2] + target_angles[2]) / 2]
@@ -318,51 +383,45 @@ class SwingMovementBezier:
                 [self.swing_start_point, control_point_1, apex_point, control_point_2, self.swing_target_point])
         else:  # in case of a collision
             rospy.logerr("a collision occured! calculate bezier points based on positions instead of joint angles!")
-            self.compute_bezier_points()
-
-    def move_to_next_point(self, activation):
-        # if not self.mleg.leg_enabled:
-        #    return
-
-        if activation >= 0.5:
-            if self.last_activation < 0.5:
-                self.trajectory_generator.reset()
-                self.swing_start_point = self.leg.ee_position()
-                self.swing_target_point = None
-                self.collision_point = None
-
-            # if numpy.any(self.swing_target_point != self.mleg.aep_shifted):
-            #    self.swing_target_point = self.mleg.aep_shifted
-            #    bezier_points = self.compute_bezier_points()
-            #    self.trajectory_generator.bezier_points = bezier_points
-            # target_position = self.trajectory_generator.compute_next_target(
-            #   desired_distance=self.swing_velocity / RSTATIC.controller_frequency)
+            return self.compute_bezier_points()
+
+    # Plan the swing from the swing_start_point to the swing_target_point.
+    def plan_swing(self):
+        self.trajectory_generator.bezier_points = self.compute_bezier_points_with_joint_angles()
+        self.trajectory_generator.arc_length_table = None
+
+    # Start a swing from the start point to the target point, the first command is sent by the next step.
+    def start_swing(self, start_point, target_point):
+        self.stop()
+        # the collision of the last swing
+        self.collision_point = None
+        self.swing_start_point = start_point
+        self.swing_target_point = target_point
+        self.plan_swing()
+        self.start()
+
+    def commands(self):
+        self.trajectory_generator.reset()
+        self.swing_start_point = self.leg.ee_position()
+        # the target is kept for the evasion curves of collisions
+        self.collision_point = None
+        while True:
             target_position = self.trajectory_generator.compute_next_target(
-                desired_distance=self.swing_velocity / RSTATIC.controller_frequency,
+                desired_distance=self.swing_velocity / self.leg.command_frequency(),
                 current_position=self.leg.ee_position()[0:3])
+            target_position = self.leg.clamp_to_workspace(target_position)
             # now it's just a matter of moving the leg to the next position
-            #current_input_angles = self.leg.get_current_angles()
-            # compute the values should for the next iteration
-            next_angles = None
             try:
                 next_angles = self.leg.compute_inverse_kinematics(target_position)
                 rospy.loginfo("target position is: " + str(target_position))
                 rospy.loginfo("computed next angles as: " + str(next_angles))
                 rospy.loginfo("would reach pos: " + str(self.leg.compute_forward_kinematics(next_angles)))
-                self.leg.set_command(next_angles)
             except ValueError:
                 rospy.logerr("ValueError in " + str(self.leg.name) + " during inverse kinematics computation.\n Tried to reach position " + str(
                     target_position) + "\ncurrent angles are: " + str(self.leg.get_current_angles()) +
                     "\nMaintaining current angles.")
-                self.leg.set_command(self.leg.get_current_angles())
-            # compute the difference
-            # delta_angles = next_angles - numpy.array(current_input_angles)
-            # compute the required speed in order to reach those angles
-            # angle_vel = delta_angles * RSTATIC.controller_frequency
-
-            # if self.mleg.wleg.leg.leg_enabled:
-            #    self.mleg.wleg.addControlVelocities(angle_vel)
-        self.last_activation = activation
+                next_angles = self.leg.get_current_angles()
+            yield next_angles
 
     def end_swing_phase(self):
         pass
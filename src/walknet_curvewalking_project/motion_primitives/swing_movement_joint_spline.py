@@ -0,0 +1,112 @@
+import numpy
+import rospy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+import walknet_curvewalking_project.support.constants as CONST
+from walknet_curvewalking_project.motion_primitives.streaming import JointLimitStage, Pipeline, StreamingPrimitive, \
+    TickSamples
+
+# number of samples per swing used to check the planned spline against the joint limits
+LIMIT_CHECK_SAMPLES = 50
+
+
+# Coefficients of the cubic Hermite polynomials between the knots (rows of angles) at the given times with the
+# given velocities. Returns an array of shape (segments, 4, joints) with the coefficients in ascending order of the
+# powers of the time relative to the start of the segment.
+def hermite_coefficients(times, angles, velocities):
+    durations = numpy.diff(times)[:, None]
+    delta = numpy.diff(angles, axis=0)
+    start_velocities = velocities[:-1] * durations
+    end_velocities = velocities[1:] * durations
+    c0 = angles[:-1]
+    c1 = start_velocities
+    c2 = 3 * delta - 2 * start_velocities - end_velocities
+    c3 = -2 * delta + start_velocities + end_velocities
+    # scale from the normalized segment parameter in [0, 1] to the time
+    return numpy.stack([c0, c1 / durations, c2 / durations ** 2, c3 / durations ** 3], axis=1)
+
+
+##
+#   Swing movement in joint space: the swing from the start over the apex to the target angles is planned once as a
+#   time parametrized cubic spline through the joint angles. The same start, apex and target angles as in
+#   SwingMovementBezier.compute_bezier_points_with_joint_angles are used. The duration is chosen such that the
+#   foot moves with swing_velocity along the start - apex - target polygon. Every tick only evaluates the spline,
+#   no inverse kinematics is computed during the swing: the commands are the pipeline of the spline samples at the
+#   commands of the leg (see SingleLeg.command_frequency) and the joint limits (see pipeline).
+#   Has the same interface as SwingMovementBezier (start_swing, plan_swing, move_to_next_point).
+class SwingMovementJointSpline(StreamingPrimitive):
+    def __init__(self, leg=None):
+        StreamingPrimitive.__init__(self, leg)
+        self.swing_velocity = CONST.DEFAULT_SWING_VELOCITY
+        self.swing_start_point = None  # the point where the swing phase starts
+        self.swing_target_point = None  # the point where the swing phase should end
+        self.apex_point_ratio = 0.5  # at which time of the swing the apex is reached (relative to the duration)
+
+        self.knot_times = None
+        self.coefficients = None
+        self.duration = None
+        self.clip_to_limits = False
+
+    # Plan the spline from the current joint angles to the swing_target_point.
+    def plan_swing(self):
+        start_angles = numpy.array(self.leg.get_current_angles(), dtype=float)
+        target_point = self.leg.clamp_to_workspace(self.swing_target_point)
+        target_angles = numpy.array(self.leg.compute_inverse_kinematics(target_point), dtype=float)
+        apex_angles = (start_angles + target_angles) / 2
+        apex_angles[1] -= CONST.DEFAULT_APEX_THIGH_OFFSET
+        angles = numpy.array([start_angles, apex_angles, target_angles])
+
+        start_point = self.leg.compute_forward_kinematics(start_angles)[0:3]
+        apex_point = self.leg.compute_forward_kinematics(apex_angles)[0:3]
+        target_point = self.leg.compute_forward_kinematics(target_angles)[0:3]
+        length = numpy.linalg.norm(apex_point - start_point) + numpy.linalg.norm(target_point - apex_point)
+        self.duration = max(length / self.swing_velocity, 1.0 / self.leg.command_frequency())
+        self.knot_times = numpy.array([0, self.apex_point_ratio * self.duration, self.duration])
+
+        # smooth at the apex, at rest at the start and the end of the swing
+        velocities = numpy.zeros_like(angles)
+        velocities[1] = (target_angles - start_angles) / self.duration
+        self.coefficients = hermite_coefficients(self.knot_times, angles, velocities)
+
+        samples = self.evaluate(numpy.linspace(0, self.duration, LIMIT_CHECK_SAMPLES))
+        limits = numpy.array(RSTATIC.joint_angle_limits)
+        self.clip_to_limits = bool(numpy.any(samples < limits[:, 0]) or numpy.any(samples > limits[:, 1]))
+        if self.clip_to_limits:
+            rospy.logerr("joint spline swing of " + str(self.leg.name) + " exceeds the joint limits, the angles are "
+                         "clipped. min = " + str(samples.min(axis=0)) + " max = " + str(samples.max(axis=0)))
+
+    # Joint angles of the planned spline at time t (scalar or array of times) after the start of the swing.
+    # After the end of the swing the target angles are kept.
+    def evaluate(self, t):
+        t = numpy.clip(t, 0, self.duration)
+        segments = numpy.minimum(numpy.searchsorted(self.knot_times, t, side='right') - 1, len(self.knot_times) - 2)
+        local_t = numpy.asarray(t - self.knot_times[segments])[..., None]
+        c = self.coefficients[segments]
+        return c[..., 0, :] + local_t * (c[..., 1, :] + local_t * (c[..., 2, :] + local_t * c[..., 3, :]))
+
+    # Joint angles of the planned swing at the commands 1, 2, ... (clipped to the joint limits if the spline
+    # exceeds them). pipeline().evaluate(count) computes the first count commands at once.
+    def pipeline(self):
+        return Pipeline(TickSamples(self.evaluate, self.leg.command_frequency()),
+                        JointLimitStage(RSTATIC.joint_angle_limits, self.clip_to_limits))
+
+    # Start a swing from the current joint angles to the target point, the first command is sent by the next step.
+    def start_swing(self, start_point, target_point):
+        self.stop()
+        self.swing_start_point = start_point
+        self.swing_target_point = target_point
+        self.plan_swing()
+        self.start()
+
+    def commands(self):
+        if self.coefficients is None:
+            self.plan_swing()
+        try:
+            for next_angles in self.pipeline():
+                yield list(next_angles)
+        finally:
+            # swing finished, the next swing is planned from scratch
+            self.coefficients = None
+
+    def end_swing_phase(self):
+        pass
@@ -5,6 +5,112 @@ import numpy
 # ====== simulation parameters ========
 controller_frequency = 100
 
+# ====== multi-rate execution ========
+# used by RobotController.walk_body_model_multi_rate: joint commands are interpolated towards the latest
+# IK targets at joint_command_frequency while the body model and the leg coordination run at
+# body_model_frequency and the rviz visualization runs at visualization_frequency.
+# configured_body_model_frequency is the body_model_frequency setting, None: controller_frequency.
+# update_rates has to be called after these values were changed.
+joint_command_frequency = 400
+configured_body_model_frequency = None
+visualization_frequency = 10
+
+
+def update_rates():
+    global body_model_frequency
+    if configured_body_model_frequency is None:
+        body_model_frequency = controller_frequency
+    else:
+        body_model_frequency = configured_body_model_frequency
+
+
+update_rates()
+
+# ====== parallel leg execution ========
+# used by RobotController.walk_body_model_parallel: 'thread' runs the per-leg computations in a thread pool,
+# 'process' in forked worker processes that exchange the leg states through shared memory.
+parallel_leg_mode = 'thread'
+parallel_leg_workers = 6
+
+# ====== swing movement ========
+# 'bezier': cartesian bezier curve, the next point on the curve and its inverse kinematics are computed every tick
+# (SwingMovementBezier). 'joint_spline': the swing is planned once as a spline in joint space and only evaluated
+# every tick (SwingMovementJointSpline).
+swing_mode = 'bezier'
+
+# ====== collision evasion ========
+# the evasion curves of the bezier swing (SwingMovementBezier.notify_of_collision) are looked up in templates that
+# are precomputed for a grid of evasion_template_ratios collision ratios (0..1) times evasion_template_heights heights
+# above the line from the start to the target of the swing (0..evasion_template_max_height m) of a swing of the
+# default_stance_distance, see evasion_templates.py. The curve is computed when the length of the swing differs by
+# more than evasion_template_tolerance (relative) from the default_stance_distance or the component of the apex
+# direction along the swing exceeds evasion_template_max_tilt.
+evasion_templates = True
+evasion_template_ratios = 20
+evasion_template_heights = 10
+evasion_template_max_height = 0.1
+evasion_template_tolerance = 0.25
+evasion_template_max_tilt = 0.1
+
+# ====== stance inverse kinematics ========
+# 'analytic': full inverse kinematics for the target of the leg vector in every tick. 'differential': the joint
+# angles follow the target with damped least squares steps of the leg Jacobian, starting from the last angles of the
+# stance. The full inverse kinematics is only used to (re-)synchronize: at the start of the stance and when the
+# target is more than stance_resync_distance (m) away from the last angles.
+stance_ik_mode = 'analytic'
+stance_resync_distance = 0.005
+# damping of the least squares steps (m), limits the joint increments near singular configurations
+differential_ik_damping = 0.005
+
+# ====== reachable workspace ========
+# if workspace_clamping is set, targets of the stance and swing movements are clamped to the nearest reachable point
+# of the precomputed workspace index of the leg (see workspace_index.py) before the inverse kinematics is computed.
+# Disabled by default: without precomputed index files a coarse index is built at start-up (seconds), which moves the
+# front PEPs and hind AEPs by some mm and is not symmetric for the left and right legs.
+workspace_clamping = False
+workspace_resolution = 0.005
+
+# ====== inverse kinematics cache ========
+# bounded LRU cache of inverse kinematics solutions keyed by leg and target position quantized to
+# ik_cache_resolution (see ik_cache.py). ik_cache_size = 0 disables the cache. ik_cache_mode is 'exact'
+# (solution of the nearest lattice point) or 'interpolate' (trilinear interpolation of the surrounding lattice points).
+# Disabled by default: the cached angles belong to the lattice point instead of the target, and the stance targets
+# move by several lattice points per tick, so most lookups miss.
+ik_cache_size = 0
+ik_cache_resolution = 0.0002
+ik_cache_mode = 'exact'
+
+# ====== waiting for joint states ========
+# the controllers block on the joint state callbacks of the legs (see SingleLeg.wait_for) and log every
+# state_wait_log_period seconds while still waiting. Commands for the initial positions are resent to legs
+# that did not reach them after init_pos_resend_period seconds, after init_pos_timeout seconds the controllers stop
+# waiting for the initial positions (None: wait until they are reached).
+state_wait_log_period = 1.0
+init_pos_resend_period = 0.5
+init_pos_timeout = 15.0
+
+# ====== runtime settings ========
+# all settings can be changed through the typed settings layer (see settings.py): at start-up from the private ROS
+# parameters of the node (and the YAML file given in ~settings_file), at runtime from the private ROS parameters that
+# are polled every parameter_update_period seconds.
+parameter_update_period = 1.0
+
+# ====== telemetry ========
+# binary per tick records of the control loop state (see support/telemetry.py). telemetry_directory = None disables
+# the recording. The records are collected in telemetry_buffers preallocated chunks of telemetry_chunk_size records
+# that are written to one file each by a background thread.
+telemetry_directory = None
+telemetry_chunk_size = 1000
+telemetry_buffers = 8
+
+# ====== steering latency ========
+# latency of the steering commands from robot_control(_stamped) to the joint commands (see support/latency.py).
+# The percentiles over the last latency_trace_size commands are published on /diagnostics every
+# latency_diagnostics_period seconds, with a warning when the 99th percentile exceeds latency_warning_threshold (s).
+latency_trace_size = 1000
+latency_diagnostics_period = 1.0
+latency_warning_threshold = 0.1
+
 # ========== naming objects ========
 leg_names = ('lf', 'rf', 'lm', 'rm', 'lr', 'rr')
 
@@ -51,15 +157,30 @@ body_c1_tf = (lf, rf, lm, rm, lr, rr)
 default_stance_distance = 0.0725
 stance_height = -0.09
 default_stance_width = 0.27
+# damping of the body model (weight of the recurrent connections, see mmcBodyModelStance)
+body_model_damping = 5
+# number of states of the body model kept for the rollback after failed inverse kinematics of a stance leg
+# (0 disables the recovery: the leg keeps its current angles, the body model continues)
+body_model_history_size = 50
 
-front_initial_aep = numpy.array([0.25, default_stance_width, stance_height])  # for forward walking
-front_initial_pep = numpy.array(
-    [front_initial_aep[0] - default_stance_distance, default_stance_width, stance_height])  # for forward walking
-middle_initial_aep = numpy.array([0.04, 0.327, stance_height])  # for forward walking
-middle_initial_pep = numpy.array(
-    [middle_initial_aep[0] - default_stance_distance, 0.327, stance_height])  # -0.07# for forward walking
-hind_initial_aep = numpy.array([-0.18, default_stance_width, stance_height])
-hind_initial_pep = numpy.array([hind_initial_aep[0] - default_stance_distance, default_stance_width, stance_height])
+
+# Anterior and posterior extreme positions of the legs, derived from default_stance_distance, stance_height and
+# default_stance_width. update_stance_geometry has to be called after these values were changed.
+def update_stance_geometry():
+    global front_initial_aep, front_initial_pep, middle_initial_aep, middle_initial_pep, hind_initial_aep, \
+        hind_initial_pep
+    front_initial_aep = numpy.array([0.25, default_stance_width, stance_height])  # for forward walking
+    front_initial_pep = numpy.array(
+        [front_initial_aep[0] - default_stance_distance, default_stance_width, stance_height])  # for forward walking
+    middle_initial_aep = numpy.array([0.04, 0.327, stance_height])  # for forward walking
+    middle_initial_pep = numpy.array(
+        [middle_initial_aep[0] - default_stance_distance, 0.327, stance_height])  # -0.07# for forward walking
+    hind_initial_aep = numpy.array([-0.18, default_stance_width, stance_height])
+    hind_initial_pep = numpy.array(
+        [hind_initial_aep[0] - default_stance_distance, default_stance_width, stance_height])
+
+
+update_stance_geometry()
 
 # == Ground Contact Parameters ========
 # =====================================
@@ -69,3 +190,24 @@ hind_initial_pep = numpy.array([hind_initial_aep[0] - default_stance_distance, d
 # (good value: 0.8, means when leg is having a height of 0.8 * the
 # intended height control value it is already assumed as having ground contact
 predicted_ground_contact_height_factor = 0.9
+# 'estimator': contact from the ground contact estimator of the robot controller (see ground_contact.py), which
+# combines the height rule with the tracking error of the joints and also detects early touchdowns.
+# 'prediction': height rule only (SingleLeg.predictedGroundContact). The estimator is not yet measured on the robot.
+ground_contact_mode = 'prediction'
+# time constant of the low pass filters of the estimator (s)
+ground_contact_filter_time = 0.03
+# vertical distance between the measured and the commanded foot position (m) and maximal vertical foot speed (m/s)
+# from which on a descending foot is considered to stand on the ground
+ground_contact_error_threshold = 0.008
+ground_contact_speed_threshold = 0.02
+
+# == Static stability ========
+# a leg only starts its swing when the stability margin of the support polygon of the remaining stance legs (distance
+# of the projected center of mass to the boundary of the polygon, see stability.py) is at least stability_min_margin
+# (m). Otherwise it continues its stance until another leg touched down or it is more than
+# stability_max_pep_overshoot (m) behind its PEP. stability_gating = False disables the check.
+stability_gating = True
+stability_min_margin = 0.0
+stability_max_pep_overshoot = 0.03
+# center of mass of the robot in body coordinates (m), only x and y are used
+center_of_mass = numpy.array([0.0, 0.0, 0.0])
@@ -1,27 +1,38 @@
 import copy
+import threading
+import time
 from math import sin, cos, atan2, pow, pi, acos, radians
 
 import numpy
 import rospy
-import tf.transformations as transformations
-from geometry_msgs.msg import Point
 from std_msgs.msg import Float64
-from visualization_msgs.msg import Marker
 
 import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+from walknet_curvewalking_project.phantomx.ik_cache import shared_cache
+from walknet_curvewalking_project.phantomx.leg_kinematics import differential_inverse_kinematics, inverse_kinematics, \
+    jacobian
+from walknet_curvewalking_project.phantomx.settings import IK_CACHE, settings
+from walknet_curvewalking_project.phantomx.workspace_index import load_workspace_index
+from walknet_curvewalking_project.support.latency import COMMAND, INVERSE_KINEMATICS
 
 
 class SingleLeg:
 
-    def __init__(self, name, segment_lengths, tf_listener, movement_dir):
+    # offline: no publishers are created and the commands are only stored in last_command (replay without ROS,
+    # see support/gait_replay.py).
+    def __init__(self, name, segment_lengths, tf_listener, movement_dir, offline=False):
         self.name = name
         self.tf_listener = tf_listener
-        self.alpha_pub = rospy.Publisher('/phantomx/j_c1_' + self.name + '_position_controller/command', Float64,
-                queue_size=1)
-        self.beta_pub = rospy.Publisher('/phantomx/j_thigh_' + self.name + '_position_controller/command', Float64,
-                queue_size=1)
-        self.gamma_pub = rospy.Publisher('/phantomx/j_tibia_' + self.name + '_position_controller/command', Float64,
-                queue_size=1)
+        self.offline = offline
+        if offline:
+            self.alpha_pub = self.beta_pub = self.gamma_pub = None
+        else:
+            self.alpha_pub = rospy.Publisher('/phantomx/j_c1_' + self.name + '_position_controller/command', Float64,
+                    queue_size=1)
+            self.beta_pub = rospy.Publisher('/phantomx/j_thigh_' + self.name + '_position_controller/command',
+                    Float64, queue_size=1)
+            self.gamma_pub = rospy.Publisher('/phantomx/j_tibia_' + self.name + '_position_controller/command',
+                    Float64, queue_size=1)
 
         self.alpha = None
         self.beta = None
@@ -36,20 +47,81 @@ class SingleLeg:
         self.beta_reached = True
         self.gamma_reached = True
 
+        self.alpha_error = None
+        self.beta_error = None
+        self.gamma_error = None
+
+        # notified by the joint state callbacks, see wait_until_ready, wait_until_target_reached and wait_for_legs
+        self.state_condition = threading.Condition()
+        if not offline:
+            rospy.on_shutdown(self.notify_state_changed)
+
         self.segment_lengths = segment_lengths
         self.movement_dir = movement_dir
         # self.rotation_dir = rotation_dir
 
         self.ee_pos = None
-
+        # reachable workspace of the leg, see clamp_to_workspace
+        self.workspace = load_workspace_index(self.name) if RSTATIC.workspace_clamping else None
+        # optional cache for the inverse kinematics (shared by all legs), see ik_cache.py
+        self.ik_cache = shared_cache()
+        # ground contact estimator of the robot (see ground_contact.py), set by the robot controller
+        self.ground_contact_estimator = None
+        # steering latency tracer of the robot (see support/latency.py), set by the robot controller. ik_command is
+        # set by the stance when the next command was computed by the inverse kinematics from the body model, only
+        # the publication of such a command completes the trace.
+        self.latency_tracer = None
+        self.ik_command = False
+        settings.subscribe(IK_CACHE, self.update_ik_cache)
+
+        # command interpolation for multi-rate execution: when interpolation_steps is greater than one,
+        # set_command only stores the new target and step_command_interpolation publishes intermediate
+        # commands towards it. The target is handed from the body model to the joint command rate group under
+        # command_lock.
+        self.interpolation_steps = 1
+        # frequency at which the motion primitives of the leg are stepped, their movement per step is derived from it.
+        # None: controller_frequency, the multi-rate execution sets body_model_frequency (see command_frequency).
+        self.step_frequency = None
+        self.command_lock = threading.Lock()
+        self.command_target = None
+        self.interpolation_target = None
+        self.interpolation_start = None
+        self.interpolation_step = 0
+        self.interpolation_traced = False
+        self.last_command = None
+
+        # deferred commands for parallel execution: set_command only stores the command until flush_command is
+        # called, so that the commands of all legs can be sent in a deterministic order after joining the workers.
+        self.defer_commands = False
+        self.pending_command = None
+        self.pending_ik = False
+
+        # marker publisher for rviz visualization, created with the markers on first use (see set_up_visualization)
+        self.visualization_pub = None
+        self.c1_ee_points = None
+
+    # The tf listener of the leg, created on first use if none was given (subscribing to the transforms of all legs
+    # delays the start of the node).
+    def transform_listener(self):
+        if self.tf_listener is None:
+            import tf
+            self.tf_listener = tf.TransformListener()
+        return self.tf_listener
+
+    def update_ik_cache(self, changed):
+        self.ik_cache = shared_cache()
+
+    # Create the marker publisher and the markers on first use, so the message packages of the visualization are
+    # only imported when a leg is visualized.
+    def set_up_visualization(self):
+        if self.c1_ee_points is not None:
+            return
+        from visualization_msgs.msg import Marker
         self.visualization_pub = rospy.Publisher('/kinematics', Marker, queue_size=1)
         self.c1_ee_points = Marker()
         self.global_ee_points = Marker()
         self.c1_leg_vec_lines = Marker()
         self.global_leg_vec_lines = Marker()
-        self.set_up_visualization()
-
-    def set_up_visualization(self):
         self.global_ee_points.header.frame_id = self.global_leg_vec_lines.header.frame_id = "MP_BODY"
         self.c1_ee_points.header.frame_id = self.c1_leg_vec_lines.header.frame_id = "c1_" + self.name
         # self.c1_ee_points.header.frame_id = self.c1_leg_vec_lines.header.frame_id = "MP_BODY"
@@ -90,6 +162,8 @@ class SingleLeg:
         self.c1_leg_vec_lines.color.b = 1.0
 
     def pub_local(self):
+        from geometry_msgs.msg import Point
+        self.set_up_visualization()
         start_point = Point()
         start = [0, 0, 0]
         start_point.x = start[0]
@@ -112,6 +186,8 @@ class SingleLeg:
             rate.sleep()
 
     def pub_global(self):
+        from geometry_msgs.msg import Point
+        self.set_up_visualization()
         start_point = Point()
         start = [0, 0, 0]
         start_point.x = start[0]
@@ -139,9 +215,36 @@ class SingleLeg:
         else:
             return False
 
+    def notify_state_changed(self):
+        with self.state_condition:
+            self.state_condition.notify_all()
+
+    # Block until the predicate (called with this leg) is true, the timeout expired or ROS is shut down.
+    # The predicate is only reevaluated when new joint states arrive. Returns the result of the predicate.
+    def wait_for(self, predicate, timeout=None):
+        with self.state_condition:
+            self.state_condition.wait_for(lambda: predicate(self) or rospy.is_shutdown(), timeout)
+            return predicate(self)
+
+    # True when the joint controllers took over the last sent command (set points within 0.01) and reached it.
+    def is_command_reached(self, tolerance=None):
+        targets = self.get_current_targets()
+        if targets is None or self.last_command is None or not self.is_target_reached(tolerance):
+            return False
+        return max(abs(target - command) for target, command in zip(targets, self.last_command)) <= 0.01
+
+    def wait_until_ready(self, timeout=None):
+        return self.wait_for(SingleLeg.is_ready, timeout)
+
+    # tolerance: maximal absolute control error of the joints, if None the error < 0.1 flags of the callbacks
+    # are used.
+    def wait_until_target_reached(self, tolerance=None, timeout=None):
+        return self.wait_for(lambda leg: leg.is_target_reached(tolerance), timeout)
+
     def c1_callback(self, data):
         self.alpha = data.process_value
         self.alpha_target = data.set_point
+        self.alpha_error = data.error
         if data.error < 0.1:
             # rospy.loginfo(self.name + ": alpha = " + str(self.alpha) + " alpha_target = " + str(
             #    self.alpha_target) + " alpha_reached = True")
@@ -150,10 +253,12 @@ class SingleLeg:
             # rospy.loginfo(self.name + ": alpha = " + str(self.alpha) + " alpha_target = " + str(
             #    self.alpha_target) + " alpha_reached = False")
             self.alpha_reached = False
+        self.notify_state_changed()
 
     def thigh_callback(self, data):
         self.beta = data.process_value
         self.beta_target = data.set_point
+        self.beta_error = data.error
         if data.error < 0.1:
             # rospy.loginfo(self.name + ": beta = " + str(self.beta) + " beta_target = " + str(
             #    self.beta_target) + " beta_reached = True")
@@ -162,10 +267,12 @@ class SingleLeg:
             # rospy.loginfo(self.name + ": beta = " + str(self.beta) + " beta_target = " + str(
             #    self.beta_target) + " beta_reached = False")
             self.beta_reached = False
+        self.notify_state_changed()
 
     def tibia_callback(self, data):
         self.gamma = data.process_value
         self.gamma_target = data.set_point
+        self.gamma_error = data.error
         if data.error < 0.1:
             # rospy.loginfo(self.name + ": gamma = " + str(self.gamma) + " gamma_target = " + str(
             #    self.gamma_target) + " gamma_reached = True")
@@ -174,6 +281,7 @@ class SingleLeg:
             # rospy.loginfo(self.name + ": gamma = " + str(self.gamma) + " gamma_target = " + str(
             #    self.gamma_target) + " gamma_reached = False")
             self.gamma_reached = False
+        self.notify_state_changed()
 
     def ee_position(self):
         self.update_ee_position()
@@ -188,6 +296,9 @@ class SingleLeg:
     #   simply decide if the leg should touch ground
     #   (very stable, but works only on flat terrain).
     def predictedGroundContact(self):
+        if RSTATIC.ground_contact_mode == 'estimator' and self.ground_contact_estimator is not None and \
+                self.ground_contact_estimator.updated:
+            return int(self.ground_contact_estimator.has_contact(self.name))
         if self.name == "lf" or self.name == "rf":
             if (self.ee_position()[2] < (RSTATIC.front_initial_aep[2] * RSTATIC.predicted_ground_contact_height_factor)) \
                     and abs(self.ee_position()[0] - RSTATIC.front_initial_aep[0]) < 0.025:
@@ -234,13 +345,26 @@ class SingleLeg:
 
         return 0
 
+    # Distance of the foot behind the PEP in the walking direction (from the AEP to the PEP), negative before the PEP.
+    def pep_distance(self):
+        leg_type = {'f': 'front', 'm': 'middle', 'r': 'hind'}[self.name[1]]
+        pep = getattr(RSTATIC, leg_type + '_initial_pep')[0]
+        aep = getattr(RSTATIC, leg_type + '_initial_aep')[0]
+        return (self.ee_position()[0] - pep) * numpy.sign(pep - aep)
+
+    # True if the foot is at the PEP or behind it, with the tolerance of reached_pep.
+    def passed_pep(self):
+        return self.pep_distance() >= -0.025
+
     # compute ee_position based on current joint values in c1 coordinate frame (= leg coordinate frame)
     # code from https://www.programcreek.com/python/example/96799/tf.transformations
     def compute_forward_kinematics_tf(self):
+        # tf is only needed for the comparison with the transforms of the robot description
+        import tf.transformations as transformations
         if not self.is_ready():
             rospy.loginfo("haven't received Joint values yet! skipp")
             return
-        (trans, rot) = self.tf_listener.lookupTransform('MP_BODY', 'tibia_' + self.name, rospy.Time(0))
+        (trans, rot) = self.transform_listener().lookupTransform('MP_BODY', 'tibia_' + self.name, rospy.Time(0))
         # (trans, rot) = self.tf_listener.lookupTransform('MP_BODY', 'tibia_' + self.name, rospy.Time(0))
         pos = numpy.array(transformations.quaternion_matrix(rot))
         pos[0, 3] = trans[0]
@@ -374,8 +498,9 @@ class SingleLeg:
         return trans.dot(point)
 
     def body_c1_transform(self, point=[0, 0, 0, 1]):
+        import tf.transformations as transformations
         # (trans, rot) = self.tf_listener.lookupTransform('MP_BODY', 'thigh_' + self.name, rospy.Time(0))
-        (trans, rot) = self.tf_listener.lookupTransform('MP_BODY', 'c1_' + self.name, rospy.Time(0))
+        (trans, rot) = self.transform_listener().lookupTransform('MP_BODY', 'c1_' + self.name, rospy.Time(0))
         pos = numpy.array(transformations.quaternion_matrix(rot))
         pos[0, 3] = trans[0]
         pos[1, 3] = trans[1]
@@ -388,8 +513,10 @@ class SingleLeg:
 
     # code from https://www.programcreek.com/python/example/96799/tf.transformations
     def alpha_forward_kinematics(self, point=[0, 0, 0, 1]):
+        import tf.transformations as transformations
         # (trans, rot) = self.tf_listener.lookupTransform('MP_BODY', 'thigh_' + self.name, rospy.Time(0))
-        (trans, rot) = self.tf_listener.lookupTransform('c1_' + self.name, 'thigh_' + self.name, rospy.Time(0))
+        (trans, rot) = self.transform_listener().lookupTransform('c1_' + self.name, 'thigh_' + self.name,
+                rospy.Time(0))
         pos = numpy.array(transformations.quaternion_matrix(rot))
         pos[0, 3] = trans[0]
         pos[1, 3] = trans[1]
@@ -398,21 +525,65 @@ class SingleLeg:
 
     # code from https://www.programcreek.com/python/example/96799/tf.transformations
     def beta_forward_kinematics(self, point=[0, 0, 0, 1]):
-        (trans, rot) = self.tf_listener.lookupTransform('thigh_' + self.name, 'tibia_' + self.name, rospy.Time(0))
+        import tf.transformations as transformations
+        (trans, rot) = self.transform_listener().lookupTransform('thigh_' + self.name, 'tibia_' + self.name,
+                rospy.Time(0))
         pos = numpy.array(transformations.quaternion_matrix(rot))
         pos[0, 3] = trans[0]
         pos[1, 3] = trans[1]
         pos[2, 3] = trans[2]
         return numpy.array(numpy.dot(pos, point))
 
+    # Clamp a target position (body frame) to the nearest reachable point of the workspace of the leg, so that the
+    # inverse kinematics can be solved within the joint limits.
+    def clamp_to_workspace(self, p):
+        if self.workspace is None:
+            return p
+        clamped = self.workspace.nearest_reachable_point(p)
+        if not self.workspace.is_reachable(p):
+            rospy.logdebug(self.name + ": target " + str(p) + " not reachable, clamped to " + str(clamped))
+        return clamped
+
     #  Calculation of inverse kinematics for a leg:
     #   Given a position in 3D space a joint configuration is calculated.
     #   When no position is provided the current position of the current leg is used
     #   to calculate the complementing angles.
+    #   The solution is taken from the inverse kinematics cache if it is enabled.
     #   @param p point in body coordinate system
     def compute_inverse_kinematics(self, p=None):
         if isinstance(p, (type(None))):
             p = self.ee_position()
+        if self.ik_cache is not None:
+            return self.ik_cache.compute_inverse_kinematics(self, p)
+        return self.solve_inverse_kinematics(p)
+
+    # Jacobian (3, 3) of the end effector position in body coordinate system with respect to the joint angles
+    # (current angles if not given).
+    def compute_jacobian(self, angles=None):
+        if angles is None:
+            angles = self.get_current_angles()
+        return jacobian(angles, self.c1_static_transform)
+
+    # One damped least squares step from the angles towards the target p in body coordinate system (see
+    # leg_kinematics.differential_inverse_kinematics). Returns the new angles and the distance between the position
+    # of the angles and the target.
+    def compute_differential_inverse_kinematics(self, angles, p):
+        next_angles, distance = differential_inverse_kinematics(angles, p[0:3], self.c1_static_transform,
+                RSTATIC.differential_ik_damping)
+        return next_angles, float(distance)
+
+    # Inverse kinematics for an array of points (n, 3) in body coordinate system at once (without cache). Raises a
+    # ValueError like compute_inverse_kinematics if one of the points is not valid for the geometry of the leg.
+    def compute_inverse_kinematics_batch(self, points):
+        angles, valid = inverse_kinematics(points, self.c1_static_transform, self.segment_lengths)
+        if not numpy.all(valid):
+            p = numpy.asarray(points)[~valid][0]
+            raise ValueError('The provided position (' + str(p[0]) + ', ' + str(p[1]) + ', ' + str(
+                    p[2]) + ') is not valid for the given geometry for leg ' + self.name)
+        return angles
+
+    # Analytic inverse kinematics for the point p in body coordinate system (without cache).
+    def solve_inverse_kinematics(self, p):
         if len(p) == 3:
             p = numpy.append(p, [1])
         p_temp = copy.copy(p)
@@ -508,6 +679,14 @@ class SingleLeg:
         #    beta_angle *= -1
         return numpy.array([alpha_angle, beta_angle, gamma_angle])
 
+    # Set the joint state directly (instead of through the joint controller state callbacks), e.g. when the
+    # state is mirrored from another process.
+    def apply_joint_state(self, angles, targets, reached):
+        self.alpha, self.beta, self.gamma = angles
+        self.alpha_target, self.beta_target, self.gamma_target = targets
+        self.alpha_reached, self.beta_reached, self.gamma_reached = reached
+        self.notify_state_changed()
+
     def get_current_angles(self):
         if self.alpha is None or self.beta is None or self.gamma is None:
             return None
@@ -518,12 +697,17 @@ class SingleLeg:
             return None
         return [self.alpha_target, self.beta_target, self.gamma_target]
 
-    def is_target_reached(self):
+    def is_target_reached(self, tolerance=None):
         # rospy.loginfo("alpha is reached = " + str(self.alpha_reached))
         # rospy.loginfo("beta is reached = " + str(self.beta_reached))
         # rospy.loginfo("gamma is reached = " + str(self.gamma_reached))
         if self.alpha_target is None or self.beta_target is None or self.gamma_target is None:
             return None
+        if tolerance is not None:
+            if self.alpha_error is None or self.beta_error is None or self.gamma_error is None:
+                return False
+            return abs(self.alpha_error) < tolerance and abs(self.beta_error) < tolerance and abs(
+                    self.gamma_error) < tolerance
         return self.alpha_reached and self.beta_reached and self.gamma_reached
 
     def set_command(self, next_angles):
@@ -531,6 +715,81 @@ class SingleLeg:
         rospy.loginfo(
                 "set command " + self.name + ". angles = " + str(next_angles) + " current angles = " + str(
                         self.get_current_angles()))
-        self.alpha_pub.publish(next_angles[0])
-        self.beta_pub.publish(next_angles[1])
-        self.gamma_pub.publish(next_angles[2])
+        ik_command, self.ik_command = self.ik_command, False
+        if self.defer_commands:
+            self.pending_command = next_angles
+            self.pending_ik = ik_command
+            return
+        self.send_command(next_angles, self.is_traced(ik_command))
+
+    # True if a command computed by the inverse kinematics (ik_command) belongs to the traced steering command.
+    def is_traced(self, ik_command):
+        return ik_command and self.latency_tracer is not None and self.latency_tracer.trace(INVERSE_KINEMATICS)
+
+    # Frequency of the commands of the motion primitives (calls of their step).
+    def command_frequency(self):
+        return RSTATIC.controller_frequency if self.step_frequency is None else self.step_frequency
+
+    # traced: the command completes the latency trace of the steering command when it is published.
+    def send_command(self, next_angles, traced=False):
+        if self.interpolation_steps > 1:
+            command_target = (numpy.array(next_angles, dtype=float), traced)
+            with self.command_lock:
+                self.command_target = command_target
+            return
+        self.publish_command(next_angles)
+        if traced:
+            self.latency_tracer.trace(COMMAND)
+
+    def flush_command(self):
+        command = self.pending_command
+        if command is not None:
+            self.pending_command = None
+            self.send_command(command, self.is_traced(self.pending_ik))
+
+    def publish_command(self, angles):
+        if not self.offline:
+            self.alpha_pub.publish(angles[0])
+            self.beta_pub.publish(angles[1])
+            self.gamma_pub.publish(angles[2])
+        self.last_command = angles
+
+    # Publish the next intermediate command on the way to the latest command target.
+    # The target is reached after interpolation_steps calls, starting from the last published command
+    # (or from the current angles for the very first target).
+    def step_command_interpolation(self):
+        with self.command_lock:
+            command_target = self.command_target
+        if command_target is None:
+            return
+        target, traced = command_target
+        if target is not self.interpolation_target:
+            self.interpolation_target = target
+            self.interpolation_traced = traced
+            if self.last_command is not None:
+                self.interpolation_start = numpy.array(self.last_command, dtype=float)
+            elif self.is_ready():
+                self.interpolation_start = numpy.array(self.get_current_angles(), dtype=float)
+            else:
+                self.interpolation_start = target
+            self.interpolation_step = 0
+        if self.interpolation_step >= self.interpolation_steps:
+            return
+        self.interpolation_step += 1
+        self.publish_command(self.interpolation_start + (target - self.interpolation_start) * (
+                self.interpolation_step / self.interpolation_steps))
+        # the first published step towards the new target
+        if self.interpolation_traced:
+            self.interpolation_traced = False
+            self.latency_tracer.trace(COMMAND)
+
+
+# Wait for all legs at once until the predicate (called with a SingleLeg) is true for every leg.
+# The timeout is shared by all legs. Returns True if the predicate holds for all legs.
+def wait_for_legs(legs, predicate, timeout=None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for leg in legs:
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if not leg.wait_for(predicate, remaining):
+            return False
+    return True
@@ -0,0 +1,82 @@
+from math import exp
+
+import numpy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+from walknet_curvewalking_project.phantomx.leg_kinematics import forward_kinematics, static_transform
+
+# width of the smooth transitions of the height (m), of the vertical tracking error (m) and of the foot speed (m/s)
+HEIGHT_SCALE = 0.001
+ERROR_SCALE = 0.002
+SPEED_SCALE = 0.005
+
+
+def sigmoid(x):
+    return 1 / (1 + numpy.exp(-numpy.clip(x, -50, 50)))
+
+
+##
+#   Ground contact estimation for all legs at once, updated once per control tick from the joint states of the legs
+#   (process values and set points of the joint controllers). Two kinds of evidence are combined:
+#       - height: the foot is below the expected ground height near the AEP (the rule of
+#         SingleLeg.predictedGroundContact, which only works on flat terrain)
+#       - load: while the command moves the foot downwards, the foot stands still above its commanded height,
+#         i.e. the joint controllers cannot reach their set points because the foot touches the ground. This ends
+#         the swing on ground that is higher than expected.
+#   The signals are smoothed by first order low pass filters. confidence holds the contact probability of each
+#   leg, contact is confidence > 0.5.
+class GroundContactEstimator:
+    def __init__(self, legs):
+        self.legs = legs
+        self.index = {leg.name: leg_nr for leg_nr, leg in enumerate(legs)}
+        self.transforms = numpy.array([static_transform(leg.name) for leg in legs])
+        count = len(legs)
+        # foot positions in body coordinates computed from the measured joint angles
+        self.feet = numpy.full((count, 3), numpy.nan)
+        self.heights = numpy.full(count, numpy.nan)
+        self.command_heights = numpy.full(count, numpy.nan)
+        self.vertical_error = numpy.zeros(count)
+        self.foot_speed = numpy.zeros(count)
+        self.command_speed = numpy.zeros(count)
+        self.confidence = numpy.zeros(count)
+        self.contact = numpy.zeros(count, dtype=bool)
+        self.updated = False
+
+    # Expected ground height and AEP x of the legs (depend on the settings).
+    def ground_reference(self):
+        aeps = {'f': RSTATIC.front_initial_aep, 'm': RSTATIC.middle_initial_aep, 'r': RSTATIC.hind_initial_aep}
+        reference = numpy.array([aeps[leg.name[1]] for leg in self.legs])
+        return reference[:, 2] * RSTATIC.predicted_ground_contact_height_factor, reference[:, 0]
+
+    # One update with the current joint states of the legs, period is the time since the last update.
+    def update(self, period):
+        angles = numpy.array([[numpy.nan] * 3 if leg.get_current_angles() is None else leg.get_current_angles()
+                              for leg in self.legs], dtype=float)
+        targets = numpy.array([[numpy.nan] * 3 if leg.get_current_targets() is None else leg.get_current_targets()
+                               for leg in self.legs], dtype=float)
+        feet = forward_kinematics(angles, self.transforms)
+        heights = feet[:, 2]
+        command_heights = forward_kinematics(targets, self.transforms)[:, 2]
+
+        alpha = 1 - exp(-period / RSTATIC.ground_contact_filter_time)
+        if self.updated:
+            self.foot_speed += alpha * (numpy.nan_to_num((heights - self.heights) / period) - self.foot_speed)
+            self.command_speed += alpha * (
+                    numpy.nan_to_num((command_heights - self.command_heights) / period) - self.command_speed)
+        self.vertical_error += alpha * (numpy.nan_to_num(heights - command_heights) - self.vertical_error)
+        self.feet = feet
+        self.heights = heights
+        self.command_heights = command_heights
+        self.updated = True
+
+        ground_height, aep_x = self.ground_reference()
+        height_evidence = sigmoid((ground_height - numpy.nan_to_num(heights, nan=0.0)) / HEIGHT_SCALE) * sigmoid(
+                (0.025 - numpy.abs(numpy.nan_to_num(feet[:, 0] - aep_x, nan=1.0))) / HEIGHT_SCALE)
+        load_evidence = sigmoid((self.vertical_error - RSTATIC.ground_contact_error_threshold) / ERROR_SCALE) * \
+            sigmoid((RSTATIC.ground_contact_speed_threshold - numpy.abs(self.foot_speed)) / SPEED_SCALE) * \
+            (self.command_speed < 0)
+        self.confidence = 1 - (1 - height_evidence) * (1 - load_evidence)
+        self.contact = self.confidence > 0.5
+
+    def has_contact(self, leg_name):
+        return bool(self.contact[self.index[leg_name]])
@@ -0,0 +1,115 @@
+import threading
+from collections import OrderedDict
+from itertools import product
+from math import floor
+
+import numpy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+
+# cache shared by all legs, see shared_cache
+cache = None
+
+
+##
+#   Bounded LRU cache for the inverse kinematics of the legs. Targets are quantized to a lattice with the given
+#   resolution, entries are keyed by the leg name and the lattice point and hold the joint angles of the lattice point.
+#   Modes:
+#       'exact': the angles of the nearest lattice point are returned (error of the target below resolution).
+#       'interpolate': the angles are interpolated trilinearly from the eight surrounding lattice points, which
+#           are solved once and then reused by all targets in between.
+#   If a lattice point cannot be solved (outside of the workspace) the target itself is solved without caching.
+class InverseKinematicsCache:
+    def __init__(self, size=4096, resolution=RSTATIC.ik_cache_resolution, mode=RSTATIC.ik_cache_mode):
+        if mode not in ('exact', 'interpolate'):
+            raise ValueError('unknown inverse kinematics cache mode: ' + str(mode))
+        self.size = size
+        self.resolution = resolution
+        self.mode = mode
+        self.entries = OrderedDict()
+        # the legs can be computed in parallel threads (see parallel_legs.py)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncached = 0
+
+    # Angles of the lattice point key for the leg, solved with solve_inverse_kinematics of the leg on a miss.
+    def lattice_angles(self, leg, key):
+        with self.lock:
+            angles = self.entries.get((leg.name, key))
+            if angles is not None:
+                self.entries.move_to_end((leg.name, key))
+                self.hits += 1
+                return angles
+            self.misses += 1
+        angles = leg.solve_inverse_kinematics([key[0] * self.resolution, key[1] * self.resolution,
+                                               key[2] * self.resolution])
+        with self.lock:
+            self.entries[(leg.name, key)] = angles
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return angles
+
+    # Joint angles for the target position p (body frame) of the leg.
+    def compute_inverse_kinematics(self, leg, p):
+        scaled = [p[0] / self.resolution, p[1] / self.resolution, p[2] / self.resolution]
+        try:
+            if self.mode == 'exact':
+                key = (int(round(scaled[0])), int(round(scaled[1])), int(round(scaled[2])))
+                return self.lattice_angles(leg, key).copy()
+            lower = [int(floor(value)) for value in scaled]
+            if lower[2] in (-1, 0):
+                # the inverse kinematics switches the solution at p[2] = 0, do not interpolate across
+                raise ValueError
+            weights = [value - corner for value, corner in zip(scaled, lower)]
+            angles = numpy.zeros(3)
+            for offset in product((0, 1), repeat=3):
+                weight = 1.0
+                for axis in range(3):
+                    weight *= weights[axis] if offset[axis] else 1 - weights[axis]
+                if weight > 0:
+                    angles += weight * self.lattice_angles(leg, (lower[0] + offset[0], lower[1] + offset[1],
+                                                                 lower[2] + offset[2]))
+            return angles
+        except ValueError:
+            with self.lock:
+                self.uncached += 1
+            return leg.solve_inverse_kinematics(p)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # Change the configuration. The entries are kept if only the size changed.
+    def configure(self, size, resolution, mode):
+        if mode not in ('exact', 'interpolate'):
+            raise ValueError('unknown inverse kinematics cache mode: ' + str(mode))
+        with self.lock:
+            if resolution != self.resolution or mode != self.mode:
+                self.entries.clear()
+            self.size = size
+            self.resolution = resolution
+            self.mode = mode
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def statistics(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'uncached': self.uncached,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0, 'entries': len(self.entries)}
+
+
+# The cache used by the legs, None if caching is disabled (RSTATIC.ik_cache_size = 0). The cache is reconfigured
+# if the settings changed since it was created.
+def shared_cache():
+    global cache
+    if RSTATIC.ik_cache_size <= 0:
+        cache = None
+    elif cache is None:
+        cache = InverseKinematicsCache(RSTATIC.ik_cache_size, RSTATIC.ik_cache_resolution, RSTATIC.ik_cache_mode)
+    else:
+        cache.configure(RSTATIC.ik_cache_size, RSTATIC.ik_cache_resolution, RSTATIC.ik_cache_mode)
+    return cache
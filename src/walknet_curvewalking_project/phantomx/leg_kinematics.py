@@ -0,0 +1,175 @@
+from math import atan2, cos, pi, sin, radians
+
+import numpy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+
+# Batched versions of the kinematics of SingleLeg. The transformations are the same as in
+# SingleLeg.c1_rotation, c1_thigh_transformation, thigh_tibia_transformation and tibia_ee_transformation
+# (including the rounding of cos(radians(90)) and sin(radians(180))), so the results match the per leg functions.
+# inverse_kinematics follows SingleLeg.solve_inverse_kinematics.
+
+COS_90, SIN_90 = cos(radians(90)), sin(radians(90))
+COS_180, SIN_180 = cos(radians(180)), sin(radians(180))
+# end effector in the tibia frame
+TIBIA_EE = numpy.array([0, -0.16, 0.02, 1])
+# angle between the tibia and the line from the tibia joint to the end effector
+TIBIA_Z_ANGLE = pi - atan2(0.02, -0.16)
+
+
+def static_transform(leg_name):
+    return RSTATIC.body_c1_tf[RSTATIC.leg_names.index(leg_name)]
+
+
+def rotation_matrices(cos_angle, sin_angle, cos_offset, sin_offset, translation):
+    matrices = numpy.zeros(cos_angle.shape + (4, 4))
+    matrices[..., 0, 0] = cos_offset
+    matrices[..., 0, 1] = sin_angle * sin_offset
+    matrices[..., 0, 2] = cos_angle * sin_offset
+    matrices[..., 1, 1] = cos_angle
+    matrices[..., 1, 2] = -sin_angle
+    matrices[..., 2, 0] = -sin_offset
+    matrices[..., 2, 1] = sin_angle * cos_offset
+    matrices[..., 2, 2] = cos_angle * cos_offset
+    matrices[..., 0:3, 3] = translation
+    matrices[..., 3, 3] = 1
+    return matrices
+
+
+# End effector positions in the c1 frame for an array of joint angles (..., 3). Returns an array (..., 3).
+def forward_kinematics_c1(angles):
+    angles = numpy.asarray(angles, dtype=float)
+    alpha, beta, gamma = angles[..., 0], angles[..., 1], angles[..., 2]
+    c1 = rotation_matrices(numpy.cos(alpha), numpy.sin(alpha), 1.0, 0.0, (0, 0, 0))
+    thigh = rotation_matrices(numpy.cos(beta), numpy.sin(beta), COS_90, SIN_90, (0, -0.054, 0))
+    tibia = rotation_matrices(numpy.cos(gamma), numpy.sin(gamma), COS_180, SIN_180, (0, -0.0645, -0.0145))
+    return numpy.matmul(c1, numpy.matmul(thigh, numpy.matmul(tibia, TIBIA_EE[:, None])))[..., 0:3, 0]
+
+
+# End effector positions in the body frame. transforms is either one static c1 transform (4, 4) of a leg or one
+# transform per row of angles (..., 4, 4).
+def forward_kinematics(angles, transforms):
+    positions = forward_kinematics_c1(angles)
+    transforms = numpy.asarray(transforms, dtype=float)
+    return numpy.einsum('...ij,...j->...i', transforms[..., 0:3, 0:3], positions) + transforms[..., 0:3, 3]
+
+
+# The joint transformations are linear in the cosine and the sine of the joint angle:
+# matrix = constant + cos(angle) * cos_part + sin(angle) * sin_part (c1, thigh, tibia in the first axis).
+def joint_matrix_parts(offsets, translations):
+    zero, one = numpy.zeros(len(offsets)), numpy.ones(len(offsets))
+    cos_offsets, sin_offsets = numpy.array(offsets).T
+    translations = numpy.array(translations)
+    constant = rotation_matrices(zero, zero, cos_offsets, sin_offsets, translations)
+    no_translation = numpy.zeros_like(translations)
+    rotation_constant = rotation_matrices(zero, zero, cos_offsets, sin_offsets, no_translation)
+    cos_part = rotation_matrices(one, zero, cos_offsets, sin_offsets, no_translation) - rotation_constant
+    sin_part = rotation_matrices(zero, one, cos_offsets, sin_offsets, no_translation) - rotation_constant
+    return constant, cos_part, sin_part
+
+
+JOINT_CONSTANT, JOINT_COS, JOINT_SIN = joint_matrix_parts(
+        [(1.0, 0.0), (COS_90, SIN_90), (COS_180, SIN_180)], [(0, 0, 0), (0, -0.054, 0), (0, -0.0645, -0.0145)])
+
+
+# End effector positions (..., 3) and Jacobians (..., 3, 3) with respect to the joint angles (..., 3) in the body
+# frame, column i of a Jacobian is the derivative with respect to angle i. transforms as in forward_kinematics.
+def forward_kinematics_and_jacobian(angles, transforms):
+    angles = numpy.asarray(angles, dtype=float)
+    transforms = numpy.asarray(transforms, dtype=float)
+    cos_angles = numpy.cos(angles)[..., None, None]
+    sin_angles = numpy.sin(angles)[..., None, None]
+    matrices = JOINT_CONSTANT + cos_angles * JOINT_COS + sin_angles * JOINT_SIN
+    derivatives = cos_angles * JOINT_SIN - sin_angles * JOINT_COS
+    c1, thigh, tibia = matrices[..., 0, :, :], matrices[..., 1, :, :], matrices[..., 2, :, :]
+    # column vectors (..., 4, 1)
+    ee = TIBIA_EE[:, None]
+    tibia_ee = numpy.matmul(tibia, ee)
+    thigh_ee = numpy.matmul(thigh, tibia_ee)
+    columns = numpy.concatenate([numpy.matmul(derivatives[..., 0, :, :], thigh_ee),
+                                 numpy.matmul(c1, numpy.matmul(derivatives[..., 1, :, :], tibia_ee)),
+                                 numpy.matmul(c1, numpy.matmul(thigh, numpy.matmul(derivatives[..., 2, :, :], ee)))],
+            axis=-1)
+    rotation = transforms[..., 0:3, 0:3]
+    positions = numpy.matmul(rotation, numpy.matmul(c1, thigh_ee)[..., 0:3, :])[..., 0] + transforms[..., 0:3, 3]
+    return positions, numpy.matmul(rotation, columns[..., 0:3, :])
+
+
+def jacobian(angles, transforms):
+    return forward_kinematics_and_jacobian(angles, transforms)[1]
+
+
+# Damped least squares increments (..., 3) of the joint angles for the displacements (..., 3) of the end effectors.
+def damped_least_squares(jacobians, displacements, damping):
+    transposed = numpy.swapaxes(jacobians, -1, -2)
+    system = numpy.matmul(jacobians, transposed) + damping ** 2 * numpy.eye(3)
+    return numpy.matmul(transposed, numpy.linalg.solve(system, displacements[..., None]))[..., 0]
+
+
+# One step of the differential inverse kinematics: joint angles (..., 3) that move the end effectors from the
+# positions of the angles (..., 3) towards the targets (..., 3). The angles are kept within
+# RSTATIC.joint_angle_limits: joints that would leave their range are held at the limit and the remaining
+# displacement is distributed to the other joints. Returns the new angles and the distances between the start
+# positions and the targets.
+def differential_inverse_kinematics(angles, targets, transforms, damping):
+    angles = numpy.asarray(angles, dtype=float)
+    positions, jacobians = forward_kinematics_and_jacobian(angles, transforms)
+    displacements = numpy.asarray(targets, dtype=float) - positions
+    new_angles = angles + damped_least_squares(jacobians, displacements, damping)
+    # angles that are already out of range (the analytic inverse kinematics does not respect the limits) may stay
+    # there, but are not moved further out
+    limits = numpy.array(RSTATIC.joint_angle_limits)
+    lower = numpy.minimum(limits[:, 0], angles)
+    upper = numpy.maximum(limits[:, 1], angles)
+    clipped = (new_angles < lower) | (new_angles > upper)
+    if numpy.any(clipped):
+        new_angles = numpy.clip(new_angles, lower, upper)
+        residuals = displacements - numpy.matmul(jacobians, (new_angles - angles)[..., None])[..., 0]
+        free = jacobians * ~clipped[..., None, :]
+        new_angles = numpy.clip(new_angles + damped_least_squares(free, residuals, damping), lower, upper)
+    return new_angles, numpy.linalg.norm(displacements, axis=-1)
+
+
+# Joint angles for an array of end effector positions (..., 3) in the body frame. transforms as in
+# forward_kinematics (the static c1 transform of one leg or one per position). Returns the angles (..., 3) and a mask
+# of the positions that are valid for the geometry of the leg (the angles of invalid positions are nan).
+def inverse_kinematics(points, transforms, segment_lengths):
+    points = numpy.asarray(points, dtype=float)
+    transforms = numpy.asarray(transforms, dtype=float)
+    rotation, translation = transforms[..., 0:3, 0:3], transforms[..., 0:3, 3]
+    p_c1 = numpy.einsum('...ji,...j->...i', rotation, points - translation)
+    alpha = -numpy.arctan2(p_c1[..., 2], -p_c1[..., 1])
+
+    c1 = rotation_matrices(numpy.cos(alpha), numpy.sin(alpha), 1.0, 0.0, (0, 0, 0))
+    thigh = rotation_matrices(numpy.ones(1), numpy.zeros(1), COS_90, SIN_90, (0, -0.054, 0))[0]
+    tibia = rotation_matrices(numpy.ones(1), numpy.zeros(1), COS_180, SIN_180, (0, -0.0645, -0.0145))[0]
+    beta_pos = numpy.matmul(c1, thigh[:, 3])[..., 0:3]
+    default_gamma_pos = numpy.matmul(c1, thigh.dot(tibia[:, 3]))[..., 0:3]
+    lct = numpy.linalg.norm(points - (numpy.einsum('...ij,...j->...i', rotation, beta_pos) + translation), axis=-1)
+    thigh_tibia_angle = -numpy.arctan2(default_gamma_pos[..., 0] - beta_pos[..., 0],
+            -default_gamma_pos[..., 1] + beta_pos[..., 1])
+
+    coxa, femur, tibia_length = segment_lengths
+    cos_gamma = (tibia_length ** 2 + femur ** 2 - lct ** 2) / (2 * femur * tibia_length)
+    cos_beta_inner = (femur ** 2 + lct ** 2 - tibia_length ** 2) / (2 * femur * lct)
+    vector_c1_ee = numpy.linalg.norm(points - translation, axis=-1)
+    cos_beta = (lct ** 2 + coxa ** 2 - vector_c1_ee ** 2) / (2 * lct * coxa)
+    # values beyond the limits on the other side are rounding errors (see SingleLeg.solve_inverse_kinematics)
+    valid = (cos_gamma <= 1) & (cos_beta_inner >= -1) & (cos_beta <= 1)
+    gamma_inner = numpy.arccos(numpy.clip(cos_gamma, -1, 1))
+    h1 = numpy.arccos(numpy.clip(cos_beta_inner, -1, 1))
+    h2 = numpy.arccos(numpy.clip(cos_beta, -1, 1))
+
+    above = points[..., 2] > 0
+    gamma = numpy.where(above, pi - gamma_inner - TIBIA_Z_ANGLE, gamma_inner - pi - TIBIA_Z_ANGLE)
+    beta = numpy.where(points[..., 2] >= 0, h1 + h2 - pi - thigh_tibia_angle, pi - (h1 + h2 + thigh_tibia_angle))
+    angles = numpy.stack([alpha, beta, gamma], axis=-1)
+    angles[~valid] = numpy.nan
+    return angles, valid
+
+
+# Grid of joint angles within RSTATIC.joint_angle_limits with the given number of samples per joint.
+# Returns an array (samples[0] * samples[1] * samples[2], 3).
+def joint_space_grid(samples):
+    axes = [numpy.linspace(limits[0], limits[1], count) for limits, count in zip(RSTATIC.joint_angle_limits, samples)]
+    return numpy.stack(numpy.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
@@ -4,13 +4,155 @@
 # https://github.com/malteschilling/cognitiveWalker/blob/master/controller/reaCog/Movements/BodymodelStance/mmcBodyModel3D.py
 # modified for PhantomX Robot
 
+import copy
 import math
+import threading
+
 import numpy
-import rospy
-from geometry_msgs.msg import Point
-from visualization_msgs.msg import Marker
 
 import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+from walknet_curvewalking_project.phantomx.leg_kinematics import forward_kinematics
+from walknet_curvewalking_project.phantomx.settings import settings
+from walknet_curvewalking_project.support import log
+
+# Rows of the vectors of the network in mmcBodyModelStance.vectors. The first STATE_ROWS rows are the variables
+# that are updated in every iteration, followed by the inputs: the disturbance vectors and the footdiags (6 x 6,
+# footdiag[i][j] for j < i).
+FRONT_ROWS = slice(0, 6)
+LEG_ROWS = slice(6, 12)
+SEGM_LEG_ANT_ROWS = slice(12, 18)
+SEGM_LEG_POST_ROWS = slice(18, 24)
+SEGM_POST_ANT_ROW = 24
+SEGM_DIAG_ROWS = slice(25, 28)
+STATE_ROWS = 28
+DELTA_FRONT_ROW = 28
+DELTA_BACK_ROW = 29
+FOOTDIAG_ROWS = slice(30, 66)
+VECTOR_ROWS = 66
+
+
+def footdiag_row(i, j):
+    return FOOTDIAG_ROWS.start + i * 6 + j
+
+
+##
+#	Connection matrix of the MMC network for the legs with ground contact gc and the damping: one iteration
+#	step (before the normalization of the segment vectors) is connection_matrix(gc, damping).dot(vectors).
+#	Each row holds the mean of the equations of one variable: the closed kinematic chains through the
+#	variable (the footdiags only for legs with ground contact) and the old value of the variable weighted by the damping.
+def connection_matrix(gc, damping):
+    matrix = numpy.zeros((STATE_ROWS, VECTOR_ROWS))
+    front, leg, ant, post = FRONT_ROWS.start, LEG_ROWS.start, SEGM_LEG_ANT_ROWS.start, SEGM_LEG_POST_ROWS.start
+    for leg_nr in range(0, 6):
+        others = [target_leg for target_leg in range(0, 6) if gc[target_leg] and target_leg != leg_nr]
+        counter = 1 + damping + len(others)
+        # front vector
+        row = matrix[front + leg_nr]
+        row[DELTA_FRONT_ROW] -= 1
+        row[SEGM_POST_ANT_ROW] -= 1
+        row[leg + leg_nr] += 1
+        row[post + leg_nr] -= 1
+        row[front + leg_nr] += damping
+        for target_leg in others:
+            row[front + target_leg] += 1
+            if target_leg < leg_nr:
+                row[footdiag_row(leg_nr, target_leg)] -= 1
+            else:
+                row[footdiag_row(target_leg, leg_nr)] += 1
+        row /= counter
+        # leg vector
+        row = matrix[leg + leg_nr]
+        row[DELTA_BACK_ROW] -= 1
+        row[post + leg_nr] += 1
+        row[SEGM_POST_ANT_ROW] += 1
+        row[front + leg_nr] += 1
+        row[leg + leg_nr] += damping
+        for target_leg in others:
+            row[leg + target_leg] += 1
+            # segment vectors between the legs (see get_segm_vectors_between_legs)
+            segment = post if leg_nr // 2 == target_leg // 2 else ant
+            row[segment + leg_nr] += 1
+            row[segment + target_leg] -= 1
+            if target_leg < leg_nr:
+                row[footdiag_row(leg_nr, target_leg)] -= 1
+            else:
+                row[footdiag_row(target_leg, leg_nr)] += 1
+        row /= counter
+        # segment vectors of the leg
+        row = matrix[ant + leg_nr]
+        row[post + leg_nr] += 1
+        row[SEGM_POST_ANT_ROW] += 1
+        row[ant + leg_nr] += damping
+        row /= 1 + damping
+        row = matrix[post + leg_nr]
+        row[ant + leg_nr] += 1
+        row[SEGM_POST_ANT_ROW] -= 1
+        row[post + leg_nr] += damping
+        row /= 1 + damping
+    # segment vector
+    row = matrix[SEGM_POST_ANT_ROW]
+    row[SEGM_POST_ANT_ROW] += 1 + damping
+    row[DELTA_FRONT_ROW] += 1
+    row[DELTA_BACK_ROW] -= 1
+    for leg_nr, other_leg, sign in ((0, 1, 1), (1, 0, -1), (2, 3, 1), (3, 2, -1), (4, 5, 1), (5, 4, -1)):
+        row[post + leg_nr] -= 1
+        row[SEGM_DIAG_ROWS.start] += sign
+        row[ant + other_leg] += 1
+    row /= 7 + damping
+    # diagonal between the front legs (the other diagonals are not updated)
+    row = matrix[SEGM_DIAG_ROWS.start]
+    row[post + 0] += 1
+    row[ant + 1] -= 1
+    row[post + 1] -= 1
+    row[ant + 0] += 1
+    row[SEGM_DIAG_ROWS.start] += damping
+    row /= 2 + damping
+    matrix[SEGM_DIAG_ROWS.start + 1, SEGM_DIAG_ROWS.start + 1] = 1
+    matrix[SEGM_DIAG_ROWS.start + 2, SEGM_DIAG_ROWS.start + 2] = 1
+    return matrix
+
+
+# state of the body model (without the ground contacts, they follow the legs)
+STATE_DTYPE = numpy.dtype([('step', '<i8'), ('front_vect', '<f8', (6, 3)), ('leg_vect', '<f8', (6, 3)),
+                           ('segm_leg_ant', '<f8', (6, 3)), ('segm_leg_post', '<f8', (6, 3)),
+                           ('segm_post_ant', '<f8', (3,)), ('segm_diag_to_right', '<f8', (3, 3)),
+                           ('footdiag', '<f8', (6, 6, 3))])
+
+
+##
+#   Ring buffer of the last consistent states of the body model in a preallocated structured array. A state is
+#   consistent if the inverse kinematics of all stance legs succeeded for its leg vectors.
+class BodyModelHistory:
+    def __init__(self, size):
+        self.states = numpy.zeros(size, dtype=STATE_DTYPE)
+        self.count = 0
+        self.next = 0
+
+    def __len__(self):
+        return self.count
+
+    def store(self, body_model):
+        state = self.states[self.next]
+        state['step'] = body_model.step
+        state['front_vect'] = body_model.front_vect
+        state['leg_vect'] = body_model.leg_vect
+        state['segm_leg_ant'] = body_model.segm_leg_ant
+        state['segm_leg_post'] = body_model.segm_leg_post
+        state['segm_post_ant'] = body_model.segm_post_ant
+        state['segm_diag_to_right'] = body_model.segm_diag_to_right
+        state['footdiag'] = body_model.footdiag
+        self.next = (self.next + 1) % len(self.states)
+        self.count = min(self.count + 1, len(self.states))
+
+    # The newest state, None if the history is empty.
+    def latest(self):
+        if self.count == 0:
+            return None
+        return self.states[self.next - 1]
+
+    def clear(self):
+        self.count = 0
+        self.next = 0
 
 
 ##
@@ -68,18 +210,12 @@ class mmcBodyModelStance:
     # The segment vectors are encoded here, the leg vectors are initialised here
     # but are actually set when a leg is really put on the ground (initially all are
     # assumed in the air, so an update of the legs is forced in the first iteration)
-    def __init__(self, robot):  # , motiv_net, stab_thr):
-        # set up marker publisher for rviz visualization
-        self.visualization_pub = rospy.Publisher('/mmcBodyModel', Marker,
-                queue_size=1)
-        self.points = Marker()
-        self.leg_lines = Marker()
-        self.front_lines = Marker()
-        self.segm_leg_ant_lines = Marker()
-        self.segm_leg_post_lines = Marker()
-        self.segm_line = Marker()
-        self.segm_diag_to_right_lines = Marker()
-        self.set_up_visualization()
+    # offline: no marker publisher is created (replay without ROS, see support/gait_replay.py)
+    def __init__(self, robot, offline=False):  # , motiv_net, stab_thr):
+        # marker publisher for rviz visualization, created with the markers on first use (see set_up_visualization)
+        self.offline = offline
+        self.visualization_pub = None
+        self.points = None
 
         # self.motivationNetRobot = motiv_net -- not used for phantomX
         self.robot = robot
@@ -180,16 +316,80 @@ class mmcBodyModelStance:
         # self.delta_back = [[numpy.array([0, 0, 0])], [numpy.array([0, 0, 0])], [numpy.array([0, 0, 0])]]
         self.delta_front = numpy.array([0, 0, 0])
         self.delta_back = numpy.array([0, 0, 0])
+
+        # All vectors of the network in one array (see the *_ROWS constants). The attributes are views of their rows,
+        # so an iteration step is one product with the connection matrix of the current ground contacts.
+        self.vectors = numpy.zeros((VECTOR_ROWS, 3))
+        self.vectors[FRONT_ROWS] = self.front_vect
+        self.vectors[LEG_ROWS] = self.leg_vect
+        self.vectors[SEGM_LEG_ANT_ROWS] = self.segm_leg_ant
+        self.vectors[SEGM_LEG_POST_ROWS] = self.segm_leg_post
+        self.vectors[SEGM_POST_ANT_ROW] = self.segm_post_ant
+        self.vectors[SEGM_DIAG_ROWS] = self.segm_diag_to_right
+        for i in range(0, 6):
+            for j in range(0, i):
+                self.vectors[footdiag_row(i, j)] = self.footdiag[i][j]
+        self.front_vect = self.vectors[FRONT_ROWS]
+        self.leg_vect = self.vectors[LEG_ROWS]
+        self.segm_leg_ant = self.vectors[SEGM_LEG_ANT_ROWS]
+        self.segm_leg_post = self.vectors[SEGM_LEG_POST_ROWS]
+        self.segm_post_ant = self.vectors[SEGM_POST_ANT_ROW]
+        self.segm_diag_to_right = self.vectors[SEGM_DIAG_ROWS]
+        self.footdiag = self.vectors[FOOTDIAG_ROWS].reshape(6, 6, 3)
+        self.delta_front = self.vectors[DELTA_FRONT_ROW]
+        self.delta_back = self.vectors[DELTA_BACK_ROW]
+        # lengths of the segment vectors (restored after every iteration step)
+        self.segm_norms = numpy.concatenate([self.segm_leg_ant_norm, self.segm_leg_post_norm,
+                                             [self.segm_post_ant_norm, self.segm_diag_norm[0]]])
+        # connection matrices of the ground contact patterns that occurred (for the current damping)
+        self.connection_matrices = {}
         # These are operated through a pull at the front
         self.pull_front = numpy.array([0.0, 0.0, 0.0])
         self.pull_back = numpy.array([0.0, 0.0, 0.0])
         self.step = 0
-        self.damping = 5
+        # held while the vectors are changed, so the visualization (running in its own rate group of the multi-rate
+        # execution) reads the vectors of one state of the model
+        self.lock = threading.Lock()
+        self.damping = RSTATIC.body_model_damping
+        settings.subscribe(('damping',), self.update_damping)
+
+        # Recovery after failed inverse kinematics: the stance legs report failures in ik_failure, then the model is
+        # rolled back to the last consistent state and re-synchronized with the measured foot positions (recover).
+        self.ik_failure = [False, False, False, False, False, False]
+        self.history = BodyModelHistory(RSTATIC.body_model_history_size) if RSTATIC.body_model_history_size > 0 \
+            else None
+        self.recoveries = 0
+
+        # deferred updates for the threaded leg execution: while defer_updates is set, legs that are put on the
+        # ground and failed inverse kinematics are only stored per leg (the leg itself already reads its new leg
+        # vector) and applied in the order of the legs by apply_deferred_updates after the workers are joined.
+        self.defer_updates = False
+        self.pending_leg_vectors = [None] * 6
+        self.pending_ik_failures = [False] * 6
+
+    def update_damping(self, changed):
+        self.damping = RSTATIC.body_model_damping
+        self.connection_matrices = {}
 
     """ **** Graphic methods: For Visualization of the body model in RVIZ **************************
     """
 
+    # Create the marker publisher and the markers on first use, so the body model does not need the ROS message
+    # packages unless it is visualized.
     def set_up_visualization(self):
+        if self.points is not None:
+            return
+        import rospy
+        from visualization_msgs.msg import Marker
+        if not self.offline:
+            self.visualization_pub = rospy.Publisher('/mmcBodyModel', Marker, queue_size=1)
+        self.points = Marker()
+        self.leg_lines = Marker()
+        self.front_lines = Marker()
+        self.segm_leg_ant_lines = Marker()
+        self.segm_leg_post_lines = Marker()
+        self.segm_line = Marker()
+        self.segm_diag_to_right_lines = Marker()
         self.points.header.frame_id = self.leg_lines.header.frame_id = self.front_lines.header.frame_id = \
             self.segm_leg_ant_lines.header.frame_id = self.segm_leg_post_lines.header.frame_id = \
             self.segm_line.header.frame_id = self.segm_diag_to_right_lines.header.frame_id = "MP_BODY"
@@ -256,25 +456,37 @@ class mmcBodyModelStance:
         list.color.b = b
         list.color.a = 1.0
 
+    # A new marker with the settings of the template (one of the markers of set_up_visualization) and without points.
+    # The published markers are never changed afterwards, the templates are never published.
+    def new_marker(self, template):
+        marker = copy.deepcopy(template)
+        marker.points = []
+        return marker
+
     def pub_vecs(self, start, vecs, markers):
         # rospy.loginfo("#############################################in pub vecs")
+        import rospy
+        from geometry_msgs.msg import Point
+        self.set_up_visualization()
+        points = self.new_marker(self.points)
+        markers = self.new_marker(markers)
         start_point = Point()
         start_point.x = start[0]
         start_point.y = start[1]
         start_point.z = start[2]
-        self.points.points.append(start_point)
+        points.points.append(start_point)
         for position in vecs:
             pos = Point()
             pos.x = start_point.x + position[0]
             pos.y = start_point.y + position[1]
             pos.z = start_point.z + position[2]
-            self.points.points.append(pos)
+            points.points.append(pos)
             markers.points.append(start_point)
             markers.points.append(pos)
 
         rate = rospy.Rate(RSTATIC.controller_frequency)
         for i in range(0, 3):
-            self.visualization_pub.publish(self.points)
+            self.visualization_pub.publish(points)
             self.visualization_pub.publish(markers)
             rate.sleep()
 
@@ -282,6 +494,43 @@ class mmcBodyModelStance:
         # rospy.loginfo("#############################################in pub relative vecs")
         # rospy.loginfo("start_points = " + str(start_points))
         # rospy.loginfo("vectors      = " + str(vecs))
+        import rospy
+        self.set_up_visualization()
+        points = self.new_marker(self.points)
+        markers = self.new_marker(markers)
+        self.append_relative_vecs(start_points, vecs, markers, points)
+
+        rate = rospy.Rate(RSTATIC.controller_frequency)
+        for i in range(0, 3):
+            self.visualization_pub.publish(points)
+            self.visualization_pub.publish(markers)
+            rate.sleep()
+
+    ##  Publish the current leg and segment vectors once, without waiting in between.
+    #   The vectors are copied under the lock of the model and new markers are built from the copies. Used by the
+    #   visualization rate group of the multi-rate execution.
+    def publish_visualization(self):
+        if self.offline:
+            return
+        self.set_up_visualization()
+        with self.lock:
+            leg_vect = self.leg_vect.copy()
+            segm_leg_ant = self.segm_leg_ant.copy()
+            segm_leg_post = self.segm_leg_post.copy()
+        points = self.new_marker(self.points)
+        leg_lines = self.new_marker(self.leg_lines)
+        segm_leg_ant_lines = self.new_marker(self.segm_leg_ant_lines)
+        segm_leg_post_lines = self.new_marker(self.segm_leg_post_lines)
+        self.append_relative_vecs(self.c1_positions, leg_vect, leg_lines, points)
+        self.append_relative_vecs(self.c1_positions, segm_leg_ant, segm_leg_ant_lines, points)
+        self.append_relative_vecs(self.c1_positions, segm_leg_post, segm_leg_post_lines, points)
+        self.visualization_pub.publish(points)
+        self.visualization_pub.publish(leg_lines)
+        self.visualization_pub.publish(segm_leg_ant_lines)
+        self.visualization_pub.publish(segm_leg_post_lines)
+
+    def append_relative_vecs(self, start_points, vecs, markers, points):
+        from geometry_msgs.msg import Point
         for idx in range(0, len(vecs)):
             start_point = Point()
             start = start_points[idx]
@@ -289,7 +538,7 @@ class mmcBodyModelStance:
             start_point.y = start[1]
             start_point.z = start[2]
             # rospy.loginfo("append start point: " + str(start_point))
-            self.points.points.append(start_point)
+            points.points.append(start_point)
             pos = Point()
             pos.x = start_point.x + vecs[idx][0]
             pos.y = start_point.y + vecs[idx][1]
@@ -298,16 +547,10 @@ class mmcBodyModelStance:
             # rospy.loginfo("target point x: " + str(pos.x) + " = start.point.x (" + str(
             #    start_point.x) + ") + vecs[idx][0] (" + str(vecs[idx][0]) + ")")
             # rospy.loginfo("append target point: " + str(pos))
-            self.points.points.append(pos)
+            points.points.append(pos)
             markers.points.append(start_point)
             markers.points.append(pos)
 
-        rate = rospy.Rate(RSTATIC.controller_frequency)
-        for i in range(0, 3):
-            self.visualization_pub.publish(self.points)
-            self.visualization_pub.publish(markers)
-            rate.sleep()
-
     """ **** Set up methods and calculation of vector methods ***************************
     """
 
@@ -343,7 +586,7 @@ class mmcBodyModelStance:
     #	model computations. As the leg is not part of the closed kinematic chains
     #	after being lifted from the ground it shall not participate.
     def lift_leg_from_ground(self, leg_nr):
-        rospy.loginfo("lift leg from ground: " + RSTATIC.leg_names[leg_nr])
+        log.loginfo("lift leg from ground: " + RSTATIC.leg_names[leg_nr])
         if self.gc[leg_nr]:
             self.gc[leg_nr] = False
 
@@ -351,17 +594,22 @@ class mmcBodyModelStance:
     #	vectors to all other standing legs (footdiag) which are used by the
     #	network.
     def put_leg_on_ground(self, leg_name, leg_vec):
-        rospy.loginfo("put leg on ground: " + leg_name)
         leg_nr = RSTATIC.leg_names.index(leg_name)
+        if self.defer_updates:
+            if not self.gc[leg_nr] and self.pending_leg_vectors[leg_nr] is None:
+                self.pending_leg_vectors[leg_nr] = numpy.array(leg_vec)
+            return
+        log.loginfo("put leg on ground: " + leg_name)
         if not self.gc[leg_nr]:
-            # Set leg and diag vector
-            self.leg_vect[leg_nr] = numpy.array(leg_vec)
-            self.front_vect[leg_nr] = self.leg_vect[leg_nr] - self.segm_leg_ant[leg_nr]
-            # Construction of all foot vectors - the ones to legs in the air are not used!
-            for i in range(0, leg_nr):
-                self.footdiag[leg_nr][i] = self.set_up_foot_diag(leg_nr, i)
-            for i in range(leg_nr + 1, 6):
-                self.footdiag[i][leg_nr] = self.set_up_foot_diag(i, leg_nr)
+            with self.lock:
+                # Set leg and diag vector
+                self.leg_vect[leg_nr] = numpy.array(leg_vec)
+                self.front_vect[leg_nr] = self.leg_vect[leg_nr] - self.segm_leg_ant[leg_nr]
+                # Construction of all foot vectors - the ones to legs in the air are not used!
+                for i in range(0, leg_nr):
+                    self.footdiag[leg_nr][i] = self.set_up_foot_diag(leg_nr, i)
+                for i in range(leg_nr + 1, 6):
+                    self.footdiag[i][leg_nr] = self.set_up_foot_diag(i, leg_nr)
             self.gc[leg_nr] = True
 
     ##	Update the current state of the legs.
@@ -390,123 +638,6 @@ class mmcBodyModelStance:
     """ **** Computation of the MMC equations *******************************************
     """
 
-    ##	Compute the leg vectors: For all standing legs
-    #	the new leg vectors are computed, summed and the mean is calculated
-    #	(the old value is also integrated, weighted by the damping value)
-    def compute_leg_computations_and_integrate(self, leg_nr):
-        equation_counter = 1
-        # segm_leg_vect = -self.delta_back[leg_nr // 2] + self.segm_leg_post[leg_nr] + self.segm_post_ant[leg_nr // 2] + \
-        #                self.front_vect[leg_nr]  # 3 segments
-        segm_leg_vect = -self.delta_back + self.segm_leg_post[leg_nr] + self.segm_post_ant + \
-                        self.front_vect[leg_nr]
-        segm_leg_vect += self.damping * self.leg_vect[leg_nr]
-        equation_counter += self.damping
-        for target_leg in range(0, len(self.gc)):
-            if self.gc[target_leg] and target_leg != leg_nr:
-                part_vec = numpy.array(self.leg_vect[target_leg]) + self.get_segm_vectors_between_legs(leg_nr,
-                        target_leg)
-                if target_leg < leg_nr:
-                    part_vec -= self.footdiag[leg_nr][target_leg]
-                elif target_leg > leg_nr:
-                    part_vec += self.footdiag[target_leg][leg_nr]
-                segm_leg_vect += part_vec
-                equation_counter += 1
-        return (segm_leg_vect / equation_counter)
-
-    ##	Compute the front vectors: For all standing legs
-    #	the new front vectors are computed, summed and the mean is calculated
-    #	(the old value is also integrated, weighted by the damping value)
-    def compute_front_computations_and_integrate(self, leg_nr):
-        # rospy.loginfo("compute_front_computations_and_integrate: " + RSTATIC.leg_names[leg_nr])
-        equation_counter = 1
-        # new_front_vect = -self.delta_front[leg_nr // 2] - self.segm_post_ant[leg_nr // 2] + self.leg_vect[leg_nr] - \
-        #                 self.segm_leg_post[leg_nr]  # 3 segments
-        new_front_vect = -self.delta_front - self.segm_post_ant + self.leg_vect[leg_nr] - \
-                         self.segm_leg_post[leg_nr]
-        new_front_vect += self.damping * self.front_vect[leg_nr]
-        equation_counter += self.damping
-        # Computations of connections between legs in ground contacts
-        # Compute equations to all other standing legs using the footdiag
-        for target_leg in range(0, len(self.gc)):
-            if self.gc[target_leg] and target_leg != leg_nr:
-                part_vec = numpy.array(
-                        self.front_vect[target_leg])  # + self.get_segm_vectors_between_front(leg_nr, target_leg)
-                if target_leg < leg_nr:
-                    part_vec -= self.footdiag[leg_nr][target_leg]
-                elif target_leg > leg_nr:
-                    part_vec += self.footdiag[target_leg][leg_nr]
-                new_front_vect += part_vec
-                equation_counter += 1
-        return (new_front_vect / equation_counter)
-
-    ##	Compute the segment vectors:
-    #	Using equations including the two legs connected to the segment,
-    #	integrating the explicit displacement given as delta
-    #	and the recurrent old value of the vector.
-    def compute_segment_leg_ant_computations_and_integrate(self, leg_nr):
-        # rospy.loginfo("compute_segment_leg_ant_computations_and_integrate: " + RSTATIC.leg_names[leg_nr])
-        equation_counter = 1
-        # new_segm_leg_ant = self.segm_leg_post[leg_nr] + self.segm_post_ant[leg_nr // 2]
-        new_segm_leg_ant = self.segm_leg_post[leg_nr] + self.segm_post_ant
-        # Neighboring leg with respect to leg_nr
-        new_segm_leg_ant += self.segm_leg_ant[leg_nr] * self.damping
-        equation_counter += self.damping
-        new_segm_leg_ant = new_segm_leg_ant / equation_counter
-        return ((self.segm_leg_ant_norm[leg_nr] / numpy.linalg.norm(new_segm_leg_ant)) * new_segm_leg_ant)
-
-    ##	Compute the segment vectors:
-    #	Using equations including the two legs connected to the segment,
-    #	integrating the explicit displacement given as delta
-    #	and the recurrent old value of the vector.
-    def compute_segment_leg_post_computations_and_integrate(self, leg_nr):
-        # rospy.loginfo("compute_segment_leg_post_computations_and_integrate: " + RSTATIC.leg_names[leg_nr])
-        equation_counter = 1
-        # new_segm_leg_post = self.segm_leg_ant[leg_nr] - self.segm_post_ant[leg_nr // 2]
-        new_segm_leg_post = self.segm_leg_ant[leg_nr] - self.segm_post_ant
-        new_segm_leg_post += self.segm_leg_post[leg_nr] * self.damping
-        equation_counter += self.damping
-        new_segm_leg_post = new_segm_leg_post / equation_counter
-        return ((self.segm_leg_post_norm[leg_nr] / numpy.linalg.norm(new_segm_leg_post)) * new_segm_leg_post)
-
-    ##	Compute the segment vectors:
-    #	Using equations including the two legs connected to the segment,
-    #	integrating the explicit displacement given as delta
-    #	and the recurrent old value of the vector.
-    def compute_segm_post_ant_computations_and_integrate(self, seg_nr):
-        # rospy.loginfo("compute_segm_post_ant_computations_and_integrate: segment nr = " + str(seg_nr))
-        if seg_nr != 0:
-            rospy.logerr("segment nr is " + str(seg_nr) + " but only 1 segment exists")
-        equation_counter = 7
-        new_segm_post_ant = self.segm_post_ant + self.delta_front - self.delta_back
-        new_segm_post_ant += -self.segm_leg_post[0] + self.segm_diag_to_right[seg_nr] + self.segm_leg_ant[1]
-        new_segm_post_ant += -self.segm_leg_post[1] - self.segm_diag_to_right[seg_nr] + self.segm_leg_ant[0]
-        new_segm_post_ant += -self.segm_leg_post[2] + self.segm_diag_to_right[seg_nr] + self.segm_leg_ant[3]
-        new_segm_post_ant += -self.segm_leg_post[3] - self.segm_diag_to_right[seg_nr] + self.segm_leg_ant[2]
-        new_segm_post_ant += -self.segm_leg_post[4] + self.segm_diag_to_right[seg_nr] + self.segm_leg_ant[5]
-        new_segm_post_ant += -self.segm_leg_post[5] - self.segm_diag_to_right[seg_nr] + self.segm_leg_ant[4]
-
-        new_segm_post_ant += self.damping * self.segm_post_ant
-        equation_counter += self.damping
-
-        new_segm_div = new_segm_post_ant / equation_counter
-        return ((self.segm_post_ant_norm / numpy.linalg.norm(new_segm_div)) * new_segm_div)
-
-    ##	Compute the segment vectors:
-    #	Using equations including the two legs connected to the segment,
-    #	integrating the explicit displacement given as delta
-    #	and the recurrent old value of the vector.
-    def compute_segm_diag_computations_and_integrate(self, joint_nr):
-        # rospy.loginfo("compute_segm_diag_computations_and_integrate: joint_nr = " + str(joint_nr))
-        equation_counter = 2
-
-        new_segm_diag = self.segm_leg_post[2 * joint_nr] + self.segm_post_ant - self.segm_leg_ant[1 + joint_nr * 2]
-        new_segm_diag -= self.segm_leg_post[1 + 2 * joint_nr] + self.segm_post_ant - self.segm_leg_ant[joint_nr * 2]
-
-        new_segm_diag += self.damping * self.segm_diag_to_right[joint_nr]
-        equation_counter += self.damping
-        new_segm_diag = new_segm_diag / equation_counter
-        return ((self.segm_diag_norm[joint_nr] / numpy.linalg.norm(new_segm_diag)) * new_segm_diag)
-
     ##	The MMC Method:
     #	- the multiple computations are computed for each variable
     #	- the mean for each variable is calculated
@@ -515,34 +646,101 @@ class mmcBodyModelStance:
     #	different equations.
     ##
     def mmc_iteration_step(self):
-        rospy.loginfo(
+        log.loginfo(
                 "mmc_iteration_step: pull_front = " + str(self.pull_front) + " pull_back = " + str(self.pull_back))
-        self.delta_front = self.pull_front
-        self.delta_back = self.pull_back
-
-        front_vect = [self.compute_front_computations_and_integrate(i) for i in range(0, 6)]
-        leg_vect = [self.compute_leg_computations_and_integrate(i) for i in range(0, 6)]
-        segm_leg_ant = [self.compute_segment_leg_ant_computations_and_integrate(i) for i in range(0, 6)]
-        segm_leg_post = [self.compute_segment_leg_post_computations_and_integrate(i) for i in range(0, 6)]
-        segm_post_ant = self.compute_segm_post_ant_computations_and_integrate(0)
-        segm_diag_to_right = [self.compute_segm_diag_computations_and_integrate(i) for i in range(0, 3)]
-        for i in range(0, 6):
-            self.segm_leg_ant[i] = segm_leg_ant[i]
-            self.segm_leg_post[i] = segm_leg_post[i]
-            self.front_vect[i] = front_vect[i]
-            self.leg_vect[i] = leg_vect[i]
-        # self.pub_relative_vecs(self.c1_positions, self.segm_leg_ant, self.segm_leg_ant_lines)
-        # self.pub_relative_vecs(self.c1_positions, self.segm_leg_post, self.segm_leg_post_lines)
-        # self.pub_vecs([0.12, 0.0, 0.0], self.front_vect, self.front_lines)
-        # self.pub_relative_vecs(self.c1_positions, self.leg_vect, self.leg_lines)
-        self.segm_diag_to_right[0] = segm_diag_to_right[0]
-        # self.pub_relative_vecs([self.c1_positions[i * 2] for i in range(0, len(self.c1_positions) // 2)],
-        #    self.segm_diag_to_right, self.segm_diag_to_right_lines)
-        self.segm_post_ant = segm_post_ant
-        # self.pub_vecs([-0.12, 0.0, 0.0], [self.segm_post_ant], self.segm_line)
+        self.delta_front[:] = self.pull_front
+        self.delta_back[:] = self.pull_back
+
+        # the footdiags and the disturbance vectors are inputs of the product, so the matrix only depends on the
+        # ground contacts and the damping
+        gc = tuple(self.gc)
+        matrix = self.connection_matrices.get(gc)
+        if matrix is None:
+            matrix = self.connection_matrices[gc] = connection_matrix(gc, self.damping)
+        new_vectors = matrix.dot(self.vectors)
+        # segment vectors keep their lengths: segm_leg_ant, segm_leg_post, segm_post_ant and the first diagonal
+        segments = new_vectors[SEGM_LEG_ANT_ROWS.start:SEGM_DIAG_ROWS.start + 1]
+        segments *= (self.segm_norms / numpy.sqrt(numpy.einsum('ij,ij->i', segments, segments)))[:, None]
+        with self.lock:
+            self.vectors[0:STATE_ROWS] = new_vectors
 
         self.step += 1
 
+    """ **** History and recovery *********************************************************
+    """
+
+    ##	Called by the stance movement of a leg when the inverse kinematics for its leg vector failed.
+    def report_ik_failure(self, leg_nr):
+        if self.defer_updates:
+            self.pending_ik_failures[leg_nr] = True
+        else:
+            self.ik_failure[leg_nr] = True
+
+    ##	Apply the updates that were stored while defer_updates was set, in the order of the legs (the same order
+    #	as in the sequential execution).
+    def apply_deferred_updates(self):
+        defer_updates, self.defer_updates = self.defer_updates, False
+        for leg_nr in range(0, 6):
+            if self.pending_leg_vectors[leg_nr] is not None:
+                self.put_leg_on_ground(RSTATIC.leg_names[leg_nr], self.pending_leg_vectors[leg_nr])
+                self.pending_leg_vectors[leg_nr] = None
+            if self.pending_ik_failures[leg_nr]:
+                self.report_ik_failure(leg_nr)
+                self.pending_ik_failures[leg_nr] = False
+        self.defer_updates = defer_updates
+
+    ##	Called once per cycle before the ground contacts are updated. Stores the state of the last
+    #	iteration if all stance legs could follow it, otherwise recovers from the last consistent state.
+    def update_history(self):
+        if self.history is None:
+            return
+        if any(self.ik_failure):
+            self.recover()
+        else:
+            self.history.store(self)
+
+    ##	Restore the vectors of the newest consistent state (the ground contacts are kept).
+    #	Returns False if there is no stored state.
+    def rollback(self):
+        state = self.history.latest() if self.history is not None else None
+        if state is None:
+            return False
+        self.front_vect[:] = state['front_vect']
+        self.leg_vect[:] = state['leg_vect']
+        self.segm_leg_ant[:] = state['segm_leg_ant']
+        self.segm_leg_post[:] = state['segm_leg_post']
+        self.segm_post_ant[:] = state['segm_post_ant']
+        self.segm_diag_to_right[:] = state['segm_diag_to_right']
+        self.footdiag[:] = state['footdiag']
+        return True
+
+    ##	Set the leg vectors of the standing legs to the measured foot positions (forward kinematics of the
+    #	current joint angles of all legs in one batch) and establish the footdiags between them again.
+    def resynchronize(self):
+        angles = [leg.leg.get_current_angles() for leg in self.robot.legs]
+        standing = [leg_nr for leg_nr in range(0, 6) if self.gc[leg_nr] and angles[leg_nr] is not None]
+        if not standing:
+            return
+        transforms = numpy.array([RSTATIC.body_c1_tf[leg_nr] for leg_nr in standing])
+        feet = forward_kinematics([angles[leg_nr] for leg_nr in standing], transforms)
+        for leg_nr, foot, transform in zip(standing, feet, transforms):
+            self.leg_vect[leg_nr] = foot - transform[0:3, 3]
+            self.front_vect[leg_nr] = self.leg_vect[leg_nr] - self.segm_leg_ant[leg_nr]
+        for i in range(1, 6):
+            for j in range(0, i):
+                self.footdiag[i][j] = self.set_up_foot_diag(i, j)
+
+    def recover(self):
+        failed = [RSTATIC.leg_names[leg_nr] for leg_nr in range(0, 6) if self.ik_failure[leg_nr]]
+        with self.lock:
+            rolled_back = self.rollback()
+            self.resynchronize()
+        self.ik_failure = [False, False, False, False, False, False]
+        self.recoveries += 1
+        log.logwarn("body model recovery after failed inverse kinematics of " + str(failed) + ": " +
+                    ("rolled back to step " + str(self.history.latest()['step']) if rolled_back else
+                     "no consistent state stored") + ", re-synchronized with the measured foot positions")
+
     """ **** Get, set methods - connection to the robot simulator ***********************
     """
 
@@ -550,7 +748,7 @@ class mmcBodyModelStance:
     #	segment. Takes an angle (0 os straight ahead) and a velocity factor
     #	(around 0.1-0.2 should be fine) to come up with a corresponding pull vector.
     def pullBodyModelAtFrontIntoRelativeDirection(self, pull_angle, speed_fact):
-        rospy.loginfo(
+        log.loginfo(
                 "pullBodyModelAtFrontIntoRelativeDirection: angle = " + str(pull_angle) + " speed = " + str(speed_fact))
         pull_angle_BM = pull_angle + math.atan2(self.segm_post_ant[1], self.segm_post_ant[0])
         self.pull_front[0] = speed_fact * math.cos(pull_angle_BM)  # pull x
@@ -561,7 +759,7 @@ class mmcBodyModelStance:
     #	(around 0.1 - positive means backwards walking!)
     #	to come up with a corresponding pull vector.
     def pullBodyModelAtBackIntoRelativeDirection(self, pull_angle, speed_fact):
-        rospy.loginfo(
+        log.loginfo(
                 "pullBodyModelAtBackIntoRelativeDirection: angle = " + str(pull_angle) + " speed = " + str(speed_fact))
         # pull_angle_BM = pull_angle + math.atan2(-self.segm_post_ant[2][1], -self.segm_post_ant[2][0]) -- 3 segments
         pull_angle_BM = pull_angle + math.atan2(-self.segm_post_ant[1], -self.segm_post_ant[0])
@@ -571,7 +769,10 @@ class mmcBodyModelStance:
     def get_leg_vector(self, leg_name):
         # rospy.loginfo("get_leg_vector: " + leg_name)
         leg_nr = RSTATIC.leg_names.index(leg_name)
-        target_vec_wn = [self.leg_vect[leg_nr][0], self.leg_vect[leg_nr][1], self.leg_vect[leg_nr][2], 0]
+        # a leg that was put on the ground in this cycle of the threaded execution reads its new vector
+        leg_vect = self.leg_vect[leg_nr] if self.pending_leg_vectors[leg_nr] is None else \
+            self.pending_leg_vectors[leg_nr]
+        target_vec_wn = [leg_vect[0], leg_vect[1], leg_vect[2], 0]
         return target_vec_wn
 
     def get_ground_contact(self, leg_nr):
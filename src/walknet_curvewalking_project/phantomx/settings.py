@@ -0,0 +1,241 @@
+import threading
+import weakref
+
+import numpy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+import walknet_curvewalking_project.support.constants as CONST
+from walknet_curvewalking_project.support import log
+
+
+##
+#   A typed setting that is stored as attribute of a settings module (RobotSettings or constants), so the
+#   modules keep being the place where the current values are read.
+#   value_type is bool, int, float, str or 'vector' (sequence of floats with the given length).
+#   runtime: False if changes only take effect when the node is restarted.
+class Setting:
+    def __init__(self, name, value_type, module=RSTATIC, attribute=None, choices=None, optional=False, length=3,
+                 runtime=True):
+        self.name = name
+        self.value_type = value_type
+        self.module = module
+        self.attribute = attribute or name
+        self.choices = choices
+        self.optional = optional
+        self.length = length
+        self.runtime = runtime
+
+    def get(self):
+        return getattr(self.module, self.attribute)
+
+    def set(self, value):
+        setattr(self.module, self.attribute, value)
+
+    # Returns the value converted to the type of the setting, raises a ValueError for invalid values.
+    def convert(self, value):
+        if value is None and self.optional:
+            return None
+        if self.value_type == 'vector':
+            converted = numpy.array(value, dtype=float)
+            if converted.shape != (self.length,):
+                raise ValueError(self.name + ' needs ' + str(self.length) + ' values, got ' + str(value))
+            return converted
+        if self.value_type is bool:
+            if not isinstance(value, bool):
+                raise ValueError(self.name + ' needs a boolean value, got ' + str(value))
+            return value
+        if self.value_type is int:
+            if isinstance(value, bool) or int(value) != value:
+                raise ValueError(self.name + ' needs an integer value, got ' + str(value))
+            converted = int(value)
+        elif self.value_type is float:
+            if isinstance(value, bool):
+                raise ValueError(self.name + ' needs a number, got ' + str(value))
+            converted = float(value)
+        else:
+            converted = self.value_type(value)
+        if self.choices is not None and converted not in self.choices:
+            raise ValueError(self.name + ' must be one of ' + str(self.choices) + ', got ' + str(value))
+        return converted
+
+    def equal(self, a, b):
+        if self.value_type == 'vector' and a is not None and b is not None:
+            return numpy.array_equal(a, b)
+        return a == b
+
+
+RATES = ('controller_frequency', 'body_model_frequency')
+STANCE_GEOMETRY = ('default_stance_distance', 'stance_height', 'default_stance_width')
+IK_CACHE = ('ik_cache_size', 'ik_cache_resolution', 'ik_cache_mode')
+SWING_MOVEMENT = ('swing_mode', 'swing_velocity', 'apex_point_offset', 'evasion_templates', 'evasion_template_ratios',
+                  'evasion_template_heights', 'evasion_template_max_height')
+
+DEFINITIONS = [
+    Setting('controller_frequency', float, runtime=False),
+    Setting('joint_command_frequency', float, runtime=False),
+    Setting('body_model_frequency', float, attribute='configured_body_model_frequency', optional=True, runtime=False),
+    Setting('visualization_frequency', float, runtime=False),
+    Setting('parallel_leg_mode', str, choices=('thread', 'process'), runtime=False),
+    Setting('parallel_leg_workers', int, runtime=False),
+    Setting('swing_mode', str, choices=('bezier', 'joint_spline')),
+    Setting('evasion_templates', bool),
+    Setting('evasion_template_ratios', int),
+    Setting('evasion_template_heights', int),
+    Setting('evasion_template_max_height', float),
+    Setting('evasion_template_tolerance', float),
+    Setting('evasion_template_max_tilt', float),
+    Setting('stance_ik_mode', str, choices=('analytic', 'differential')),
+    Setting('stance_resync_distance', float),
+    Setting('differential_ik_damping', float),
+    # building the workspace index takes seconds, it is only loaded at start-up
+    Setting('workspace_clamping', bool, runtime=False),
+    Setting('workspace_resolution', float, runtime=False),
+    Setting('ik_cache_size', int),
+    Setting('ik_cache_resolution', float),
+    Setting('ik_cache_mode', str, choices=('exact', 'interpolate')),
+    Setting('state_wait_log_period', float),
+    Setting('init_pos_resend_period', float),
+    Setting('init_pos_timeout', float, optional=True),
+    Setting('parameter_update_period', float, runtime=False),
+    Setting('telemetry_directory', str, optional=True, runtime=False),
+    Setting('telemetry_chunk_size', int, runtime=False),
+    Setting('telemetry_buffers', int, runtime=False),
+    Setting('latency_trace_size', int, runtime=False),
+    Setting('latency_diagnostics_period', float, runtime=False),
+    Setting('latency_warning_threshold', float),
+    Setting('default_stance_distance', float),
+    Setting('stance_height', float),
+    Setting('default_stance_width', float),
+    Setting('predicted_ground_contact_height_factor', float),
+    Setting('ground_contact_mode', str, choices=('estimator', 'prediction')),
+    Setting('ground_contact_filter_time', float),
+    Setting('ground_contact_error_threshold', float),
+    Setting('ground_contact_speed_threshold', float),
+    Setting('stability_gating', bool),
+    Setting('stability_min_margin', float),
+    Setting('stability_max_pep_overshoot', float),
+    Setting('center_of_mass', 'vector'),
+    Setting('damping', float, attribute='body_model_damping'),
+    Setting('body_model_history_size', int, runtime=False),
+    Setting('swing_velocity', float, CONST, 'DEFAULT_SWING_VELOCITY'),
+    Setting('stance_velocity', float, CONST, 'DEFAULT_STANCE_VELOCITY'),
+    Setting('apex_thigh_offset', float, CONST, 'DEFAULT_APEX_THIGH_OFFSET'),
+    Setting('apex_point_offset', 'vector', CONST, 'DEFAULT_APEX_POINT_OFFSET')]
+
+
+##
+#   The settings of the controller. Values are validated and converted to their types before anything is changed, so
+#   an update is applied completely or not at all. Derived values (e.g. the AEPs and PEPs) are recomputed when one of
+#   their inputs changed, then the subscribers of the changed settings are notified (e.g. to rebuild caches).
+#   Updates from other threads (e.g. the ROS parameter polling) are requested with request_update and applied by the
+#   control loop between two ticks with apply_pending. Changes of settings that only take effect after a restart
+#   (runtime=False) are rejected by apply_pending, they can only be set at start-up with update and load_yaml.
+class Settings:
+    def __init__(self, definitions):
+        self.definitions = {definition.name: definition for definition in definitions}
+        self.lock = threading.RLock()
+        self.derived = []
+        self.subscribers = []
+        self.pending = {}
+        # rejected restart-only values, to log each rejected value only once
+        self.rejected = {}
+
+    def get(self, name):
+        return self.definitions[name].get()
+
+    def as_dict(self):
+        return {name: definition.get() for name, definition in self.definitions.items()}
+
+    # Recompute function() whenever one of the settings in inputs changed.
+    def add_derived(self, inputs, function):
+        self.derived.append((frozenset(inputs), function))
+
+    # Call callback(changed names) after one of the settings in names changed. Bound methods are referenced weakly,
+    # so the subscription ends with the lifetime of the object.
+    def subscribe(self, names, callback):
+        if hasattr(callback, '__self__'):
+            reference = weakref.WeakMethod(callback)
+        else:
+            reference = lambda: callback
+        with self.lock:
+            self.subscribers.append((frozenset(names), reference))
+
+    # Validated and converted values. Unknown names raise a ValueError unless ignore_unknown is set.
+    def convert(self, values, ignore_unknown=False):
+        converted = {}
+        for name, value in values.items():
+            if name not in self.definitions:
+                if ignore_unknown:
+                    continue
+                raise ValueError('unknown setting ' + str(name))
+            converted[name] = self.definitions[name].convert(value)
+        return converted
+
+    # Apply the values at once. Returns the names of the changed settings. If runtime is set, changes of the settings
+    # that only take effect after a restart are rejected (logged) and the other values are applied.
+    def update(self, values, ignore_unknown=False, runtime=False):
+        converted = self.convert(values, ignore_unknown)
+        with self.lock:
+            changed = set(name for name, value in converted.items() if
+                          not self.definitions[name].equal(self.definitions[name].get(), value))
+            if runtime:
+                changed = self.reject_restart_required(changed, converted)
+            if not changed:
+                return changed
+            for name in changed:
+                self.definitions[name].set(converted[name])
+            for inputs, function in self.derived:
+                if inputs & changed:
+                    function()
+            self.notify(changed)
+        return changed
+
+    # The changed names without the restart-only settings, which are logged the first time they are rejected with a
+    # value.
+    def reject_restart_required(self, changed, values):
+        accepted = set()
+        for name in changed:
+            definition = self.definitions[name]
+            if definition.runtime:
+                accepted.add(name)
+                continue
+            if name not in self.rejected or not definition.equal(self.rejected[name], values[name]):
+                log.logwarn("setting " + name + " can only be changed at start-up, ignoring " + str(values[name]))
+            self.rejected[name] = values[name]
+        return accepted
+
+    def notify(self, changed):
+        alive = []
+        for names, reference in self.subscribers:
+            callback = reference()
+            if callback is None:
+                continue
+            alive.append((names, reference))
+            if names & changed:
+                callback(changed)
+        self.subscribers = alive
+
+    # Validate the values now and apply them with the next apply_pending (values of earlier requests are merged).
+    def request_update(self, values, ignore_unknown=False):
+        converted = self.convert(values, ignore_unknown)
+        with self.lock:
+            self.pending.update(converted)
+
+    def apply_pending(self):
+        if not self.pending:
+            return set()
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            return self.update(pending, runtime=True)
+
+    def load_yaml(self, path, ignore_unknown=False):
+        # PyYAML is only needed for settings files
+        import yaml
+        with open(path) as file:
+            return self.update(yaml.safe_load(file) or {}, ignore_unknown)
+
+
+settings = Settings(DEFINITIONS)
+settings.add_derived(RATES, RSTATIC.update_rates)
+settings.add_derived(STANCE_GEOMETRY, RSTATIC.update_stance_geometry)
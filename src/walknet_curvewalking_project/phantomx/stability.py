@@ -0,0 +1,90 @@
+import threading
+
+import numpy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+
+# tolerance of the side tests of the support polygon (m), feet on the line of an edge belong to the polygon
+SIDE_TOLERANCE = 1e-9
+
+
+# Stability margins of the support polygons of stance feet: the signed distance of the center (x, y) to the boundary of
+# the convex hull of the feet of each stance set (rows of the boolean (..., sets, n) array), negative if the center is
+# outside of the polygon and -inf for less than three feet. feet are the (..., n, 2) positions of the feet projected
+# onto the ground, the leading dimensions (e.g. of a batch of robots) are broadcast.
+# An ordered pair of feet (i, j) is a counterclockwise edge of the convex hull of a set when no foot of the set lies on
+# the right of the line from i to j. The side tests of all pairs with all feet are one (n * n, n) array that is shared
+# by all sets (a boolean matrix product with the sets), so the margins of many sets cost about as much as the margin of
+# one.
+def support_margins(feet, stance_sets, center):
+    count = feet.shape[-2]
+    edges_x = feet[..., None, :, 0] - feet[..., :, None, 0]
+    edges_y = feet[..., None, :, 1] - feet[..., :, None, 1]
+    lengths = numpy.hypot(edges_x, edges_y)
+    # right[..., i, j, m]: foot m is on the right of the line from foot i to foot j
+    right = edges_x[..., :, :, None] * edges_y[..., :, None, :] - edges_y[..., :, :, None] * edges_x[..., :, None, :] \
+        < -SIDE_TOLERANCE * lengths[..., None]
+    to_center = numpy.asarray(center)[..., None, :] - feet
+    distances = (edges_x * to_center[..., :, None, 1] - edges_y * to_center[..., :, None, 0]) / numpy.maximum(
+        lengths, SIDE_TOLERANCE)
+    pairs = stance_sets[..., :, :, None] & stance_sets[..., :, None, :]
+    violated = numpy.matmul(right.reshape(right.shape[:-3] + (count * count, count)),
+                            numpy.swapaxes(stance_sets, -1, -2))
+    is_edge = pairs.reshape(pairs.shape[:-2] + (count * count,)) & ~numpy.swapaxes(violated, -1, -2) & \
+        (lengths > SIDE_TOLERANCE).reshape(lengths.shape[:-2] + (1, count * count))
+    margins = numpy.where(is_edge, distances.reshape(distances.shape[:-2] + (1, count * count)), numpy.inf).min(axis=-1)
+    margins[stance_sets.sum(axis=-1) < 3] = -numpy.inf
+    return margins
+
+
+##
+#   Static stability of the robot, updated once per control tick from the foot positions and the stance legs. margin
+#   is the stability margin of the current support polygon (see support_margins) for the projection of the center of
+#   mass (center_of_mass in body coordinates) and lift_margins the margins if one leg was lifted, for all legs at once
+#   (the margin of a swing leg is the current margin). Both are computed in one batch by update, so the query of a
+#   leg (can_lift) is a lookup.
+#   Legs that start a swing are registered with request_lift, which updates the margins for the legs that are
+#   decided later in the same tick. The requests of the threaded leg execution are serialized by a lock (which of two
+#   legs that reach their PEPs in the same tick is lifted first depends on the timing of the threads).
+class StabilityMonitor:
+    def __init__(self, leg_count):
+        self.leg_count = leg_count
+        self.stance_sets = numpy.ones((leg_count + 1, leg_count), dtype=bool)
+        # the sets of the current stance legs without one of the legs
+        self.without_leg = ~numpy.eye(leg_count, dtype=bool)
+        self.feet = numpy.full((leg_count, 2), numpy.nan)
+        self.stance = numpy.zeros(leg_count, dtype=bool)
+        self.margin = -numpy.inf
+        self.lift_margins = numpy.full(leg_count, -numpy.inf)
+        self.lock = threading.Lock()
+
+    # One update with the (n, 3) foot positions in body coordinates (rows with nan for legs without joint states) and
+    # the stance legs (boolean array).
+    def update(self, feet, stance):
+        feet = numpy.asarray(feet, dtype=float)[:, 0:2]
+        with self.lock:
+            self.feet = feet
+            self.stance = numpy.asarray(stance, dtype=bool) & ~numpy.isnan(feet[:, 0])
+            self.compute_margins()
+
+    def compute_margins(self):
+        self.stance_sets[0] = self.stance
+        self.stance_sets[1:] = self.stance & self.without_leg
+        margins = support_margins(self.feet, self.stance_sets, numpy.asarray(RSTATIC.center_of_mass[0:2]))
+        self.margin = margins[0]
+        self.lift_margins = margins[1:]
+
+    # True if the margin stays at least stability_min_margin when the leg is lifted (or the gating is disabled).
+    def can_lift(self, leg_nr):
+        return not RSTATIC.stability_gating or self.lift_margins[leg_nr] >= RSTATIC.stability_min_margin
+
+    # Register the start of a swing of the leg if it can be lifted (or force is set). Returns False if the leg has to
+    # stay on the ground.
+    def request_lift(self, leg_nr, force=False):
+        with self.lock:
+            if not force and not self.can_lift(leg_nr):
+                return False
+            if self.stance[leg_nr]:
+                self.stance[leg_nr] = False
+                self.compute_margins()
+            return True
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+import argparse
+import itertools
+import os
+from math import floor
+
+import numpy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+from walknet_curvewalking_project.phantomx.leg_kinematics import forward_kinematics, joint_space_grid, \
+    static_transform
+from walknet_curvewalking_project.support import log
+
+DEFAULT_INDEX_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workspace_index')
+# samples per joint (alpha, beta, gamma) of the joint space grid that is used to build the index
+WORKSPACE_JOINT_SAMPLES = (64, 160, 128)
+# coarser index that is built at start-up when no precomputed index exists (factor of the resolution, samples)
+FALLBACK_RESOLUTION_FACTOR = 2
+FALLBACK_JOINT_SAMPLES = (32, 80, 64)
+# number of unreachable voxels around the reachable workspace
+MARGIN_VOXELS = 4
+FK_CHUNK_SIZE = 100000
+
+# loaded indices by leg name, shared by all legs (and forked processes)
+loaded_indices = {}
+
+
+##
+#   Reachable workspace of a leg as a voxel grid in the body frame. Every voxel stores the nearest reachable point and
+#   the distance of the voxel center to this point (0 for reachable voxels), so queries are answered by a single
+#   lookup. The grid is built offline from the forward kinematics over the joint angle limits and stored as .npy
+#   files that are memory-mapped when loaded.
+class WorkspaceIndex:
+    def __init__(self, origin, resolution, nearest):
+        self.origin = numpy.asarray(origin, dtype=float)
+        self.resolution = float(resolution)
+        # (nx, ny, nz, 4): nearest reachable point and distance
+        self.nearest = nearest
+        self.upper = [size - 1 for size in nearest.shape[0:3]]
+
+    # Index of the voxel containing p (clipped to the grid) and whether p lies inside the grid.
+    def voxel(self, p):
+        cell = []
+        inside = True
+        for i in range(3):
+            c = int(floor((p[i] - self.origin[i]) / self.resolution))
+            if c < 0 or c > self.upper[i]:
+                inside = False
+                c = min(max(c, 0), self.upper[i])
+            cell.append(c)
+        return tuple(cell), inside
+
+    def is_reachable(self, p):
+        cell, inside = self.voxel(p)
+        return inside and self.nearest[cell][3] == 0
+
+    # Returns p if it is reachable, otherwise the nearest reachable point (with the resolution of the grid).
+    def nearest_reachable_point(self, p):
+        cell, inside = self.voxel(p)
+        entry = self.nearest[cell]
+        if inside and entry[3] == 0:
+            return numpy.array(p[0:3], dtype=float)
+        return numpy.array(entry[0:3], dtype=float)
+
+    def save(self, directory, leg_name):
+        os.makedirs(directory, exist_ok=True)
+        numpy.save(os.path.join(directory, leg_name + '_workspace.npy'), self.nearest)
+        numpy.save(os.path.join(directory, leg_name + '_workspace_grid.npy'),
+                numpy.append(self.origin, self.resolution))
+
+
+# result[x] = array[x - offset], cells that are shifted in from outside are set to fill.
+def shift(array, offset, fill):
+    result = numpy.full_like(array, fill)
+    if any(abs(o) >= size for o, size in zip(offset, array.shape)):
+        return result
+    destination = tuple(slice(max(o, 0), size + min(o, 0)) for o, size in zip(offset, array.shape))
+    source = tuple(slice(max(-o, 0), size + min(-o, 0)) for o, size in zip(offset, array.shape))
+    result[destination] = array[source]
+    return result
+
+
+# Jump flooding: propagate the index of the nearest seed (seed_points) to every voxel of the grid.
+# seeds contains the index of the seed in the voxel or -1. Returns the indices and the distances.
+def jump_flood(seeds, seed_points, centers):
+    # the index -1 (no seed) selects a point at infinity
+    seed_points = numpy.vstack([seed_points, numpy.full((1, 3), numpy.inf)])
+
+    def squared_distances(indices):
+        delta = centers - seed_points[indices]
+        return numpy.einsum('...i,...i->...', delta, delta)
+
+    nearest = seeds.copy()
+    distances = squared_distances(nearest)
+    step = 1 << int(numpy.ceil(numpy.log2(max(seeds.shape))))
+    steps = []
+    while step > 1:
+        step //= 2
+        steps.append(step)
+    # additional pass with step 1 reduces the errors of the approximation
+    for step in steps + [1]:
+        for offset in itertools.product((-step, 0, step), repeat=3):
+            if offset == (0, 0, 0):
+                continue
+            candidates = shift(nearest, offset, -1)
+            candidate_distances = squared_distances(candidates)
+            better = candidate_distances < distances
+            numpy.copyto(nearest, candidates, where=better)
+            numpy.copyto(distances, candidate_distances, where=better)
+    return nearest, numpy.sqrt(distances)
+
+
+def build_workspace_index(leg_name, resolution=RSTATIC.workspace_resolution, samples=WORKSPACE_JOINT_SAMPLES):
+    angles = joint_space_grid(samples)
+    transform = static_transform(leg_name)
+    points = numpy.concatenate([forward_kinematics(chunk, transform)
+                                for chunk in numpy.array_split(angles, max(1, len(angles) // FK_CHUNK_SIZE))])
+    origin = points.min(axis=0) - MARGIN_VOXELS * resolution
+    shape = tuple(numpy.ceil((points.max(axis=0) - origin) / resolution).astype(int) + MARGIN_VOXELS + 1)
+    cells = numpy.floor((points - origin) / resolution).astype(int)
+    flat_cells = numpy.ravel_multi_index(cells.T, shape)
+
+    # reachable voxels are represented by the sample closest to their center
+    grid = numpy.stack(numpy.meshgrid(*[numpy.arange(size) for size in shape], indexing='ij'), axis=-1)
+    centers = origin + (grid + 0.5) * resolution
+    center_distances = numpy.linalg.norm(points - centers.reshape(-1, 3)[flat_cells], axis=1)
+    order = numpy.lexsort((center_distances, flat_cells))
+    first = numpy.concatenate(([True], numpy.diff(flat_cells[order]) != 0))
+    seed_cells = flat_cells[order][first]
+    seed_points = points[order][first]
+
+    seeds = numpy.full(int(numpy.prod(shape)), -1, dtype=numpy.int64)
+    seeds[seed_cells] = numpy.arange(len(seed_cells))
+    nearest, distances = jump_flood(seeds.reshape(shape), seed_points, centers)
+
+    index = numpy.empty(shape + (4,), dtype=numpy.float32)
+    index[..., 0:3] = seed_points[nearest]
+    index[..., 3] = distances
+    index.reshape(-1, 4)[seed_cells, 3] = 0
+    return WorkspaceIndex(origin, resolution, index)
+
+
+# Load the precomputed index of the leg (memory-mapped). If no precomputed index exists, a coarser index is built in
+# memory.
+def load_workspace_index(leg_name, directory=None):
+    if leg_name in loaded_indices:
+        return loaded_indices[leg_name]
+    directory = directory or DEFAULT_INDEX_DIRECTORY
+    index_file = os.path.join(directory, leg_name + '_workspace.npy')
+    grid_file = os.path.join(directory, leg_name + '_workspace_grid.npy')
+    if os.path.exists(index_file) and os.path.exists(grid_file):
+        grid = numpy.load(grid_file)
+        index = WorkspaceIndex(grid[0:3], grid[3], numpy.load(index_file, mmap_mode='r'))
+    else:
+        log.logwarn("no precomputed workspace index for leg " + leg_name + " in " + directory +
+                    ", building a coarse index now. Run workspace_index.py to precompute the index.")
+        index = build_workspace_index(leg_name, FALLBACK_RESOLUTION_FACTOR * RSTATIC.workspace_resolution,
+                FALLBACK_JOINT_SAMPLES)
+    loaded_indices[leg_name] = index
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the reachable workspace index of the legs.')
+    parser.add_argument('--output', default=DEFAULT_INDEX_DIRECTORY, help='directory for the index files')
+    parser.add_argument('--resolution', type=float, default=RSTATIC.workspace_resolution,
+                        help='edge length of the voxels in m')
+    parser.add_argument('--legs', nargs='+', default=list(RSTATIC.leg_names), choices=RSTATIC.leg_names)
+    args = parser.parse_args()
+    for name in args.legs:
+        workspace = build_workspace_index(name, args.resolution)
+        workspace.save(args.output, name)
+        print(name + ": " + str(workspace.nearest.shape[0:3]) + " voxels, " +
+              str(int(numpy.sum(workspace.nearest[..., 3] == 0))) + " reachable")
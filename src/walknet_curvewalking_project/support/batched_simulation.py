@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+import argparse
+import itertools
+import time
+
+import numpy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+import walknet_curvewalking_project.support.constants as CONST
+from walknet_curvewalking_project.phantomx.leg_kinematics import forward_kinematics, inverse_kinematics
+from walknet_curvewalking_project.phantomx.mmcBodyModel3D import DELTA_BACK_ROW, DELTA_FRONT_ROW, FOOTDIAG_ROWS, \
+    FRONT_ROWS, LEG_ROWS, SEGM_DIAG_ROWS, SEGM_LEG_ANT_ROWS, SEGM_LEG_POST_ROWS, SEGM_POST_ANT_ROW, STATE_ROWS, \
+    connection_matrix, mmcBodyModelStance
+from walknet_curvewalking_project.phantomx.stability import support_margins
+
+# segment lengths of the legs (coxa, femur, tibia) as in SingleLegController
+SEGMENT_LENGTHS = (0.054, 0.066, 0.16)
+# legs that start with a swing (see RobotController)
+INITIAL_SWING_LEGS = ('lm', 'rf', 'rr')
+# distance of the foot from the AEP / PEP in x within which the swing / stance ends (see SingleLeg.reached_pep)
+PHASE_END_DISTANCE = 0.025
+# position of the bezier swing apex between the start and the target (see SwingMovementBezier)
+APEX_POINT_RATIO = 0.5
+# search of the next swing target as in TrajectoryGenerator.compute_next_target: relative accuracy of the distance,
+# steps that adapt the parameter step, steps that extend the search interval and bisection steps
+SWING_TARGET_ACCURACY = 1 / 100
+SWING_TARGET_STEPS = 6
+SWING_TARGET_EXTENSIONS = 20
+SWING_TARGET_BISECTIONS = 20
+
+
+# Points of piecewise bezier curves (..., points, 3) at the parameters (..., m), extrapolated outside of [0, 1] like
+# swing_movement_bezier.bezier.
+def bezier_curves(points, parameters, order=2):
+    num_of_segments = (points.shape[-2] - 1) // order
+    segment_numbers = numpy.clip(numpy.floor(parameters * num_of_segments), 0, num_of_segments - 1).astype(int)
+    relative_parameters = (parameters * num_of_segments - segment_numbers)[..., None, None]
+    indices = (segment_numbers[..., None] * order + numpy.arange(order + 1)).reshape(
+        segment_numbers.shape[:-1] + (segment_numbers.shape[-1] * (order + 1),))
+    relevant_points = numpy.take_along_axis(points, indices[..., None], axis=-2).reshape(
+        parameters.shape + (order + 1, 3))
+    while relevant_points.shape[-2] > 1:
+        relevant_points = relevant_points[..., :-1, :] + numpy.diff(relevant_points, axis=-2) * relative_parameters
+    return relevant_points[..., 0, :]
+
+
+# Parameters and points of the curves (n, points, 3) at the desired distance from the feet (n, 3), parameter steps per
+# distance of the next search. The search of TrajectoryGenerator.compute_next_target for all curves: the parameter step
+# of the last search is adapted to the distance, if this does not reach the accuracy the tried parameters bracket the
+# distance (extended from the last targets if none is beyond it) and the bracket is bisected.
+def search_swing_targets(points, current, last_parameters, last_targets, norm_deltas, desired_distance):
+    count = len(current)
+    parameters = last_parameters.copy()
+    curve_points = numpy.zeros((count, 3))
+    norm_deltas = norm_deltas.copy()
+    tried_parameters = numpy.full((count, SWING_TARGET_STEPS + 1), numpy.nan)
+    tried_distances = numpy.full((count, SWING_TARGET_STEPS + 1), numpy.nan)
+    tried_parameters[:, 0] = last_parameters
+    tried_distances[:, 0] = numpy.linalg.norm(last_targets - current, axis=-1)
+    delta_parameters = norm_deltas * desired_distance
+    searching = numpy.arange(count)
+    for step in range(1, SWING_TARGET_STEPS + 1):
+        test_parameters = last_parameters[searching] + delta_parameters[searching]
+        test_points = bezier_curves(points[searching], test_parameters[:, None])[:, 0]
+        distances = numpy.linalg.norm(test_points - current[searching], axis=-1)
+        tried_parameters[searching, step] = test_parameters
+        tried_distances[searching, step] = distances
+        found = numpy.abs(distances - desired_distance) / desired_distance < SWING_TARGET_ACCURACY
+        parameters[searching[found]] = test_parameters[found]
+        curve_points[searching[found]] = test_points[found]
+        delta_parameters[searching] /= distances / desired_distance
+        searching = searching[~found]
+    if len(searching) == 0:
+        return parameters, curve_points, norm_deltas
+
+    points, current = points[searching], current[searching]
+    last_parameters, last_targets = last_parameters[searching], last_targets[searching]
+    closer = last_parameters.copy()
+    further = numpy.full(len(searching), numpy.inf)
+    for step in range(SWING_TARGET_STEPS + 1):
+        tried, distances = tried_parameters[searching, step], tried_distances[searching, step]
+        between = (closer < tried) & (tried < further)
+        closer = numpy.where(between & (distances <= desired_distance), tried, closer)
+        further = numpy.where(between & (distances > desired_distance), tried, further)
+    extending = numpy.isinf(further)
+    further[extending] = closer[extending]
+    for _ in range(SWING_TARGET_EXTENSIONS):
+        if not extending.any():
+            break
+        further[extending] += (further[extending] - last_parameters[extending]) * 2
+        extending[extending] = numpy.linalg.norm(bezier_curves(points[extending], further[extending, None])[:, 0] -
+                                                 last_targets[extending], axis=-1) <= desired_distance
+
+    test_parameters = (closer + further) / 2
+    test_points = numpy.zeros((len(searching), 3))
+    bisecting = numpy.ones(len(searching), dtype=bool)
+    for _ in range(SWING_TARGET_BISECTIONS):
+        test_points[bisecting] = bezier_curves(points[bisecting], test_parameters[bisecting, None])[:, 0]
+        distances = numpy.linalg.norm(test_points - current, axis=-1)
+        bisecting &= numpy.abs(distances - desired_distance) / desired_distance >= SWING_TARGET_ACCURACY
+        if not bisecting.any():
+            break
+        closer = numpy.where(bisecting & (distances < desired_distance), test_parameters, closer)
+        further = numpy.where(bisecting & (distances > desired_distance), test_parameters, further)
+        test_parameters = numpy.where(bisecting, (closer + further) / 2, test_parameters)
+    parameters[searching] = test_parameters
+    curve_points[searching] = test_points
+    norm_deltas[searching] = (test_parameters - last_parameters) / desired_distance
+    return parameters, curve_points, norm_deltas
+
+
+# Rigid 2D transformations (angles, translations) that map the points q onto the points p (..., n, 2) for the points
+# of the mask (..., n), see kinematic_simulation.fit_rigid_transform.
+def fit_rigid_transforms(p, q, mask):
+    weights = mask[..., None] / numpy.maximum(mask.sum(axis=-1), 1)[..., None, None]
+    p_center = (p * weights).sum(axis=-2)
+    q_center = (q * weights).sum(axis=-2)
+    p_centered = (p - p_center[..., None, :]) * mask[..., None]
+    q_centered = (q - q_center[..., None, :]) * mask[..., None]
+    angles = numpy.arctan2(numpy.sum(q_centered[..., 0] * p_centered[..., 1] - q_centered[..., 1] * p_centered[..., 0],
+                                     axis=-1), numpy.sum(q_centered * p_centered, axis=(-2, -1)))
+    cos, sin = numpy.cos(angles), numpy.sin(angles)
+    translations = p_center - numpy.stack([cos * q_center[..., 0] - sin * q_center[..., 1],
+                                           sin * q_center[..., 0] + cos * q_center[..., 1]], axis=-1)
+    return angles, translations
+
+
+##
+#   Kinematic simulation of many robots in one process: the state of all robots is held in arrays with a leading batch
+#   dimension and every control tick is one vectorized step of all of them, without a RobotController per robot. The
+#   step follows the controller of KinematicSimulation (body model, bezier swings, body model stances, PEP / ground
+#   contact coordination and the static stability gating) against a flat ground: the joints reach every command
+#   immediately, a swing ends when the foot is below the predicted ground contact height near the AEP (the
+#   'prediction' rule of SingleLeg.predictedGroundContact) and the body pose is estimated from the feet that stay on the
+#   ground.
+#   Simplifications against the controller: targets are not clamped to the workspace index, the inverse kinematics is
+#   not cached and legs with unreachable targets keep their angles without a body model recovery. The search of the
+#   swing targets follows TrajectoryGenerator step by step: near the apex several points of the curve are within its
+#   accuracy and a different search picks a different one, which changes the touchdowns and the heading.
+#   speed_fact and pull_angle are numbers or arrays with one value per robot. The settings are read when the
+#   simulation is created (damping) or in every step.
+class BatchedSimulation:
+    def __init__(self, count, speed_fact=0.1, pull_angle=0.0):
+        self.count = count
+        leg_count = len(RSTATIC.leg_names)
+        self.transforms = numpy.array(RSTATIC.body_c1_tf)
+        self.c1_positions = self.transforms[:, 0:3, 3]
+        aeps = {'f': RSTATIC.front_initial_aep, 'm': RSTATIC.middle_initial_aep, 'r': RSTATIC.hind_initial_aep}
+        peps = {'f': RSTATIC.front_initial_pep, 'm': RSTATIC.middle_initial_pep, 'r': RSTATIC.hind_initial_pep}
+        side = numpy.array([[1, 1 if name[0] == 'l' else -1, 1] for name in RSTATIC.leg_names])
+        self.aeps = numpy.array([aeps[name[1]] for name in RSTATIC.leg_names]) * side
+        self.peps = numpy.array([peps[name[1]] for name in RSTATIC.leg_names]) * side
+        self.without_leg = ~numpy.eye(leg_count, dtype=bool)
+
+        # controller state: swing legs start at their PEPs, stance legs at their AEPs
+        initial_swing = numpy.array([name in INITIAL_SWING_LEGS for name in RSTATIC.leg_names])
+        angles, valid = inverse_kinematics(numpy.where(initial_swing[:, None], self.peps, self.aeps),
+                                           self.transforms, SEGMENT_LENGTHS)
+        self.angles = numpy.tile(angles, (count, 1, 1))
+        self.swing = numpy.tile(initial_swing, (count, 1))
+        # running swing movements: bezier points, parameter step per distance (see
+        # TrajectoryGenerator.norm_delta_parameter), parameter and position of the last target
+        self.swing_active = numpy.zeros((count, leg_count), dtype=bool)
+        self.swing_points = numpy.zeros((count, leg_count, 5, 3))
+        self.swing_norm_deltas = numpy.zeros((count, leg_count))
+        self.swing_parameters = numpy.zeros((count, leg_count))
+        self.swing_last_targets = numpy.zeros((count, leg_count, 3))
+        # running stance movements (the leg was put on the ground in the body model) and stances whose lift was
+        # refused by the stability gate (see SingleLegController.lift_delayed)
+        self.stance_active = numpy.zeros((count, leg_count), dtype=bool)
+        self.lift_delayed = numpy.zeros((count, leg_count), dtype=bool)
+
+        # body model: the vectors of mmcBodyModelStance (see the *_ROWS constants) and the ground contacts of all
+        # robots, with the connection matrices of all ground contact patterns
+        body_model = mmcBodyModelStance(None, offline=True)
+        self.vectors = numpy.tile(body_model.vectors, (count, 1, 1))
+        self.segm_norms = body_model.segm_norms
+        self.gc = numpy.zeros((count, leg_count), dtype=bool)
+        self.connection_matrices = numpy.array([connection_matrix(gc, RSTATIC.body_model_damping) for gc in
+                                                itertools.product((False, True), repeat=leg_count)])
+        self.pattern_weights = 1 << numpy.arange(leg_count - 1, -1, -1)
+        # segment vectors in the closed chains of two legs (see mmcBodyModelStance.get_segm_vectors_between_legs)
+        same_segment = numpy.equal.outer(numpy.arange(leg_count) // 2, numpy.arange(leg_count) // 2)
+        self.between_rows = numpy.where(same_segment, SEGM_LEG_POST_ROWS.start, SEGM_LEG_ANT_ROWS.start)
+        self.lower_pairs = numpy.tril(numpy.ones((leg_count, leg_count), dtype=bool), -1)
+        self.walking = numpy.zeros(count, dtype=bool)
+        self.steer(speed_fact, pull_angle)
+
+        self.ticks = 0
+        self.tick_time = 0.0
+        self.ik_failures = numpy.zeros(count, dtype=int)
+        self.position = numpy.zeros((count, 2))
+        self.heading = numpy.zeros(count)
+        self.path_length = numpy.zeros(count)
+        self.min_margin = numpy.full(count, numpy.inf)
+        self.swing_start_count = numpy.zeros((count, leg_count), dtype=int)
+        self.first_swing_start = numpy.zeros((count, leg_count), dtype=int)
+        self.last_swing_start = numpy.zeros((count, leg_count), dtype=int)
+        self.feet = self.foot_positions()
+
+    # Steering command of all robots (see RobotController.control_robot_callback): the body model is pulled at the
+    # front into the direction relative to its first segment. Robots with speed_fact 0 keep their last command.
+    def steer(self, speed_fact, pull_angle):
+        speed_fact = numpy.broadcast_to(numpy.asarray(speed_fact, dtype=float), (self.count,))
+        pull_angle = numpy.broadcast_to(numpy.asarray(pull_angle, dtype=float), (self.count,))
+        steered = speed_fact > 0
+        segment = self.vectors[:, SEGM_POST_ANT_ROW]
+        angle = pull_angle + numpy.arctan2(segment[:, 1], segment[:, 0])
+        pull = numpy.stack([speed_fact * numpy.cos(angle), speed_fact * numpy.sin(angle), numpy.zeros(self.count)],
+                           axis=-1)
+        self.vectors[steered, DELTA_FRONT_ROW] = pull[steered]
+        self.vectors[steered, DELTA_BACK_ROW] = 0
+        self.walking |= steered
+
+    def foot_positions(self):
+        return forward_kinematics(self.angles, self.transforms)
+
+    # One iteration of the body model of all robots: the robots are grouped by their ground contact pattern, so each
+    # group is one product with its connection matrix.
+    def body_model_step(self):
+        patterns = self.gc.dot(self.pattern_weights)
+        new_vectors = numpy.empty((self.count, STATE_ROWS, 3))
+        for pattern in numpy.unique(patterns):
+            robots = patterns == pattern
+            new_vectors[robots] = numpy.matmul(self.connection_matrices[pattern], self.vectors[robots])
+        segments = new_vectors[:, SEGM_LEG_ANT_ROWS.start:SEGM_DIAG_ROWS.start + 1]
+        segments *= (self.segm_norms / numpy.sqrt(numpy.einsum('nij,nij->ni', segments, segments)))[..., None]
+        self.vectors[:, 0:STATE_ROWS] = new_vectors
+
+    # Put the legs of the mask (robots, legs) on the ground in the body model at the foot positions and establish the
+    # footdiags to the other legs (see mmcBodyModelStance.put_leg_on_ground).
+    def put_legs_on_ground(self, mask, feet):
+        self.gc |= mask
+        # only the robots that put down a leg
+        robots = numpy.nonzero(mask.any(axis=1))[0]
+        if len(robots) == 0:
+            return
+        mask = mask[robots]
+        vectors = self.vectors[robots]
+        leg_vect = vectors[:, LEG_ROWS]
+        leg_vect[mask] = (feet[robots] - self.c1_positions)[mask]
+        vectors[:, FRONT_ROWS][mask] = (leg_vect - vectors[:, SEGM_LEG_ANT_ROWS])[mask]
+        leg_nrs = numpy.arange(len(RSTATIC.leg_names))
+        between = vectors[:, self.between_rows + leg_nrs[:, None]] - vectors[:, self.between_rows + leg_nrs]
+        footdiag = leg_vect[:, None, :] - leg_vect[:, :, None] + between
+        changed = ((mask[:, :, None] | mask[:, None, :]) & self.lower_pairs).reshape(len(robots), -1)
+        vectors[:, FOOTDIAG_ROWS][changed] = footdiag.reshape(len(robots), -1, 3)[changed]
+        self.vectors[robots] = vectors
+
+    # Plan the swings of the legs of the mask from the foot positions to the AEPs (see
+    # SwingMovementBezier.compute_bezier_points_with_joint_angles). Swings with unreachable start or target points
+    # are planned again in the next tick.
+    def start_swings(self, mask, feet):
+        if not mask.any():
+            return
+        robots, legs = numpy.nonzero(mask)
+        starts = feet[robots, legs]
+        targets = self.aeps[legs]
+        transforms = self.transforms[legs]
+        angles, valid = inverse_kinematics(numpy.concatenate([starts, targets]), numpy.concatenate(
+            [transforms, transforms]), SEGMENT_LENGTHS)
+        apex_angles = (angles[:len(starts)] + angles[len(starts):]) / 2 - [0, CONST.DEFAULT_APEX_THIGH_OFFSET, 0]
+        apex_points = forward_kinematics(apex_angles, transforms)
+        start_to_end_vectors = targets - starts
+        points = numpy.stack([starts, apex_points - 0.5 * APEX_POINT_RATIO * start_to_end_vectors, apex_points,
+                              apex_points + 0.5 * (1 - APEX_POINT_RATIO) * start_to_end_vectors, targets], axis=1)
+        # the initial parameter step of TrajectoryGenerator.compute_next_target (including its difference of the
+        # coordinates of the first two points)
+        norm_deltas = 1 / ((points.shape[1] - 1) // 2) * CONST.DEFAULT_SWING_VELOCITY / \
+            RSTATIC.controller_frequency / numpy.linalg.norm(numpy.diff(points[:, 0:2], axis=-1), axis=(-2, -1))
+        planned = valid[:len(starts)] & valid[len(starts):]
+        self.ik_failures += numpy.bincount(robots[~planned], minlength=self.count)
+        robots, legs = robots[planned], legs[planned]
+        self.swing_points[robots, legs] = points[planned]
+        self.swing_norm_deltas[robots, legs] = norm_deltas[planned]
+        self.swing_parameters[robots, legs] = 0
+        self.swing_last_targets[robots, legs] = starts[planned]
+        self.swing_active[robots, legs] = True
+
+    # Next targets of the running swings (see TrajectoryGenerator.compute_next_target): the point on the curve at the
+    # distance of one tick of the swing velocity from the foot. A foot that is further than this distance from the
+    # last target moves towards the last target.
+    def swing_targets(self, feet):
+        desired_distance = CONST.DEFAULT_SWING_VELOCITY / RSTATIC.controller_frequency
+        robots, legs = numpy.nonzero(self.swing_active)
+        current = feet[robots, legs]
+        last_targets = self.swing_last_targets[robots, legs]
+        directions = last_targets - current
+        behind = numpy.round(numpy.linalg.norm(directions, axis=-1), 3) > desired_distance
+        robots, legs = robots[~behind], legs[~behind]
+        parameters, curve_points, norm_deltas = search_swing_targets(
+            self.swing_points[robots, legs], current[~behind], self.swing_parameters[robots, legs],
+            last_targets[~behind], self.swing_norm_deltas[robots, legs], desired_distance)
+        directions[~behind] = curve_points - current[~behind]
+        targets = current + directions / numpy.linalg.norm(directions, axis=-1)[:, None] * desired_distance
+        self.swing_parameters[robots, legs] = parameters
+        self.swing_norm_deltas[robots, legs] = norm_deltas
+        self.swing_last_targets[robots, legs] = targets[~behind]
+        all_targets = numpy.zeros(feet.shape)
+        all_targets[numpy.nonzero(self.swing_active)] = targets
+        return all_targets
+
+    # Swing starts of the legs at their PEPs in the order of the legs, each only if the robot stays statically stable
+    # without the leg or it is forced (see StabilityMonitor.request_lift). stance are the stance legs of the stability
+    # monitor.
+    def lift_legs(self, reached_pep, stance, feet, forced):
+        lifted = numpy.zeros_like(reached_pep)
+        for leg_nr in range(reached_pep.shape[1]):
+            candidates = reached_pep[:, leg_nr].copy()
+            if RSTATIC.stability_gating and candidates.any():
+                margins = support_margins(feet[candidates, :, 0:2], (stance[candidates] & self.without_leg[leg_nr])[
+                    :, None], RSTATIC.center_of_mass[0:2])[:, 0]
+                candidates[candidates] = (margins >= RSTATIC.stability_min_margin) | forced[candidates, leg_nr]
+            lifted[:, leg_nr] = candidates
+            stance[candidates, leg_nr] = False
+        return lifted
+
+    # One control tick of all robots: the controller step followed by the movement of the joints to the commands.
+    def step(self):
+        start = time.perf_counter()
+        feet = self.feet
+        contact = (feet[..., 2] < self.aeps[:, 2] * RSTATIC.predicted_ground_contact_height_factor) & \
+            (numpy.abs(feet[..., 0] - self.aeps[:, 0]) < PHASE_END_DISTANCE)
+        stance = ~self.swing
+        self.min_margin = numpy.minimum(self.min_margin, support_margins(
+            feet[..., 0:2], stance[:, None], RSTATIC.center_of_mass[0:2])[:, 0])
+        self.gc &= stance
+        self.body_model_step()
+
+        walking = self.walking[:, None]
+        swing = self.swing & walking
+        stance &= walking
+        self.start_swings(swing & ~self.swing_active, feet)
+        swing &= self.swing_active
+        placed = stance & ~self.stance_active
+        self.put_legs_on_ground(placed, feet)
+        self.stance_active |= placed
+        targets = numpy.where(swing[..., None], self.swing_targets(feet),
+                              self.c1_positions + self.vectors[:, LEG_ROWS])
+        angles, valid = inverse_kinematics(targets, self.transforms, SEGMENT_LENGTHS)
+        commanded = (swing | stance) & valid
+        self.ik_failures += ((swing | stance) & ~valid).sum(axis=1)
+
+        # coordination: swings end at the ground contact, stances at the PEP if the robot stays stable. Refused legs
+        # request their lift again as long as they are at or behind the PEP (see SingleLeg.passed_pep).
+        landed = swing & contact
+        self.swing_active &= ~landed
+        from_pep = feet[..., 0] - self.peps[:, 0]
+        pep_distance = from_pep * numpy.sign(self.peps[:, 0] - self.aeps[:, 0])
+        requesting = stance & ((numpy.abs(from_pep) < PHASE_END_DISTANCE) | (self.lift_delayed & (
+            pep_distance >= -PHASE_END_DISTANCE)))
+        lifted = self.lift_legs(requesting, ~self.swing, feet,
+                                self.lift_delayed & (pep_distance > RSTATIC.stability_max_pep_overshoot))
+        self.lift_delayed = (self.lift_delayed | requesting) & ~lifted
+        self.stance_active &= ~lifted
+        swing_before = self.swing
+        self.swing = (self.swing & ~landed) | lifted
+        self.tick_time += time.perf_counter() - start
+
+        self.angles = numpy.where(commanded[..., None], angles, self.angles)
+        self.update_pose(swing_before)
+        self.ticks += 1
+
+    def update_pose(self, swing_before):
+        feet = self.foot_positions()
+        started = self.swing & ~swing_before
+        self.first_swing_start[started & (self.swing_start_count == 0)] = self.ticks
+        self.last_swing_start[started] = self.ticks
+        self.swing_start_count += started
+        stance = ~swing_before & ~self.swing
+        moved = stance.sum(axis=1) >= 2
+        angles, translations = fit_rigid_transforms(self.feet[moved, :, 0:2], feet[moved, :, 0:2], stance[moved])
+        heading = self.heading[moved]
+        self.position[moved] += numpy.stack([
+            numpy.cos(heading) * translations[:, 0] - numpy.sin(heading) * translations[:, 1],
+            numpy.sin(heading) * translations[:, 0] + numpy.cos(heading) * translations[:, 1]], axis=-1)
+        self.heading[moved] += angles
+        self.path_length[moved] += numpy.hypot(translations[:, 0], translations[:, 1])
+        self.feet = feet
+
+    # Run the ticks, returns the metrics of all robots and the throughput of the run.
+    def run(self, ticks):
+        start = time.perf_counter()
+        for _ in range(ticks):
+            self.step()
+        wall_time = time.perf_counter() - start
+        metrics = self.metrics()
+        metrics['wall_time'] = wall_time
+        metrics['steps_per_second'] = ticks / wall_time if wall_time > 0 else float('inf')
+        metrics['robot_steps_per_second'] = metrics['steps_per_second'] * self.count
+        return metrics
+
+    # Metrics of KinematicSimulation.metrics, one value per robot, and the minimal stability margin of the robots.
+    def metrics(self):
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            curvature = numpy.where(self.path_length > 1e-6, self.heading / self.path_length, 0.0)
+            cycles = numpy.maximum(self.swing_start_count - 1, 0)
+            step_cycle_time = ((self.last_swing_start - self.first_swing_start) * (cycles > 0)).sum(axis=1) / \
+                cycles.sum(axis=1) / RSTATIC.controller_frequency
+            return {'ticks': self.ticks, 'distance': numpy.linalg.norm(self.position, axis=1),
+                    'path_length': self.path_length.copy(), 'heading_change': self.heading.copy(),
+                    'curvature': curvature, 'turning_radius': numpy.where(curvature != 0, 1 / curvature, numpy.inf),
+                    'ik_failures': self.ik_failures.copy(),
+                    'mean_tick_time': self.tick_time / self.ticks if self.ticks > 0 else 0.0,
+                    'step_cycle_time': step_cycle_time, 'min_stability_margin': self.min_margin.copy()}
+
+
+# Values of a parameter for the robots: a number or LOW:HIGH, spread evenly over the robots.
+def robot_values(text, count):
+    if ':' in text:
+        low, high = text.split(':')
+        return numpy.linspace(float(low), float(high), count)
+    return numpy.full(count, float(text))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate many robots at once on the batched kinematic simulation '
+                                                 'and report the throughput.')
+    parser.add_argument('--robots', type=int, default=1000)
+    parser.add_argument('--ticks', type=int, default=1000, help='control ticks of the robots')
+    parser.add_argument('--speed', default='0.1', metavar='SPEED|LOW:HIGH',
+                        help='speed factor of the robots, spread over the robots for a range')
+    parser.add_argument('--pull-angle', default='0.0', metavar='ANGLE|LOW:HIGH',
+                        help='pull angle of the robots, spread over the robots for a range')
+    args = parser.parse_args()
+
+    simulation = BatchedSimulation(args.robots, robot_values(args.speed, args.robots),
+                                   robot_values(args.pull_angle, args.robots))
+    results = simulation.run(args.ticks)
+    print(str(args.robots) + " robots, " + str(args.ticks) + " ticks in " + str(round(results['wall_time'], 2)) +
+          " s: " + str(round(results['steps_per_second'], 1)) + " steps/s, " +
+          str(round(results['robot_steps_per_second'])) + " robot steps/s")
+    for name in ('distance', 'curvature', 'step_cycle_time', 'min_stability_margin', 'ik_failures'):
+        values = results[name]
+        print(name + ": mean " + str(round(float(numpy.mean(values)), 4)) + ", min " +
+              str(round(float(numpy.min(values)), 4)) + ", max " + str(round(float(numpy.max(values)), 4)))
@@ -1,5 +1,7 @@
 import numpy
 
 DEFAULT_SWING_VELOCITY = 2.2
+# speed of the end effector during the simple stance movement (m/s)
+DEFAULT_STANCE_VELOCITY = 0.05
 DEFAULT_APEX_THIGH_OFFSET = 0.4
 DEFAULT_APEX_POINT_OFFSET = numpy.array([0, 0.02, 0.04])
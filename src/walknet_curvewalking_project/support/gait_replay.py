@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import functools
+import os
+import time
+from collections import namedtuple
+from itertools import product
+from multiprocessing import Pool
+
+import numpy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+from walknet_curvewalking_project.controller.robot_controller import RobotController
+from walknet_curvewalking_project.support.recording import EVENT_DTYPE, JOINT_STATE, ROBOT_CONTROL, RecordWriter, \
+    read_chunks
+
+JOINT_TYPES = ('c1', 'thigh', 'tibia')
+CONTROL_TOPIC = '/control_robot'
+SUMMARY_FIELDS = ['episode', 'events', 'ticks', 'wall_time', 'mean_tick_time', 'max_tick_time']
+
+# stand-ins for the recorded messages, only the fields used by the callbacks
+JointState = namedtuple('JointState', ['process_value', 'set_point', 'error'])
+RobotControl = namedtuple('RobotControl', ['pull_angle', 'speed_fact'])
+
+# per tick output: commands of the legs (nan before the first command), swing state, ground contact, leg and segment
+# vectors of the body model and the computation time of the tick in seconds
+TICK_DTYPE = numpy.dtype([('tick', '<u4'), ('time', '<f8'), ('commands', '<f8', (6, 3)), ('swing', '?', (6,)),
+                          ('ground_contact', '?', (6,)), ('leg_vect', '<f8', (6, 3)), ('segm_post_ant', '<f8', (3,)),
+                          ('compute_time', '<f8')])
+
+
+def joint_state_topic(leg_name, joint_type):
+    return '/phantomx/j_' + joint_type + '_' + leg_name + '_position_controller/state'
+
+
+# Events (time, kind, index, values) of a rosbag in the order of the recording, see recording.EVENT_DTYPE.
+def bag_events(path):
+    # rosbag is only needed for replaying bags
+    import rosbag
+    indices = {joint_state_topic(leg_name, joint_type): index for index, (leg_name, joint_type) in
+               enumerate(product(RSTATIC.leg_names, JOINT_TYPES))}
+    with rosbag.Bag(path) as bag:
+        for topic, msg, t in bag.read_messages(topics=list(indices) + [CONTROL_TOPIC]):
+            if topic == CONTROL_TOPIC:
+                yield t.to_sec(), ROBOT_CONTROL, 0, (msg.pull_angle, msg.speed_fact, 0.0)
+            else:
+                yield t.to_sec(), JOINT_STATE, indices[topic], (msg.process_value, msg.set_point, msg.error)
+
+
+def recording_events(path):
+    for chunk in read_chunks(path):
+        for event in chunk.tolist():
+            yield event
+
+
+def read_events(path):
+    if path.endswith('.bag'):
+        return bag_events(path)
+    return recording_events(path)
+
+
+##
+#   Replays recorded joint states and robot control messages through an offline RobotController. The controller is
+#   stepped (body_model_step) at the controller frequency of the recorded time, without waiting in between: before
+#   each tick all events up to the tick are passed to the callbacks. As in the online controller, ticks are only
+#   computed once the joint states of all legs were received.
+class GaitReplay:
+    def __init__(self, frequency=RSTATIC.controller_frequency):
+        self.robot = RobotController('robot', None, offline=True)
+        self.robot.debug = False
+        self.period = 1.0 / frequency
+        controllers = {controller.name: controller for controller in self.robot.legs}
+        self.controllers = [controllers[name] for name in RSTATIC.leg_names]
+        self.legs = [controller.leg for controller in self.controllers]
+        self.joint_callbacks = [callback for leg in self.legs for callback in
+                                (leg.c1_callback, leg.thigh_callback, leg.tibia_callback)]
+        self.events = 0
+        self.ticks = 0
+        self.compute_time = 0.0
+        self.max_compute_time = 0.0
+
+    def apply(self, kind, index, values):
+        if kind == JOINT_STATE:
+            self.joint_callbacks[index](JointState(*values))
+        elif kind == ROBOT_CONTROL:
+            self.robot.control_robot_callback(RobotControl(values[0], values[1]))
+        self.events += 1
+
+    def step(self, tick_time, writer):
+        start = time.perf_counter()
+        self.robot.body_model_step()
+        compute_time = time.perf_counter() - start
+        self.compute_time += compute_time
+        self.max_compute_time = max(self.max_compute_time, compute_time)
+        if writer is not None:
+            record = writer.next_record()
+            record['tick'] = self.ticks
+            record['time'] = tick_time
+            for leg_nr, leg in enumerate(self.legs):
+                record['commands'][leg_nr] = numpy.nan if leg.last_command is None else leg.last_command
+            record['swing'] = [controller.swing for controller in self.controllers]
+            record['ground_contact'] = self.robot.body_model.gc
+            record['leg_vect'] = self.robot.body_model.leg_vect
+            record['segm_post_ant'] = self.robot.body_model.segm_post_ant
+            record['compute_time'] = compute_time
+        self.ticks += 1
+
+    # Replay the events (time, kind, index, values). Stops after max_ticks ticks if given.
+    def run(self, events, writer=None, max_ticks=None):
+        next_tick = None
+        for event_time, kind, index, values in events:
+            if next_tick is None:
+                next_tick = event_time + self.period
+            while event_time >= next_tick:
+                if all(leg.is_ready() for leg in self.legs):
+                    if max_ticks is not None and self.ticks >= max_ticks:
+                        return
+                    self.step(next_tick, writer)
+                next_tick += self.period
+            self.apply(kind, index, values)
+
+    def summary(self):
+        return {'events': self.events, 'ticks': self.ticks,
+                'mean_tick_time': self.compute_time / self.ticks if self.ticks > 0 else 0.0,
+                'max_tick_time': self.max_compute_time}
+
+
+def episode_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+# Replay one recorded episode and write the ticks to <output>/<episode>_ticks.rec. Returns the summary.
+def replay_episode(path, output, max_ticks=None):
+    replay = GaitReplay()
+    start = time.perf_counter()
+    with RecordWriter(os.path.join(output, episode_name(path) + '_ticks.rec'), TICK_DTYPE) as writer:
+        replay.run(read_events(path), writer, max_ticks)
+    summary = replay.summary()
+    summary['episode'] = episode_name(path)
+    summary['wall_time'] = time.perf_counter() - start
+    return summary
+
+
+def convert_episode(path, output):
+    with RecordWriter(os.path.join(output, episode_name(path) + '.rec'), EVENT_DTYPE) as writer:
+        for event in read_events(path):
+            writer.write(*event)
+    return episode_name(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded joint states and robot control messages through '
+                                                 'the controller without ROS.')
+    parser.add_argument('inputs', nargs='+', help='rosbags (.bag) or recording files (.rec), one episode each')
+    parser.add_argument('--output', default='replay', help='directory for the tick records and summary.csv')
+    parser.add_argument('--ticks', type=int, default=None, help='maximal number of ticks per episode')
+    parser.add_argument('--jobs', type=int, default=1, help='number of episodes replayed in parallel')
+    parser.add_argument('--convert', action='store_true',
+                        help='only convert the inputs to recording files (.rec) in the output directory')
+    args = parser.parse_args()
+    os.makedirs(args.output, exist_ok=True)
+    with Pool(args.jobs) as pool:
+        if args.convert:
+            for name in pool.imap(functools.partial(convert_episode, output=args.output), args.inputs):
+                print("converted " + name)
+        else:
+            with open(os.path.join(args.output, 'summary.csv'), 'w', newline='') as summary_file:
+                summary_writer = csv.DictWriter(summary_file, SUMMARY_FIELDS)
+                summary_writer.writeheader()
+                for summary in pool.imap(functools.partial(replay_episode, output=args.output,
+                                                           max_ticks=args.ticks), args.inputs):
+                    summary_writer.writerow(summary)
+                    print(summary['episode'] + ": " + str(summary['ticks']) + " ticks in " +
+                          str(round(summary['wall_time'], 3)) + " s, mean tick " +
+                          str(round(summary['mean_tick_time'] * 1000, 3)) + " ms")
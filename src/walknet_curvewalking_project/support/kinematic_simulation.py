@@ -0,0 +1,131 @@
+import time
+from collections import namedtuple
+from math import atan2, cos, sin, hypot
+
+import numpy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+from walknet_curvewalking_project.controller.robot_controller import RobotController
+from walknet_curvewalking_project.phantomx.leg_kinematics import forward_kinematics
+
+# stand-in for the robot_control message
+RobotControl = namedtuple('RobotControl', ['pull_angle', 'speed_fact'])
+
+
+# Rigid 2D transformation (angle, translation) that maps the points q onto the points p (least squares).
+def fit_rigid_transform(p, q):
+    p_center = p.mean(axis=0)
+    q_center = q.mean(axis=0)
+    p_centered = p - p_center
+    q_centered = q - q_center
+    angle = atan2(numpy.sum(q_centered[:, 0] * p_centered[:, 1] - q_centered[:, 1] * p_centered[:, 0]),
+            numpy.sum(q_centered * p_centered))
+    rotation = numpy.array([[cos(angle), -sin(angle)], [sin(angle), cos(angle)]])
+    return angle, p_center - rotation.dot(q_center)
+
+
+##
+#   Headless kinematic stand-in for the robot: an offline RobotController whose joints reach every command
+#   immediately. The body pose in the plane is estimated from the feet that stay on the ground between two ticks
+#   (the feet do not slip), which gives the travelled distance and the curvature of the path without a physics
+#   simulation. An exception of the kinematics outside of the legs (e.g. forward kinematics of a leg without joint
+#   state) is counted as inverse kinematics failure and ends the episode, the metrics cover the ticks until then.
+class KinematicSimulation:
+    def __init__(self, speed_fact=0.1, pull_angle=0.0):
+        self.robot = RobotController('robot', None, offline=True)
+        self.robot.debug = False
+        self.transforms = numpy.array([RSTATIC.body_c1_tf[RSTATIC.leg_names.index(leg.name)]
+                                       for leg in self.robot.legs])
+        self.ik_failures = 0
+        # repr of the exception that ended the episode, None if all ticks were run
+        self.aborted = None
+        for leg in self.robot.legs:
+            leg.leg.compute_inverse_kinematics = self.count_failures(leg.leg.compute_inverse_kinematics)
+
+        self.robot.set_legs_init_pos()
+        for leg in self.robot.legs:
+            self.apply(leg.leg, leg.leg.compute_inverse_kinematics(leg.init_pos))
+        self.robot.control_robot_callback(RobotControl(pull_angle, speed_fact))
+
+        self.ticks = 0
+        self.tick_time = 0.0
+        self.max_tick_time = 0.0
+        self.position = numpy.zeros(2)
+        self.heading = 0.0
+        self.path_length = 0.0
+        self.swing_starts = [[] for _ in self.robot.legs]
+        self.swing = [leg.swing for leg in self.robot.legs]
+        self.feet = self.foot_positions()
+
+    def count_failures(self, compute_inverse_kinematics):
+        def counted(*args, **kwargs):
+            try:
+                return compute_inverse_kinematics(*args, **kwargs)
+            except ValueError:
+                self.ik_failures += 1
+                raise
+        return counted
+
+    @staticmethod
+    def apply(leg, angles):
+        leg.apply_joint_state(angles, angles, (True, True, True))
+
+    def foot_positions(self):
+        return forward_kinematics([leg.leg.get_current_angles() for leg in self.robot.legs], self.transforms)
+
+    # One control tick: the controller step followed by the movement of the joints to the commands.
+    def step(self):
+        start = time.perf_counter()
+        self.robot.updateStanceBodyModel()
+        for leg in self.robot.legs:
+            try:
+                leg.manage_walk(sleep=False)
+            except ValueError:
+                # unreachable swing target (counted in count_failures), the leg keeps its last command
+                pass
+        tick_time = time.perf_counter() - start
+        self.tick_time += tick_time
+        self.max_tick_time = max(self.max_tick_time, tick_time)
+        for leg in self.robot.legs:
+            if leg.leg.last_command is not None:
+                self.apply(leg.leg, leg.leg.last_command)
+        self.update_pose()
+        self.ticks += 1
+
+    def update_pose(self):
+        feet = self.foot_positions()
+        swing = [leg.swing for leg in self.robot.legs]
+        stance = [not before and not after for before, after in zip(self.swing, swing)]
+        for leg_nr in range(len(swing)):
+            if swing[leg_nr] and not self.swing[leg_nr]:
+                self.swing_starts[leg_nr].append(self.ticks)
+        if sum(stance) >= 2:
+            angle, translation = fit_rigid_transform(self.feet[stance, 0:2], feet[stance, 0:2])
+            self.position += numpy.array([cos(self.heading) * translation[0] - sin(self.heading) * translation[1],
+                                          sin(self.heading) * translation[0] + cos(self.heading) * translation[1]])
+            self.heading += angle
+            self.path_length += hypot(translation[0], translation[1])
+        self.feet = feet
+        self.swing = swing
+
+    def run(self, ticks):
+        for _ in range(ticks):
+            try:
+                self.step()
+            except (ValueError, TypeError, ArithmeticError, numpy.linalg.LinAlgError) as error:
+                self.ik_failures += 1
+                self.aborted = repr(error)
+                break
+        return self.metrics()
+
+    def metrics(self):
+        curvature = self.heading / self.path_length if self.path_length > 1e-6 else 0.0
+        cycles = [numpy.diff(starts) for starts in self.swing_starts if len(starts) > 1]
+        return {'ticks': self.ticks, 'distance': float(numpy.linalg.norm(self.position)),
+                'path_length': self.path_length, 'heading_change': self.heading, 'curvature': curvature,
+                'turning_radius': 1 / curvature if curvature != 0 else float('inf'), 'ik_failures': self.ik_failures,
+                'aborted': self.aborted,
+                'mean_tick_time': self.tick_time / self.ticks if self.ticks > 0 else 0.0,
+                'max_tick_time': self.max_tick_time,
+                'step_cycle_time': float(numpy.mean(numpy.concatenate(cycles))) / RSTATIC.controller_frequency
+                if cycles else float('nan')}
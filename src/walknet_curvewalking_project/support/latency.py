@@ -0,0 +1,105 @@
+import threading
+import time
+
+import numpy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+
+# Trace points of a steering command in the order in which the command passes them: reception in
+# control_robot_callback, the first body model iteration with the new pull vectors, the first stance inverse
+# kinematics computed from the body model and the publication of the first joint command computed by it.
+RECEIVED = 0
+BODY_MODEL = 1
+INVERSE_KINEMATICS = 2
+COMMAND = 3
+STAGES = ('received', 'body_model', 'inverse_kinematics', 'command')
+PERCENTILES = (50, 90, 99)
+
+
+##
+#   Latency of the steering commands from the time at which they were issued (the stamp of robot_control_stamped
+#   messages, the reception for unstamped messages) to the trace points of the control loop. Only the latest command
+#   is traced: a command that is replaced before its first joint command counts as superseded. The latencies (s) of
+#   the last size completed traces are kept in a ring buffer. trace is called from the control loop (and the leg
+#   threads), command_received from the subscriber threads.
+class LatencyTracer:
+    def __init__(self, size=RSTATIC.latency_trace_size, clock=time.time):
+        self.clock = clock
+        self.latencies = numpy.full((size, len(STAGES)), numpy.nan)
+        self.sequences = numpy.zeros(size, dtype=numpy.int64)
+        self.completed = 0
+        self.superseded = 0
+        # (sequence, start time, latencies of the stages) of the traced command
+        self.pending = None
+        self.lock = threading.Lock()
+
+    # A new steering command. stamp is the time (of clock) at which it was issued, None to trace from now.
+    def command_received(self, sequence, stamp=None):
+        now = self.clock()
+        start = now if stamp is None else stamp
+        latencies = numpy.full(len(STAGES), numpy.nan)
+        latencies[RECEIVED] = now - start
+        with self.lock:
+            if self.pending is not None:
+                self.superseded += 1
+            self.pending = (sequence, start, latencies)
+
+    # Trace point of the stage for the pending command. Every stage is recorded once, the stages after the body model
+    # only once the previous stage was passed. The trace is completed by the first joint command that was computed by
+    # the inverse kinematics (the legs only trace COMMAND for these commands). Returns True if the pending command
+    # passed the stage (now or before).
+    def trace(self, stage):
+        if self.pending is None:
+            return False
+        now = self.clock()
+        with self.lock:
+            if self.pending is None:
+                return False
+            sequence, start, latencies = self.pending
+            if not numpy.isnan(latencies[stage]):
+                return True
+            if stage > BODY_MODEL and numpy.isnan(latencies[stage - 1]):
+                return False
+            latencies[stage] = now - start
+            if stage == COMMAND:
+                row = self.completed % len(self.latencies)
+                self.latencies[row] = latencies
+                self.sequences[row] = sequence
+                self.completed += 1
+                self.pending = None
+            return True
+
+    # Percentiles and maximum (s) of the latencies of every stage over the stored traces.
+    def statistics(self):
+        with self.lock:
+            latencies = self.latencies[:min(self.completed, len(self.latencies))].copy()
+        statistics = {'completed': self.completed, 'superseded': self.superseded}
+        for stage_nr, stage in enumerate(STAGES):
+            values = latencies[:, stage_nr]
+            values = values[~numpy.isnan(values)]
+            for percentile in PERCENTILES:
+                statistics[stage + '_p' + str(percentile)] = \
+                    float(numpy.percentile(values, percentile)) if len(values) else float('nan')
+            statistics[stage + '_max'] = float(values.max()) if len(values) else float('nan')
+        return statistics
+
+    # diagnostic_msgs/DiagnosticArray with the statistics, a warning when the 99th percentile of the latency of the
+    # joint commands exceeds RSTATIC.latency_warning_threshold.
+    def diagnostics(self, stamp=None):
+        from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+        statistics = self.statistics()
+        status = DiagnosticStatus()
+        status.name = 'walknet_curvewalking: steering latency'
+        status.hardware_id = 'robot_controller'
+        if statistics['command_p99'] > RSTATIC.latency_warning_threshold:
+            status.level = DiagnosticStatus.WARN
+            status.message = 'steering latency above ' + str(RSTATIC.latency_warning_threshold) + ' s'
+        else:
+            status.level = DiagnosticStatus.OK
+            status.message = str(statistics['completed']) + ' commands traced'
+        status.values = [KeyValue(name, str(value)) for name, value in statistics.items()]
+        array = DiagnosticArray()
+        if stamp is not None:
+            array.header.stamp = stamp
+        array.status = [status]
+        return array
@@ -0,0 +1,25 @@
+import logging
+import sys
+
+logger = logging.getLogger('walknet_curvewalking')
+
+
+##
+#   Logging functions for the modules that are used without ROS (kinematics, body model and settings, e.g. in the
+#   offline tools). The messages go to the functions of rospy once rospy was imported by the node, otherwise to the
+#   python logger 'walknet_curvewalking'. rospy is never imported here, so importing these modules stays fast.
+def log_function(name, fallback):
+    def log(message):
+        rospy = sys.modules.get('rospy')
+        if rospy is not None:
+            getattr(rospy, name)(message)
+        else:
+            fallback(message)
+    log.__name__ = name
+    return log
+
+
+logdebug = log_function('logdebug', logger.debug)
+loginfo = log_function('loginfo', logger.info)
+logwarn = log_function('logwarn', logger.warning)
+logerr = log_function('logerr', logger.error)
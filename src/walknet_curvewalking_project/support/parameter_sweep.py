@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+import argparse
+import itertools
+import json
+import os
+import random
+import time
+from multiprocessing import Pool
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+import walknet_curvewalking_project.support.constants as CONST
+from walknet_curvewalking_project.phantomx.settings import settings
+from walknet_curvewalking_project.phantomx.workspace_index import load_workspace_index
+from walknet_curvewalking_project.support.kinematic_simulation import KinematicSimulation
+
+# Swept parameters and their default values. The apex point offset is swept per component.
+DEFAULTS = {'damping': RSTATIC.body_model_damping,
+            'default_stance_distance': RSTATIC.default_stance_distance,
+            'stance_height': RSTATIC.stance_height,
+            'swing_velocity': CONST.DEFAULT_SWING_VELOCITY,
+            'apex_thigh_offset': CONST.DEFAULT_APEX_THIGH_OFFSET,
+            'apex_point_offset_y': float(CONST.DEFAULT_APEX_POINT_OFFSET[1]),
+            'apex_point_offset_z': float(CONST.DEFAULT_APEX_POINT_OFFSET[2]),
+            'predicted_ground_contact_height_factor': RSTATIC.predicted_ground_contact_height_factor}
+
+
+# Update the settings of the current process to the parameters (defaults for the parameters that are not given).
+def apply_parameters(parameters):
+    values = dict(DEFAULTS)
+    values.update(parameters)
+    updates = {name: value for name, value in values.items() if not name.startswith('apex_point_offset')}
+    updates['apex_point_offset'] = [0, values['apex_point_offset_y'], values['apex_point_offset_z']]
+    settings.update(updates)
+
+
+def run_key(parameters):
+    return json.dumps(parameters, sort_keys=True)
+
+
+# Run one parameter set on the kinematic simulation. episode: speed_fact, pull_angle, ticks and target_curvature.
+# Runs are executed in the worker processes of the pool.
+def run_parameters(run):
+    parameters, episode = run
+    start = time.perf_counter()
+    result = {'key': run_key(parameters), 'parameters': parameters}
+    try:
+        apply_parameters(parameters)
+        simulation = KinematicSimulation(episode['speed_fact'], episode['pull_angle'])
+        result.update(simulation.run(episode['ticks']))
+        result['curvature_error'] = abs(result['curvature'] - episode['target_curvature'])
+    except Exception as error:
+        result['error'] = repr(error)
+    result['wall_time'] = time.perf_counter() - start
+    return result
+
+
+def parse_values(text, parse):
+    name, values = text.split('=', 1)
+    if name not in DEFAULTS:
+        raise argparse.ArgumentTypeError('unknown parameter ' + name + ', expected one of ' + str(list(DEFAULTS)))
+    return name, parse(values)
+
+
+def grid_values(text):
+    return parse_values(text, lambda values: [float(value) for value in values.split(',')])
+
+
+def range_values(text):
+    return parse_values(text, lambda values: [float(value) for value in values.split(':')])
+
+
+# Parameter sets: the product of the grid values, combined with samples drawn uniformly from the ranges.
+def parameter_sets(grid, ranges, samples, seed):
+    grid_sets = [dict(zip([name for name, _ in grid], values)) for values in
+                 itertools.product(*[values for _, values in grid])]
+    if not ranges:
+        return grid_sets
+    generator = random.Random(seed)
+    sampled_sets = [{name: generator.uniform(low, high) for name, (low, high) in ranges} for _ in range(samples)]
+    return [dict(grid_set, **sampled_set) for grid_set in grid_sets for sampled_set in sampled_sets]
+
+
+# Keys of the runs that are already stored in the results file. Runs that failed with an error are run again.
+def finished_runs(path):
+    if not os.path.exists(path):
+        return set()
+    keys = set()
+    with open(path) as results:
+        for line in results:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # incomplete last line of an interrupted sweep
+                continue
+            if 'key' in result and 'error' not in result:
+                keys.add(result['key'])
+    return keys
+
+
+# Terminate an incomplete last line of an interrupted sweep, so the next result starts on a new line.
+def terminate_last_line(path):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb+') as results:
+        results.seek(-1, os.SEEK_END)
+        if results.read(1) != b'\n':
+            results.write(b'\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep gait parameters on the kinematic simulation. The results are '
+                                                 'appended to the output file, finished runs are skipped when the '
+                                                 'sweep is started again.')
+    parser.add_argument('--grid', type=grid_values, action='append', default=[], metavar='NAME=V1,V2,...',
+                        help='grid values of a parameter, one of ' + ', '.join(DEFAULTS))
+    parser.add_argument('--range', type=range_values, action='append', default=[], metavar='NAME=LOW:HIGH',
+                        help='range of a randomly sampled parameter')
+    parser.add_argument('--samples', type=int, default=100, help='number of random samples of the ranges')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ticks', type=int, default=1000, help='control ticks per run')
+    parser.add_argument('--speed', type=float, default=0.1, help='speed factor of the robot control message')
+    parser.add_argument('--pull-angle', type=float, default=0.0, help='pull angle of the robot control message')
+    parser.add_argument('--target-curvature', type=float, default=0.0, help='expected curvature of the path in 1/m')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--output', default='sweep_results.jsonl')
+    args = parser.parse_args()
+
+    episode = {'speed_fact': args.speed, 'pull_angle': args.pull_angle, 'ticks': args.ticks,
+               'target_curvature': args.target_curvature}
+    finished = finished_runs(args.output)
+    runs = [(parameters, episode) for parameters in parameter_sets(args.grid, args.range, args.samples, args.seed)
+            if run_key(parameters) not in finished]
+    print(str(len(finished)) + " runs finished, " + str(len(runs)) + " runs left")
+    if RSTATIC.workspace_clamping:
+        # load the workspace indices once, the forked workers share them
+        for leg_name in RSTATIC.leg_names:
+            load_workspace_index(leg_name)
+    terminate_last_line(args.output)
+    with Pool(args.jobs) as pool, open(args.output, 'a') as output:
+        for count, result in enumerate(pool.imap_unordered(run_parameters, runs), 1):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            print(str(count) + "/" + str(len(runs)) + " " + result['key'] + ": " + (
+                result['error'] if 'error' in result else "distance " + str(round(result['distance'], 3)) +
+                " m, curvature error " + str(round(result['curvature_error'], 4)) + ", ik failures " +
+                str(result['ik_failures']) + (", aborted: " + result['aborted'] if result['aborted'] else "")))
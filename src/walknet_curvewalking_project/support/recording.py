@@ -0,0 +1,96 @@
+import ast
+
+import numpy
+
+# Compact recording files: a header (magic line and the numpy dtype description of the records) followed by the
+# records as raw binary data. Records are written and read in chunks, so arbitrarily long recordings can be streamed
+# without loading them into memory.
+MAGIC = b'WALKNET_RECORDING 1\n'
+DEFAULT_CHUNK_SIZE = 4096
+
+# event kinds of the recorded input
+JOINT_STATE = 0
+ROBOT_CONTROL = 1
+# index: leg_nr * 3 + joint (c1, thigh, tibia) for joint states, unused for robot control messages
+# values: process_value, set_point, error for joint states and pull_angle, speed_fact, 0 for robot control messages
+EVENT_DTYPE = numpy.dtype([('time', '<f8'), ('kind', 'u1'), ('index', 'u1'), ('values', '<f8', (3,))])
+
+
+##
+#   Writes records of the given dtype to a recording file. Records are buffered and written in chunks.
+class RecordWriter:
+    def __init__(self, path, dtype, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.dtype = numpy.dtype(dtype)
+        self.file = open(path, 'wb')
+        write_header(self.file, self.dtype)
+        self.buffer = numpy.zeros(chunk_size, dtype=self.dtype)
+        self.count = 0
+
+    # Index of the next record in the buffer, which is written with the next flush.
+    def next_index(self):
+        if self.count == len(self.buffer):
+            self.flush()
+        self.count += 1
+        return self.count - 1
+
+    # Returns the next record (a view into the buffer) to be filled by the caller.
+    def next_record(self):
+        return self.buffer[self.next_index()]
+
+    def write(self, *values):
+        self.buffer[self.next_index()] = values
+
+    def flush(self):
+        self.buffer[0:self.count].tofile(self.file)
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_header(file, dtype):
+    file.write(MAGIC)
+    file.write(repr(dtype.descr).encode('ascii') + b'\n')
+
+
+# Write the records to a new recording file at once.
+def write_chunk(path, records):
+    with open(path, 'wb') as file:
+        write_header(file, records.dtype)
+        records.tofile(file)
+
+
+def read_header(file):
+    if file.readline() != MAGIC:
+        raise ValueError(str(file.name) + ' is not a recording file')
+    return numpy.dtype(ast.literal_eval(file.readline().decode('ascii')))
+
+
+# Yields the records of the recording file as arrays of at most chunk_size records.
+def read_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    with open(path, 'rb') as file:
+        dtype = read_header(file)
+        while True:
+            chunk = numpy.fromfile(file, dtype=dtype, count=chunk_size)
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+
+# Memory-map the records of the recording file (read only).
+def map_chunk(path):
+    with open(path, 'rb') as file:
+        dtype = read_header(file)
+        offset = file.tell()
+        file.seek(0, 2)
+        count = (file.tell() - offset) // dtype.itemsize
+    if count == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
@@ -1,26 +1,148 @@
 #!/usr/bin/env python3
+import csv
+import time
 
+import numpy
 import rospy
-from walknet_curvewalking.msg import robot_control
+from walknet_curvewalking.msg import robot_control, robot_control_stamped
 
+# columns of a command profile: time since the start (s), speed factor and pull angle
+PROFILE_COLUMNS = ('time', 'speed_fact', 'pull_angle')
+INTERPOLATIONS = ('linear', 'step')
 
-def talker(speed_fact, pull_angle):
-    if not rospy.is_shutdown():
+
+# Command profile (n, 3) sorted by time from keyframes, dictionaries with the PROFILE_COLUMNS (missing values keep
+# the value of the previous keyframe, the first keyframe defaults to standing still).
+def profile_from_keyframes(keyframes):
+    rows = []
+    values = {'time': 0.0, 'speed_fact': 0.0, 'pull_angle': 0.0}
+    for keyframe in keyframes:
+        unknown = set(keyframe) - set(PROFILE_COLUMNS)
+        if unknown:
+            raise ValueError('unknown keys ' + str(sorted(unknown)) + ' in keyframe ' + str(keyframe))
+        values.update({name: float(value) for name, value in keyframe.items()})
+        rows.append([values[name] for name in PROFILE_COLUMNS])
+    if not rows:
+        raise ValueError('the command profile has no keyframes')
+    profile = numpy.array(rows)
+    return profile[numpy.argsort(profile[:, 0], kind='stable')]
+
+
+# Command profile from a CSV file (header with the PROFILE_COLUMNS) or a YAML file (list of keyframes).
+def load_profile(path):
+    with open(path) as file:
+        if path.endswith('.csv'):
+            keyframes = list(csv.DictReader(file))
+        else:
+            # PyYAML is only needed for YAML profiles
+            import yaml
+            keyframes = yaml.safe_load(file) or []
+    return profile_from_keyframes(keyframes)
+
+
+# Speed factor and pull angle of the profile at time t, linearly interpolated between the keyframes or held until the
+# next keyframe (interpolation 'step'). With loop the profile is repeated, otherwise the last keyframe is kept.
+def sample_profile(profile, t, interpolation='linear', loop=False):
+    if loop and profile[-1, 0] > 0:
+        t = t % profile[-1, 0]
+    if interpolation == 'step':
+        row = profile[max(0, numpy.searchsorted(profile[:, 0], t, side='right') - 1)]
+        return float(row[1]), float(row[2])
+    return float(numpy.interp(t, profile[:, 0], profile[:, 1])), float(numpy.interp(t, profile[:, 0], profile[:, 2]))
+
+
+def create_message(speed_fact, pull_angle, stamped):
+    if stamped:
+        # the stamp is the start of the steering latency traces of the controller
+        msg = robot_control_stamped()
+        msg.header.stamp = rospy.Time.now()
+    else:
         msg = robot_control()
-        msg.speed_fact = speed_fact
-        msg.pull_angle = pull_angle
+    msg.speed_fact = speed_fact
+    msg.pull_angle = pull_angle
+    return msg
+
+
+def talker(speed_fact, pull_angle, stamped):
+    if not rospy.is_shutdown():
+        msg = create_message(speed_fact, pull_angle, stamped)
         rospy.loginfo("publish msg: " + str(msg))
         pub.publish(msg)
 
 
+##
+#   Plays a command profile back at a fixed rate. Every cycle publishes burst messages with the current values of the
+#   profile back to back (burst > 1 stresses the callback path of the controller). The number of messages that were
+#   actually published is reported every report_period seconds.
+class CommandStream:
+    def __init__(self, publisher, profile, rate, stamped=False, interpolation='linear', loop=False, burst=1,
+                 report_period=1.0):
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError('interpolation must be one of ' + str(INTERPOLATIONS) + ', got ' + str(interpolation))
+        self.publisher = publisher
+        self.profile = profile
+        self.rate = rate
+        self.stamped = stamped
+        self.interpolation = interpolation
+        self.loop = loop
+        self.burst = burst
+        self.report_period = report_period
+        self.published = 0
+
+    def finished(self, t):
+        return not self.loop and t > self.profile[-1, 0]
+
+    # Publish the profile until it ended (or forever with loop). Returns the number of published messages.
+    def run(self):
+        rate = rospy.Rate(self.rate)
+        start = rospy.get_time()
+        report_start = time.monotonic()
+        report_count = 0
+        while not rospy.is_shutdown():
+            t = rospy.get_time() - start
+            if self.finished(t):
+                break
+            speed_fact, pull_angle = sample_profile(self.profile, t, self.interpolation, self.loop)
+            for _ in range(self.burst):
+                self.publisher.publish(create_message(speed_fact, pull_angle, self.stamped))
+            self.published += self.burst
+            report_count += self.burst
+            now = time.monotonic()
+            if now - report_start >= self.report_period:
+                rospy.loginfo("published " + str(round(report_count / (now - report_start), 1)) +
+                              " messages/s (t = " + str(round(t, 2)) + " s, speed_fact = " +
+                              str(round(speed_fact, 3)) + ", pull_angle = " + str(round(pull_angle, 3)) + ")")
+                report_start = now
+                report_count = 0
+            rate.sleep()
+        return self.published
+
+
 if __name__ == '__main__':
-    pub = rospy.Publisher('/control_robot', robot_control, queue_size=1)
     rospy.init_node('talker', anonymous=True)
     speed = rospy.get_param('~speed', 0.1)
     direction = rospy.get_param('~direction', 0.0)
+    stamped = rospy.get_param('~stamped', False)
+    burst = rospy.get_param('~burst', 1)
+    # the queue holds a whole burst, so the messages are not dropped by the publisher
+    if stamped:
+        pub = rospy.Publisher('/control_robot_stamped', robot_control_stamped, queue_size=burst)
+    else:
+        pub = rospy.Publisher('/control_robot', robot_control, queue_size=burst)
+    # command stream: a profile from ~file (CSV or YAML) or ~profile (list of keyframes), otherwise one message
+    profile_file = rospy.get_param('~file', None)
+    keyframes = rospy.get_param('~profile', None)
     try:
-        pass
-        talker(speed, direction)
+        if profile_file is None and keyframes is None:
+            talker(speed, direction, stamped)
+        else:
+            stream = CommandStream(pub, load_profile(profile_file) if profile_file is not None else
+                                   profile_from_keyframes(keyframes), rospy.get_param('~rate', 10.0), stamped,
+                                   rospy.get_param('~interpolation', 'linear'), rospy.get_param('~loop', False),
+                                   burst)
+            # give the subscribers time to connect before the first commands are lost
+            rospy.sleep(rospy.get_param('~connect_delay', 0.5))
+            rospy.loginfo("published " + str(stream.run()) + " messages")
     except rospy.ROSInterruptException:
         pass
 
@@ -28,3 +150,8 @@ if __name__ == '__main__':
 # rosrun walknet_curvewalking robot_control_pub.py
 # rosrun walknet_curvewalking robot_control_pub.py _speed:=<value> _direction:=<value>
 # rosrun walknet_curvewalking robot_control_pub.py _speed:=0.2 _direction:=0.0
+# rosrun walknet_curvewalking robot_control_pub.py _speed:=0.2 _direction:=0.0 _stamped:=true
+# command stream from a file with the columns time,speed_fact,pull_angle:
+# rosrun walknet_curvewalking robot_control_pub.py _file:=curve.csv _rate:=20 _interpolation:=linear _loop:=true
+# stress test of the callback path with 50 messages per cycle at 100 Hz:
+# rosrun walknet_curvewalking robot_control_pub.py _file:=curve.yaml _rate:=100 _burst:=50 _stamped:=true
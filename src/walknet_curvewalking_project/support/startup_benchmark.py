@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import subprocess
+import sys
+
+import numpy
+
+# Stages of the start-up of the controller. Every stage runs in a fresh interpreter, so the import times are not
+# hidden by modules that are already loaded.
+STAGES = [('interpreter', 'pass'),
+          ('kinematics core', 'import walknet_curvewalking_project.phantomx.leg_kinematics\n'
+                              'import walknet_curvewalking_project.phantomx.mmcBodyModel3D'),
+          ('single leg', 'import walknet_curvewalking_project.phantomx.SingleLeg'),
+          ('robot controller', 'import walknet_curvewalking_project.controller.robot_controller'),
+          ('offline robot', 'from walknet_curvewalking_project.controller.robot_controller import RobotController\n'
+                            'RobotController("robot", None, offline=True)')]
+# modules that should only be loaded when they are used
+ROS_MODULES = ('rospy', 'tf', 'geometry_msgs', 'visualization_msgs')
+
+MEASUREMENT = '''
+import json, resource, sys, time
+start = time.perf_counter()
+exec(sys.argv[1])
+duration = time.perf_counter() - start
+print(json.dumps({'time': duration, 'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'modules': [name for name in sys.argv[2:] if name in sys.modules]}))
+'''
+
+
+def measure(code):
+    output = subprocess.run([sys.executable, '-c', MEASUREMENT, code] + list(ROS_MODULES), check=True,
+            stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+# Median time (s) and resident memory (MB, maximum of the process) of every stage over the repetitions.
+def run_benchmark(repetitions):
+    results = []
+    for name, code in STAGES:
+        runs = [measure(code) for _ in range(repetitions)]
+        results.append({'stage': name, 'time': float(numpy.median([run['time'] for run in runs])),
+                        'max_rss': float(numpy.median([run['max_rss'] for run in runs])) / 1024,
+                        'ros_modules': runs[0]['modules']})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the start-up time and the resident memory of the stages '
+                                                 'of the controller start-up, each in a fresh interpreter.')
+    parser.add_argument('--repetitions', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.repetitions)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for result in results:
+            print(result['stage'].ljust(20) + str(round(result['time'] * 1000, 1)).rjust(8) + " ms " +
+                  str(round(result['max_rss'], 1)).rjust(8) + " MB  ROS modules: " +
+                  (", ".join(result['ros_modules']) or "none"))
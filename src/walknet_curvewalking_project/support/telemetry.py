@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import os
+import queue
+import threading
+import time
+
+import numpy
+import rospy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+from walknet_curvewalking_project.phantomx.leg_kinematics import forward_kinematics
+from walknet_curvewalking_project.support.recording import map_chunk, write_chunk
+
+# One record per control tick. The per leg fields are in the order of RSTATIC.leg_names, missing values are nan.
+#   angles, targets: joint states of the joint controllers, commands: last command sent to the legs
+#   foot_positions: forward kinematics of the angles in the body frame
+#   leg_vect, front_vect, segm_post_ant, pull_front: vectors of the body model
+#   swing, ground_contact: phase of the legs and ground contact of the body model
+#   phase_time: time since the start of the current phase of the leg, last_phase_duration: duration of the previous
+#   phase of the leg, tick_time: computation time of the tick (nan if the tick includes waiting)
+TELEMETRY_DTYPE = numpy.dtype([('tick', '<u4'), ('time', '<f8'), ('angles', '<f4', (6, 3)), ('targets', '<f4', (6, 3)),
+                               ('commands', '<f4', (6, 3)), ('foot_positions', '<f4', (6, 3)),
+                               ('leg_vect', '<f4', (6, 3)), ('front_vect', '<f4', (6, 3)),
+                               ('segm_post_ant', '<f4', (3,)), ('pull_front', '<f4', (3,)), ('swing', '?', (6,)),
+                               ('ground_contact', '?', (6,)), ('phase_time', '<f4', (6,)),
+                               ('last_phase_duration', '<f4', (6,)), ('tick_time', '<f4')])
+
+
+def leg_values(values):
+    return [numpy.nan] * 3 if values is None else values
+
+
+##
+#   Records the state of the control loop once per tick into preallocated chunks of a ring buffer. Full chunks are
+#   written to one file each (<directory>/<prefix>_<chunk>.rec, see recording.py) by a background thread and the
+#   chunk is reused afterwards. Recording never blocks the control loop: if all chunks are waiting to be written the
+#   records are dropped (and counted).
+class TelemetryRecorder:
+    def __init__(self, directory, chunk_size=RSTATIC.telemetry_chunk_size, buffers=RSTATIC.telemetry_buffers,
+                 prefix=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.prefix = prefix or time.strftime('telemetry_%Y%m%d_%H%M%S')
+        self.chunks = [numpy.zeros(chunk_size, dtype=TELEMETRY_DTYPE) for _ in range(buffers)]
+        self.free_chunks = queue.Queue()
+        for chunk_nr in range(1, buffers):
+            self.free_chunks.put(chunk_nr)
+        self.full_chunks = queue.Queue()
+        self.chunk = 0
+        self.count = 0
+        self.files = 0
+        self.ticks = 0
+        self.dropped = 0
+        self.transforms = numpy.array(RSTATIC.body_c1_tf)
+        self.last_swing = None
+        self.phase_start = numpy.full(6, numpy.nan)
+        self.last_phase_duration = numpy.full(6, numpy.nan)
+        self.writer = threading.Thread(target=self.write_chunks, daemon=True)
+        self.writer.start()
+
+    # Record the current state of the robot (RobotController). tick_time is the computation time of the tick.
+    def record(self, robot, tick_time=numpy.nan):
+        now = time.time()
+        swing = numpy.array([leg.swing for leg in robot.legs])
+        if self.last_swing is None:
+            self.phase_start[:] = now
+        else:
+            changed = swing != self.last_swing
+            self.last_phase_duration[changed] = now - self.phase_start[changed]
+            self.phase_start[changed] = now
+        self.last_swing = swing
+        self.ticks += 1
+        if self.chunk is None:
+            try:
+                self.chunk = self.free_chunks.get_nowait()
+            except queue.Empty:
+                self.dropped += 1
+                return
+
+        angles = numpy.array([leg_values(leg.leg.get_current_angles()) for leg in robot.legs], dtype=float)
+        record = self.chunks[self.chunk][self.count]
+        record['tick'] = self.ticks - 1
+        record['time'] = now
+        record['angles'] = angles
+        record['targets'] = [leg_values(leg.leg.get_current_targets()) for leg in robot.legs]
+        record['commands'] = [leg_values(leg.leg.last_command) for leg in robot.legs]
+        record['foot_positions'] = forward_kinematics(angles, self.transforms)
+        record['leg_vect'] = robot.body_model.leg_vect
+        record['front_vect'] = robot.body_model.front_vect
+        record['segm_post_ant'] = robot.body_model.segm_post_ant
+        record['pull_front'] = robot.body_model.pull_front
+        record['swing'] = swing
+        record['ground_contact'] = robot.body_model.gc
+        record['phase_time'] = now - self.phase_start
+        record['last_phase_duration'] = self.last_phase_duration
+        record['tick_time'] = tick_time
+        self.count += 1
+        if self.count == len(self.chunks[self.chunk]):
+            self.submit()
+
+    def submit(self):
+        if self.chunk is not None and self.count > 0:
+            self.full_chunks.put((self.chunk, self.count))
+            self.chunk = None
+            self.count = 0
+
+    def write_chunks(self):
+        while True:
+            item = self.full_chunks.get()
+            if item is None:
+                return
+            chunk_nr, count = item
+            write_chunk(os.path.join(self.directory, self.prefix + '_' + str(self.files).zfill(6) + '.rec'),
+                    self.chunks[chunk_nr][0:count])
+            self.files += 1
+            self.free_chunks.put(chunk_nr)
+
+    # Write the remaining records and stop the writer thread.
+    def close(self):
+        self.submit()
+        self.full_chunks.put(None)
+        self.writer.join()
+        rospy.loginfo("telemetry: " + str(self.ticks) + " ticks, " + str(self.dropped) + " dropped, " +
+                      str(self.files) + " files in " + self.directory)
+
+
+# Memory-mapped chunks of a recording (all recordings in the directory if no prefix is given), in recording order.
+def telemetry_chunks(directory, prefix=None):
+    return [map_chunk(path) for path in sorted(glob.glob(os.path.join(directory, (prefix or '*') + '_*.rec')))]
+
+
+# Load the records of a recording as one structured array.
+def load_telemetry(directory, prefix=None):
+    chunks = telemetry_chunks(directory, prefix)
+    if len(chunks) == 0:
+        return numpy.zeros(0, dtype=TELEMETRY_DTYPE)
+    return numpy.concatenate(chunks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize recorded telemetry.')
+    parser.add_argument('directory', nargs='?', default=RSTATIC.telemetry_directory)
+    parser.add_argument('--prefix', default=None, help='name of the recording (all recordings if not given)')
+    args = parser.parse_args()
+    records = load_telemetry(args.directory, args.prefix)
+    print(str(len(records)) + " records")
+    if len(records) > 0:
+        tick_times = records['tick_time'][~numpy.isnan(records['tick_time'])]
+        if len(tick_times) > 0:
+            print("tick time: mean " + str(round(float(tick_times.mean()) * 1000, 3)) + " ms, max " +
+                  str(round(float(tick_times.max()) * 1000, 3)) + " ms")
+        print("swing ratio per leg: " + str(records['swing'].mean(axis=0)))
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# the tests run against the sources, without a catkin workspace
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from walknet_curvewalking_project.phantomx.settings import settings  # noqa: E402
+
+
+# Restores the settings (and the derived values) that were changed by a test.
+@pytest.fixture
+def restore_settings():
+    values = settings.as_dict()
+    yield settings
+    settings.pending = {}
+    settings.rejected = {}
+    settings.update(values)
@@ -0,0 +1,31 @@
+import numpy
+import pytest
+
+from walknet_curvewalking_project.support.batched_simulation import BatchedSimulation
+
+TICKS = 300
+
+
+def test_robots_of_a_batch_do_not_influence_each_other():
+    batch = BatchedSimulation(3, [0.1, 0.2, 0.1], [0.0, -0.3, 0.0]).run(TICKS)
+    single = BatchedSimulation(1, 0.2, -0.3).run(TICKS)
+    for name in ('distance', 'heading_change', 'ik_failures'):
+        assert batch[name][0] == batch[name][2]
+        numpy.testing.assert_allclose(batch[name][1], single[name][0])
+
+
+def test_robots_walk_straight_without_a_pull_angle():
+    metrics = BatchedSimulation(1, 0.1, 0.0).run(TICKS)
+    assert metrics['distance'][0] > 0.5
+    assert abs(metrics['curvature'][0]) < 0.05
+    assert metrics['ik_failures'][0] == 0
+
+
+# The batched simulation against the controller on the kinematic simulation.
+def test_batched_simulation_reproduces_the_kinematic_simulation():
+    pytest.importorskip('rospy')
+    from walknet_curvewalking_project.support.kinematic_simulation import KinematicSimulation
+    expected = KinematicSimulation(0.2, -0.3).run(TICKS)
+    metrics = BatchedSimulation(1, 0.2, -0.3).run(TICKS)
+    for name in ('distance', 'heading_change', 'ik_failures'):
+        numpy.testing.assert_allclose(metrics[name][0], expected[name], atol=1e-6)
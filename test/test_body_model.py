@@ -0,0 +1,135 @@
+import itertools
+
+import numpy
+
+from walknet_curvewalking_project.phantomx.mmcBodyModel3D import DELTA_BACK_ROW, DELTA_FRONT_ROW, FRONT_ROWS, \
+    LEG_ROWS, SEGM_DIAG_ROWS, SEGM_LEG_ANT_ROWS, SEGM_LEG_POST_ROWS, SEGM_POST_ANT_ROW, STATE_ROWS, VECTOR_ROWS, \
+    BodyModelHistory, connection_matrix, footdiag_row, mmcBodyModelStance
+
+
+##
+#   Reference for connection_matrix: the equations of the MMC network computed per variable, like the former
+#   compute_*_computations_and_integrate methods of mmcBodyModelStance (without the normalization of the segment
+#   vectors).
+class PerVariableIteration:
+    def __init__(self, vectors, gc, damping):
+        self.vectors = vectors
+        self.gc = gc
+        self.damping = damping
+        self.front_vect = vectors[FRONT_ROWS]
+        self.leg_vect = vectors[LEG_ROWS]
+        self.segm_leg_ant = vectors[SEGM_LEG_ANT_ROWS]
+        self.segm_leg_post = vectors[SEGM_LEG_POST_ROWS]
+        self.segm_post_ant = vectors[SEGM_POST_ANT_ROW]
+        self.segm_diag_to_right = vectors[SEGM_DIAG_ROWS]
+        self.delta_front = vectors[DELTA_FRONT_ROW]
+        self.delta_back = vectors[DELTA_BACK_ROW]
+
+    def footdiag(self, i, j):
+        return self.vectors[footdiag_row(i, j)]
+
+    def get_segm_vectors_between_legs(self, start_leg, end_leg):
+        if start_leg // 2 == end_leg // 2:
+            return self.segm_leg_post[start_leg] - self.segm_leg_post[end_leg]
+        return self.segm_leg_ant[start_leg] - self.segm_leg_ant[end_leg]
+
+    # Sum of the chains through the footdiags to the other standing legs and their number.
+    def footdiag_chains(self, leg_nr, vectors, between):
+        total = numpy.zeros(3)
+        count = 0
+        for target_leg in range(0, 6):
+            if self.gc[target_leg] and target_leg != leg_nr:
+                part_vec = vectors[target_leg].copy()
+                if between:
+                    part_vec += self.get_segm_vectors_between_legs(leg_nr, target_leg)
+                if target_leg < leg_nr:
+                    part_vec -= self.footdiag(leg_nr, target_leg)
+                else:
+                    part_vec += self.footdiag(target_leg, leg_nr)
+                total += part_vec
+                count += 1
+        return total, count
+
+    def front(self, leg_nr):
+        chains, count = self.footdiag_chains(leg_nr, self.front_vect, False)
+        new_front_vect = -self.delta_front - self.segm_post_ant + self.leg_vect[leg_nr] - self.segm_leg_post[leg_nr]
+        return (new_front_vect + chains + self.damping * self.front_vect[leg_nr]) / (1 + self.damping + count)
+
+    def leg(self, leg_nr):
+        chains, count = self.footdiag_chains(leg_nr, self.leg_vect, True)
+        segm_leg_vect = -self.delta_back + self.segm_leg_post[leg_nr] + self.segm_post_ant + self.front_vect[leg_nr]
+        return (segm_leg_vect + chains + self.damping * self.leg_vect[leg_nr]) / (1 + self.damping + count)
+
+    def segm_leg_ant_vect(self, leg_nr):
+        return (self.segm_leg_post[leg_nr] + self.segm_post_ant + self.damping * self.segm_leg_ant[leg_nr]) / (
+                1 + self.damping)
+
+    def segm_leg_post_vect(self, leg_nr):
+        return (self.segm_leg_ant[leg_nr] - self.segm_post_ant + self.damping * self.segm_leg_post[leg_nr]) / (
+                1 + self.damping)
+
+    def segm_post_ant_vect(self):
+        new_segm_post_ant = self.segm_post_ant + self.delta_front - self.delta_back
+        for leg_nr, other_leg, sign in ((0, 1, 1), (1, 0, -1), (2, 3, 1), (3, 2, -1), (4, 5, 1), (5, 4, -1)):
+            new_segm_post_ant += -self.segm_leg_post[leg_nr] + sign * self.segm_diag_to_right[0] + \
+                self.segm_leg_ant[other_leg]
+        return (new_segm_post_ant + self.damping * self.segm_post_ant) / (7 + self.damping)
+
+    def segm_diag_vect(self):
+        new_segm_diag = self.segm_leg_post[0] + self.segm_post_ant - self.segm_leg_ant[1]
+        new_segm_diag -= self.segm_leg_post[1] + self.segm_post_ant - self.segm_leg_ant[0]
+        return (new_segm_diag + self.damping * self.segm_diag_to_right[0]) / (2 + self.damping)
+
+    def state(self):
+        state = numpy.zeros((STATE_ROWS, 3))
+        for leg_nr in range(0, 6):
+            state[FRONT_ROWS.start + leg_nr] = self.front(leg_nr)
+            state[LEG_ROWS.start + leg_nr] = self.leg(leg_nr)
+            state[SEGM_LEG_ANT_ROWS.start + leg_nr] = self.segm_leg_ant_vect(leg_nr)
+            state[SEGM_LEG_POST_ROWS.start + leg_nr] = self.segm_leg_post_vect(leg_nr)
+        state[SEGM_POST_ANT_ROW] = self.segm_post_ant_vect()
+        state[SEGM_DIAG_ROWS] = self.segm_diag_to_right
+        state[SEGM_DIAG_ROWS.start] = self.segm_diag_vect()
+        return state
+
+
+def test_connection_matrix_matches_the_per_variable_equations():
+    generator = numpy.random.RandomState(0)
+    vectors = generator.uniform(-0.3, 0.3, (VECTOR_ROWS, 3))
+    for damping in (0, 1.5, 5):
+        for gc in itertools.product((False, True), repeat=6):
+            expected = PerVariableIteration(vectors, gc, damping).state()
+            numpy.testing.assert_allclose(connection_matrix(gc, damping).dot(vectors), expected, atol=1e-12)
+
+
+def test_iteration_step_keeps_the_segment_lengths():
+    body_model = mmcBodyModelStance(None, offline=True)
+    body_model.gc = [True] * 6
+    norms = body_model.segm_norms.copy()
+    body_model.pullBodyModelAtFrontIntoRelativeDirection(0.2, 0.05)
+    for _ in range(20):
+        body_model.mmc_iteration_step()
+    segments = body_model.vectors[SEGM_LEG_ANT_ROWS.start:SEGM_DIAG_ROWS.start + 1]
+    numpy.testing.assert_allclose(numpy.linalg.norm(segments, axis=1), norms)
+    assert body_model.step == 20
+
+
+def test_rollback_restores_the_latest_consistent_state():
+    body_model = mmcBodyModelStance(None, offline=True)
+    body_model.gc = [True] * 6
+    body_model.history = BodyModelHistory(3)
+    assert not body_model.rollback()
+    body_model.pullBodyModelAtFrontIntoRelativeDirection(0.0, 0.05)
+    states = []
+    for _ in range(5):
+        body_model.mmc_iteration_step()
+        body_model.update_history()
+        states.append(body_model.vectors[0:STATE_ROWS].copy())
+    assert len(body_model.history) == 3
+    assert body_model.history.latest()['step'] == 5
+    footdiag = body_model.footdiag.copy()
+    body_model.mmc_iteration_step()
+    body_model.footdiag[1][0] += 0.1
+    assert body_model.rollback()
+    numpy.testing.assert_array_equal(body_model.vectors[0:STATE_ROWS], states[-1])
+    numpy.testing.assert_array_equal(body_model.footdiag, footdiag)
@@ -0,0 +1,53 @@
+import numpy
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+from walknet_curvewalking_project.phantomx.ground_contact import GroundContactEstimator
+from walknet_curvewalking_project.phantomx.leg_kinematics import inverse_kinematics, static_transform
+from walknet_curvewalking_project.support.batched_simulation import SEGMENT_LENGTHS
+
+PERIOD = 0.01
+
+
+# Joint state of a leg, set from foot positions (measured) and commanded foot positions.
+class Leg:
+    def __init__(self, name):
+        self.name = name
+        self.angles = None
+        self.targets = None
+
+    def move(self, foot, command=None):
+        transform = static_transform(self.name)
+        self.angles = inverse_kinematics(foot, transform, SEGMENT_LENGTHS)[0].tolist()
+        self.targets = inverse_kinematics(foot if command is None else command, transform, SEGMENT_LENGTHS)[0].tolist()
+
+    def get_current_angles(self):
+        return self.angles
+
+    def get_current_targets(self):
+        return self.targets
+
+
+def test_feet_at_the_aep_below_the_expected_ground_have_contact():
+    legs = [Leg('lf'), Leg('lm'), Leg('rr')]
+    estimator = GroundContactEstimator(legs)
+    legs[0].move(RSTATIC.front_initial_aep)
+    # in the air above the AEP
+    legs[1].move(RSTATIC.middle_initial_aep + [0, 0, 0.03])
+    # a leg without joint state
+    for _ in range(5):
+        estimator.update(PERIOD)
+    assert estimator.contact.tolist() == [True, False, False]
+    assert estimator.has_contact('lf') and not estimator.has_contact('rr')
+
+
+def test_foot_that_is_stopped_above_its_descending_command_has_contact():
+    leg = Leg('lm')
+    estimator = GroundContactEstimator([leg])
+    # higher ground in the middle of the swing: the command keeps moving down, the foot stays
+    foot = numpy.array([0.0, 0.3, RSTATIC.stance_height + 0.03])
+    for tick in range(30):
+        leg.move(foot + [0, 0, 0.001 * max(0, 10 - tick)], foot - [0, 0, 0.001 * tick])
+        estimator.update(PERIOD)
+        if tick == 5:
+            assert not estimator.contact[0]
+    assert estimator.contact[0]
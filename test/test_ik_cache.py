@@ -0,0 +1,103 @@
+import numpy
+import pytest
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+from walknet_curvewalking_project.phantomx import ik_cache
+from walknet_curvewalking_project.phantomx.ik_cache import InverseKinematicsCache
+from walknet_curvewalking_project.phantomx.leg_kinematics import forward_kinematics, inverse_kinematics, \
+    static_transform
+from walknet_curvewalking_project.support.batched_simulation import SEGMENT_LENGTHS
+
+
+# The inverse kinematics of a leg (as used by the cache) with the batched kinematics, counting the solved points.
+class Leg:
+    def __init__(self, name):
+        self.name = name
+        self.transform = static_transform(name)
+        self.solved = 0
+
+    def solve_inverse_kinematics(self, p):
+        self.solved += 1
+        angles, valid = inverse_kinematics(p[0:3], self.transform, SEGMENT_LENGTHS)
+        if not valid:
+            raise ValueError('The provided position is not valid for the given geometry for leg ' + self.name)
+        return angles
+
+
+def test_exact_mode_returns_the_angles_of_the_nearest_lattice_point():
+    leg = Leg('lf')
+    cache = InverseKinematicsCache(size=16, resolution=0.001, mode='exact')
+    target = RSTATIC.front_initial_aep + [0.0002, -0.0003, 0.0004]
+    angles = cache.compute_inverse_kinematics(leg, target)
+    numpy.testing.assert_allclose(angles, leg.solve_inverse_kinematics(numpy.round(target, 3)))
+    # a target with the same lattice point is a hit, the returned angles are a copy of the entry
+    angles[0] = 10
+    assert cache.compute_inverse_kinematics(leg, target + 0.0001)[0] != 10
+    assert cache.statistics()['hits'] == 1 and cache.statistics()['misses'] == 1
+
+
+def test_entries_are_keyed_by_the_leg():
+    cache = InverseKinematicsCache(size=16, resolution=0.001, mode='exact')
+    target = numpy.array([0.0, 0.25, RSTATIC.stance_height])
+    cache.compute_inverse_kinematics(Leg('lm'), target)
+    cache.compute_inverse_kinematics(Leg('lf'), target)
+    assert cache.statistics()['misses'] == 2
+
+
+def test_least_recently_used_entries_are_evicted():
+    leg = Leg('lm')
+    cache = InverseKinematicsCache(size=2, resolution=0.001, mode='exact')
+    targets = [RSTATIC.middle_initial_aep + [offset, 0, 0] for offset in (0.0, 0.01, 0.02)]
+    cache.compute_inverse_kinematics(leg, targets[0])
+    cache.compute_inverse_kinematics(leg, targets[1])
+    # the first target is used again, so the second one is the least recently used
+    cache.compute_inverse_kinematics(leg, targets[0])
+    cache.compute_inverse_kinematics(leg, targets[2])
+    assert cache.statistics()['evictions'] == 1
+    solved = leg.solved
+    cache.compute_inverse_kinematics(leg, targets[0])
+    assert leg.solved == solved
+    cache.compute_inverse_kinematics(leg, targets[1])
+    assert leg.solved == solved + 1
+    cache.configure(1, 0.001, 'exact')
+    assert cache.statistics()['entries'] == 1
+
+
+def test_interpolated_angles_are_closer_than_the_nearest_lattice_point():
+    leg = Leg('rm')
+    transform = static_transform('rm')
+    exact = InverseKinematicsCache(size=1000, resolution=0.002, mode='exact')
+    interpolated = InverseKinematicsCache(size=1000, resolution=0.002, mode='interpolate')
+    targets = RSTATIC.middle_initial_aep * [1, -1, 1] + numpy.random.RandomState(0).uniform(-0.02, 0.02, (20, 3))
+    feet = forward_kinematics([leg.solve_inverse_kinematics(target) for target in targets], transform)
+    exact_errors = numpy.linalg.norm(forward_kinematics(
+            [exact.compute_inverse_kinematics(leg, target) for target in targets], transform) - feet, axis=1)
+    interpolated_errors = numpy.linalg.norm(forward_kinematics(
+            [interpolated.compute_inverse_kinematics(leg, target) for target in targets], transform) - feet, axis=1)
+    assert interpolated_errors.max() < 1e-4
+    assert interpolated_errors.mean() < exact_errors.mean() / 5
+    # the eight corners of a lattice cell are shared by the targets in the cell
+    solved = leg.solved
+    interpolated.compute_inverse_kinematics(leg, (numpy.floor(targets[0] / 0.002) + 0.5) * 0.002)
+    assert leg.solved == solved
+
+
+def test_targets_that_cannot_be_cached_are_solved_directly():
+    leg = Leg('lf')
+    cache = InverseKinematicsCache(size=16, resolution=0.001, mode='interpolate')
+    # no interpolation across the switch of the solution at z = 0
+    target = numpy.array([0.2, 0.2, -0.0005])
+    numpy.testing.assert_allclose(cache.compute_inverse_kinematics(leg, target), leg.solve_inverse_kinematics(target))
+    assert cache.statistics()['uncached'] == 1
+    with pytest.raises(ValueError):
+        cache.compute_inverse_kinematics(leg, static_transform('lf')[0:3, 3])
+
+
+def test_shared_cache_follows_the_settings(restore_settings):
+    restore_settings.update({'ik_cache_size': 0})
+    assert ik_cache.shared_cache() is None
+    restore_settings.update({'ik_cache_size': 8, 'ik_cache_resolution': 0.001, 'ik_cache_mode': 'interpolate'})
+    cache = ik_cache.shared_cache()
+    assert (cache.size, cache.resolution, cache.mode) == (8, 0.001, 'interpolate')
+    restore_settings.update({'ik_cache_size': 4})
+    assert ik_cache.shared_cache() is cache and cache.size == 4
@@ -0,0 +1,48 @@
+import numpy
+
+from walknet_curvewalking_project.support.latency import BODY_MODEL, COMMAND, INVERSE_KINEMATICS, LatencyTracer
+
+
+class Clock:
+    def __init__(self):
+        self.time = 100.0
+
+    def __call__(self):
+        return self.time
+
+
+def test_latencies_of_the_stages_are_measured_from_the_stamp():
+    clock = Clock()
+    tracer = LatencyTracer(size=4, clock=clock)
+    tracer.command_received(1, stamp=99.9)
+    clock.time = 100.1
+    # the stages after the body model wait for the previous stage
+    assert not tracer.trace(INVERSE_KINEMATICS)
+    assert tracer.trace(BODY_MODEL)
+    clock.time = 100.2
+    assert tracer.trace(INVERSE_KINEMATICS)
+    clock.time = 100.3
+    assert tracer.trace(COMMAND)
+    numpy.testing.assert_allclose(tracer.latencies[0], [0.1, 0.2, 0.3, 0.4])
+    assert tracer.sequences[0] == 1
+    # nothing is traced until the next command
+    assert not tracer.trace(BODY_MODEL)
+    statistics = tracer.statistics()
+    assert statistics['completed'] == 1
+    numpy.testing.assert_allclose(statistics['command_p50'], 0.4)
+
+
+def test_replaced_commands_are_superseded():
+    clock = Clock()
+    tracer = LatencyTracer(size=2, clock=clock)
+    tracer.command_received(1)
+    tracer.trace(BODY_MODEL)
+    tracer.command_received(2)
+    assert tracer.statistics()['superseded'] == 1
+    for sequence in range(3, 6):
+        tracer.command_received(sequence)
+        for stage in (BODY_MODEL, INVERSE_KINEMATICS, COMMAND):
+            tracer.trace(stage)
+    # the ring buffer keeps the last traces
+    assert tracer.completed == 3
+    assert sorted(tracer.sequences.tolist()) == [4, 5]
@@ -0,0 +1,54 @@
+import numpy
+import pytest
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+from walknet_curvewalking_project.phantomx.leg_kinematics import forward_kinematics, inverse_kinematics, \
+    static_transform
+from walknet_curvewalking_project.support.batched_simulation import SEGMENT_LENGTHS
+
+
+# Grid of points around the stance of the leg (from behind its PEP to in front of its AEP, inside and outside of
+# the default stance width, around the stance height).
+def stance_points(leg_name):
+    aep = {'f': RSTATIC.front_initial_aep, 'm': RSTATIC.middle_initial_aep, 'r': RSTATIC.hind_initial_aep}[leg_name[1]]
+    pep = {'f': RSTATIC.front_initial_pep, 'm': RSTATIC.middle_initial_pep, 'r': RSTATIC.hind_initial_pep}[leg_name[1]]
+    side = 1 if leg_name[0] == 'l' else -1
+    axes = (numpy.linspace(pep[0] - 0.02, aep[0] + 0.02, 5), side * numpy.linspace(aep[1] - 0.04, aep[1] + 0.04, 5),
+            numpy.linspace(aep[2] - 0.02, aep[2] + 0.02, 3))
+    return numpy.stack(numpy.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+def test_kinematics_of_all_legs_at_once_match_the_kinematics_per_leg():
+    points = numpy.array([stance_points(leg_name) for leg_name in RSTATIC.leg_names])
+    transforms = numpy.array([static_transform(leg_name) for leg_name in RSTATIC.leg_names])
+    angles, valid = inverse_kinematics(points, transforms[:, None], SEGMENT_LENGTHS)
+    assert valid.all()
+    feet = forward_kinematics(angles, transforms[:, None])
+    for leg_nr, leg_name in enumerate(RSTATIC.leg_names):
+        leg_angles, _ = inverse_kinematics(points[leg_nr], static_transform(leg_name), SEGMENT_LENGTHS)
+        numpy.testing.assert_allclose(angles[leg_nr], leg_angles, atol=1e-12)
+        numpy.testing.assert_allclose(feet[leg_nr], forward_kinematics(leg_angles, static_transform(leg_name)),
+                                      atol=1e-12)
+
+
+def test_inverse_kinematics_marks_points_near_the_coxa_invalid():
+    transform = static_transform('lf')
+    points = numpy.array([transform[0:3, 3] + [0, 0.01, 0], RSTATIC.front_initial_aep])
+    angles, valid = inverse_kinematics(points, transform, SEGMENT_LENGTHS)
+    assert valid.tolist() == [False, True]
+    assert numpy.isnan(angles[0]).all()
+    assert not numpy.isnan(angles[1]).any()
+
+
+# The batched kinematics of leg_kinematics.py against the per leg functions of SingleLeg.
+def test_batched_kinematics_match_single_leg():
+    pytest.importorskip('rospy')
+    from walknet_curvewalking_project.phantomx.SingleLeg import SingleLeg
+    for leg_name in RSTATIC.leg_names:
+        leg = SingleLeg(leg_name, list(SEGMENT_LENGTHS), None, 1, offline=True)
+        points = stance_points(leg_name)
+        angles = leg.compute_inverse_kinematics_batch(points)
+        numpy.testing.assert_allclose(angles, [leg.solve_inverse_kinematics(point) for point in points], atol=1e-9)
+        numpy.testing.assert_allclose(forward_kinematics(angles, leg.c1_static_transform),
+                                      [leg.compute_forward_kinematics(leg_angles)[0:3] for leg_angles in angles],
+                                      atol=1e-12)
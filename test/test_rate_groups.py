@@ -0,0 +1,26 @@
+import time
+
+import pytest
+
+pytest.importorskip('rospy')
+
+from walknet_curvewalking_project.controller import rate_groups  # noqa: E402
+
+
+def test_missed_releases_are_skipped():
+    group = rate_groups.RateGroup('body_model', 100.0, lambda: None)
+    assert group.next_release(1.0, 1.005) == pytest.approx(1.01)
+    # the execution ended after three more releases
+    assert group.next_release(1.0, 1.035) == pytest.approx(1.04)
+    assert group.skipped_releases == 3
+
+
+def test_executions_over_the_deadline_are_counted():
+    group = rate_groups.RateGroup('legs', 100.0, lambda: None, deadline=0.002)
+    group.execute(time.perf_counter())
+    # released one second ago
+    group.execute(time.perf_counter() - 1.0)
+    statistics = group.statistics()
+    assert statistics['executions'] == 2
+    assert statistics['overruns'] == 1
+    assert statistics['max_latency'] >= 1.0
@@ -0,0 +1,71 @@
+import numpy
+import pytest
+
+import walknet_curvewalking_project.phantomx.RobotSettings as RSTATIC
+import walknet_curvewalking_project.support.constants as CONST
+
+
+def test_stance_geometry_is_derived_from_its_settings(restore_settings):
+    changed = restore_settings.update({'stance_height': -0.1, 'default_stance_distance': 0.12})
+    assert changed == {'stance_height', 'default_stance_distance'}
+    assert RSTATIC.front_initial_aep[2] == -0.1
+    numpy.testing.assert_allclose(RSTATIC.front_initial_aep[0] - RSTATIC.front_initial_pep[0], 0.12)
+
+
+def test_body_model_frequency_follows_the_controller_frequency(restore_settings):
+    restore_settings.update({'controller_frequency': 50, 'body_model_frequency': None})
+    assert RSTATIC.body_model_frequency == 50
+    restore_settings.update({'body_model_frequency': 25})
+    assert RSTATIC.body_model_frequency == 25
+    restore_settings.update({'controller_frequency': 80})
+    assert RSTATIC.body_model_frequency == 25
+
+
+def test_values_are_converted_to_the_types_of_the_settings(restore_settings):
+    restore_settings.update({'damping': 3, 'swing_velocity': '1.5', 'apex_point_offset': [0, 0.01, 0.02],
+                             'evasion_template_ratios': 10.0})
+    assert isinstance(RSTATIC.body_model_damping, float) and RSTATIC.body_model_damping == 3.0
+    assert CONST.DEFAULT_SWING_VELOCITY == 1.5
+    assert isinstance(CONST.DEFAULT_APEX_POINT_OFFSET, numpy.ndarray)
+    assert isinstance(RSTATIC.evasion_template_ratios, int)
+
+
+@pytest.mark.parametrize('values', [{'evasion_template_ratios': 2.5}, {'swing_mode': 'spline'},
+                                    {'stability_gating': 1}, {'apex_point_offset': [0, 1]}, {'damping': True},
+                                    {'no_such_setting': 1}])
+def test_invalid_values_are_rejected_without_changing_any_setting(restore_settings, values):
+    before = restore_settings.as_dict()
+    with pytest.raises(ValueError):
+        restore_settings.update(dict(values, stance_height=-0.11))
+    assert restore_settings.as_dict()['stance_height'] == before['stance_height']
+
+
+def test_unknown_settings_can_be_ignored(restore_settings):
+    assert restore_settings.update({'no_such_setting': 1, 'damping': 4}, ignore_unknown=True) == {'damping'}
+
+
+def test_restart_only_settings_are_rejected_at_runtime(restore_settings):
+    frequency = RSTATIC.controller_frequency
+    restore_settings.request_update({'controller_frequency': frequency + 10, 'damping': 4})
+    assert restore_settings.apply_pending() == {'damping'}
+    assert RSTATIC.controller_frequency == frequency
+    assert RSTATIC.body_model_damping == 4
+    # at start-up they are applied
+    assert restore_settings.update({'controller_frequency': frequency + 10}) == {'controller_frequency'}
+
+
+class Subscriber:
+    def __init__(self):
+        self.notifications = []
+
+    def changed(self, names):
+        self.notifications.append(names)
+
+
+def test_subscribers_are_notified_of_their_changed_settings(restore_settings):
+    subscriber = Subscriber()
+    restore_settings.subscribe(('swing_mode', 'swing_velocity'), subscriber.changed)
+    restore_settings.update({'damping': 4})
+    restore_settings.update({'swing_velocity': 1.2, 'damping': 6})
+    restore_settings.update({'swing_velocity': 1.2})
+    assert subscriber.notifications == [{'swing_velocity', 'damping'}]
@@ -0,0 +1,51 @@
+import numpy
+
+from walknet_curvewalking_project.phantomx.stability import StabilityMonitor, support_margins
+
+SQUARE = numpy.array([[1.0, 1.0], [-1.0, 1.0], [-1.0, -1.0], [1.0, -1.0]])
+
+
+def test_margin_of_a_square_is_the_distance_to_the_nearest_edge():
+    stance_sets = numpy.ones((1, 4), dtype=bool)
+    assert support_margins(SQUARE, stance_sets, numpy.zeros(2))[0] == 1.0
+    numpy.testing.assert_allclose(support_margins(SQUARE, stance_sets, numpy.array([0.5, 0.2]))[0], 0.5)
+    # outside of the polygon the margin is negative
+    numpy.testing.assert_allclose(support_margins(SQUARE, stance_sets, numpy.array([1.5, 0.0]))[0], -0.5)
+
+
+def test_margins_of_several_stance_sets_at_once():
+    # the triangle without the foot at (1, -1) and a set with two feet only
+    stance_sets = numpy.array([[True, True, True, True], [True, True, True, False], [True, True, False, False]])
+    margins = support_margins(SQUARE, stance_sets, numpy.array([-0.5, 0.0]))
+    numpy.testing.assert_allclose(margins[0:2], [0.5, 0.5 / numpy.sqrt(2)])
+    assert margins[2] == -numpy.inf
+
+
+def test_feet_in_the_interior_and_on_the_edges_do_not_change_the_polygon():
+    feet = numpy.vstack([SQUARE, [[0.0, 0.0], [1.0, 0.0]]])
+    stance_sets = numpy.ones((1, 6), dtype=bool)
+    numpy.testing.assert_allclose(support_margins(feet, stance_sets, numpy.array([0.2, 0.0]))[0], 0.8)
+
+
+def test_margins_of_a_batch_of_robots():
+    feet = numpy.array([SQUARE, 2 * SQUARE])
+    stance_sets = numpy.ones((2, 1, 4), dtype=bool)
+    numpy.testing.assert_allclose(support_margins(feet, stance_sets, numpy.zeros((2, 2)))[:, 0], [1.0, 2.0])
+
+
+def test_monitor_refuses_the_lift_of_a_leg_that_carries_the_center(restore_settings):
+    restore_settings.update({'stability_gating': True, 'stability_min_margin': 0.0, 'center_of_mass': [0, 0, 0]})
+    monitor = StabilityMonitor(4)
+    # the center of mass (origin) is outside of the triangle without foot 1
+    feet = numpy.column_stack([numpy.array([[1.0, 0.1], [-1.0, 1.0], [-1.0, -1.0], [1.0, -1.0]]), numpy.zeros(4)])
+    monitor.update(feet, [True] * 4)
+    assert monitor.margin > 0
+    assert not monitor.can_lift(1)
+    assert not monitor.request_lift(1)
+    assert monitor.request_lift(0)
+    # after foot 0 was lifted the polygon is a triangle, the other legs have to stay on the ground
+    assert not monitor.stance[0]
+    assert not any(monitor.can_lift(leg_nr) for leg_nr in (1, 2, 3))
+    assert monitor.request_lift(2, force=True)
+    restore_settings.update({'stability_gating': False})
+    assert monitor.can_lift(1)
@@ -0,0 +1,56 @@
+import numpy
+
+from walknet_curvewalking_project.motion_primitives.streaming import END_OF_MOVEMENT, JointLimitStage, Pipeline, \
+    StreamingPrimitive, TickSamples, sample_line
+
+
+class Leg:
+    def __init__(self):
+        self.commands = []
+
+    def set_command(self, command):
+        self.commands.append(command)
+
+
+class Movement(StreamingPrimitive):
+    def commands(self):
+        yield 1
+        yield None
+        yield 2
+
+
+def test_sample_line_ends_at_the_target():
+    samples = sample_line([0, 0, 0], [1, 2, 0], 4)
+    numpy.testing.assert_allclose(samples[0], [0.25, 0.5, 0])
+    numpy.testing.assert_allclose(samples[-1], [1, 2, 0])
+
+
+def test_bulk_evaluation_matches_the_evaluation_per_tick():
+    limits = [[-1, 1], [-0.5, 0.5], [0, 2]]
+    pipeline = Pipeline(TickSamples(lambda t: numpy.stack([t, -t, t * t], axis=-1), 10.0), JointLimitStage(limits))
+    ticks = [value for value, _ in zip(pipeline, range(15))]
+    numpy.testing.assert_allclose(pipeline.evaluate(15), ticks)
+    assert pipeline.evaluate(15)[-1].tolist() == [1.0, -0.5, 2.0]
+
+
+def test_streaming_primitive_sends_the_commands_until_it_is_finished():
+    leg = Leg()
+    movement = Movement(leg)
+    assert movement.step() and movement.step() and movement.step()
+    assert not movement.is_finished()
+    # the movement ends with the tick after the last command
+    assert not movement.step()
+    assert movement.is_finished() and movement.next_command() is END_OF_MOVEMENT
+    assert leg.commands == [1, 2]
+    movement.stop()
+    assert not movement.is_finished() and movement.next_command() == 1
+
+
+def test_activation_stops_the_movement_when_it_drops():
+    leg = Leg()
+    movement = Movement(leg)
+    movement.move_to_next_point(1.0)
+    movement.move_to_next_point(0.0)
+    assert not movement.is_active()
+    movement.move_to_next_point(1.0)
+    assert leg.commands == [1, 1]